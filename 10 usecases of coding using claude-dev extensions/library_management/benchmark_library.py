@@ -0,0 +1,405 @@
+"""
+Benchmarks for the Library implementations on synthetic catalogs.
+
+Usage:
+    python benchmark_library.py search [--sizes 1000,10000,100000,1000000] [--queries N]
+    python benchmark_library.py ingest [--sizes 100000,1000000]
+    python benchmark_library.py memory [--size 1000000] [--lookups N]
+    python benchmark_library.py sqlite [--sizes 10000,100000] [--queries N] [--borrows N]
+    python benchmark_library.py startup [--size 1000000] [--lookups N]
+    python benchmark_library.py threads [--threads 1,2,4,8] [--size 100000] [--operations N]
+    python benchmark_library.py indexes [--sizes 100000,1000000] [--repeat N]
+"""
+import argparse
+import contextlib
+import gc
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from typing import Callable, Iterator, List
+
+import optimized_library_management
+from columnar_library_management import BookTable, ColumnarLibrary
+from concurrent_library_management import LOCK_STRIPES, ConcurrentLibrary
+from refactored_library_management import Book, Library
+from sqlite_library_management import SQLiteLibrary
+
+ONSETS = ("", "b", "br", "c", "ch", "d", "f", "g", "h", "k", "l", "m", "n", "p", "r", "s", "st", "t", "th", "v", "w")
+SYLLABLES = [onset + vowel + coda for onset in ONSETS for vowel in "aeiou" for coda in ("", "n", "r", "s", "l")]
+FIRST_NAMES = ["Ada", "Ben", "Clara", "Dmitri", "Elif", "Femi", "Grace", "Hiro", "Ines", "Jonas", "Kemal", "Lena"]
+VOCABULARY_SIZE = 20000
+
+
+def _word(rng: random.Random) -> str:
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 3)))
+
+
+def _pick(rng: random.Random, words: List[str]) -> str:
+    # Skewed towards the start of the list, like word frequencies in real titles
+    return words[int(len(words) * rng.random() ** 3)]
+
+
+def iter_books(count: int, seed: int = 0, book_class=Book) -> Iterator[Book]:
+    """
+    Generates a reproducible catalog of made-up titles and authors.
+    """
+    rng = random.Random(seed)
+    vocabulary = [_word(rng) for _ in range(VOCABULARY_SIZE)]
+    surnames = [(_word(rng) + _word(rng)).capitalize() for _ in range(max(10, count // 20))]
+    for i in range(count):
+        title = " ".join(_pick(rng, vocabulary) for _ in range(rng.randint(2, 5))).capitalize()
+        author = f"{rng.choice(FIRST_NAMES)} {rng.choice(surnames)}"
+        yield book_class(title, author, f"{i:013d}")
+
+
+def make_books(count: int, seed: int = 0) -> List[Book]:
+    """
+    Builds a reproducible catalog of made-up titles and authors.
+    """
+    return list(iter_books(count, seed))
+
+
+def make_queries(books: List[Book], count: int, seed: int = 1) -> List[str]:
+    """
+    Picks substrings of random titles and authors, plus some that match nothing.
+    """
+    rng = random.Random(seed)
+    queries = []
+    for i in range(count):
+        if i % 10 == 9:
+            queries.append("xq" + _word(rng))
+            continue
+        book = rng.choice(books)
+        text = rng.choice((book.title, book.author.split()[-1]))
+        length = min(len(text), rng.randint(4, 10))
+        start = rng.randint(0, len(text) - length)
+        queries.append(text[start:start + length])
+    return queries
+
+
+def linear_search(library: Library, search_term: str) -> List[Book]:
+    """
+    The full scan search_books used before the trigram index.
+    """
+    return [
+        book for book in library.books.values()
+        if search_term.lower() in book.title.lower() or search_term.lower() in book.author.lower()
+    ]
+
+
+def _time_queries(search: Callable[[str], List[Book]], queries: List[str]) -> List[float]:
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        search(query)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def bench_search(args) -> None:
+    for size in args.sizes:
+        books = make_books(size)
+        queries = make_queries(books, args.queries)
+        library = Library()
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            for book in books:
+                library.add_book(book)
+        load = time.perf_counter() - start
+
+        for query in queries[:20]:
+            assert library.search_books(query) == linear_search(library, query), query
+        # The scan takes seconds per query at a million books; fewer queries suffice
+        scan_queries = queries[:max(5, min(len(queries), 10_000_000 // size))]
+        scan = _time_queries(lambda q: linear_search(library, q), scan_queries)
+        indexed = _time_queries(library.search_books, queries)
+        scan_ms, indexed_ms = statistics.median(scan) * 1000, statistics.median(indexed) * 1000
+        print(
+            f"books={size:<8} load={load:6.2f}s "
+            f"scan_p50={scan_ms:9.3f}ms index_p50={indexed_ms:8.3f}ms "
+            f"index_max={max(indexed) * 1000:8.3f}ms speedup={scan_ms / indexed_ms:7.1f}x"
+        )
+
+
+def _time_ingest(books: List[Book], load: Callable[[optimized_library_management.Library], None], **kwargs) -> float:
+    library = optimized_library_management.Library(**kwargs)
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        load(library)
+    elapsed = time.perf_counter() - start
+    assert len(library.books) == len(books)
+    return elapsed
+
+
+def bench_ingest(args) -> None:
+    def one_by_one(library):
+        for book in books:
+            library.add_book(book)
+
+    def printed(event, book):
+        # What add_book did before messages went through the logger (to /dev/null here, not a terminal)
+        print(f"Book '{book.title}' added to the library.")
+
+    for size in args.sizes:
+        books = list(iter_books(size, book_class=optimized_library_management.Book))
+        for name, load, kwargs in (
+            ("add_book + print", one_by_one, {"on_event": printed}),
+            ("add_book quiet", one_by_one, {}),
+            ("add_books batch", lambda library: library.add_books(books), {}),
+        ):
+            elapsed = _time_ingest(books, load, **kwargs)
+            print(f"books={size:<8} {name:<17} {elapsed:6.2f}s {size / elapsed:10,.0f} books/s")
+
+
+def _traced_bytes(build: Callable[[], object]) -> int:
+    # Memory still allocated after build(), while its result is alive
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = build()
+        gc.collect()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return current
+
+
+def bench_memory(args) -> None:
+    size = args.size
+    book_class = optimized_library_management.Book
+
+    def dict_storage():
+        return OrderedDict((book.isbn, book) for book in iter_books(size, book_class=book_class))
+
+    def columnar_storage():
+        table = BookTable()
+        for book in iter_books(size, book_class=book_class):
+            table[book.isbn] = book
+        return table
+
+    def quiet(library):
+        library.add_books(iter_books(size, book_class=book_class))
+        return library
+
+    rows = [
+        ("OrderedDict of Book", dict_storage),
+        ("BookTable", columnar_storage),
+        ("Library", lambda: quiet(optimized_library_management.Library())),
+        ("ColumnarLibrary", lambda: quiet(ColumnarLibrary())),
+    ]
+    for name, build in rows:
+        used = _traced_bytes(build)
+        print(f"books={size:<8} {name:<20} {used / 2 ** 20:8.1f} MiB {used / size:7.1f} bytes/book")
+
+    rng = random.Random(2)
+    isbns = [f"{rng.randrange(size):013d}" for _ in range(args.lookups)]
+    for name, build in rows[:2]:
+        storage = build()
+        start = time.perf_counter()
+        for isbn in isbns:
+            storage[isbn].status
+        elapsed = time.perf_counter() - start
+        print(f"books={size:<8} {name:<20} {elapsed / len(isbns) * 1e6:8.2f} us/lookup")
+        del storage
+
+
+def bench_sqlite(args) -> None:
+    for size in args.sizes:
+        queries = make_queries(make_books(size), args.queries)
+        rng = random.Random(3)
+        isbns = [f"{rng.randrange(size):013d}" for _ in range(args.borrows)]
+        with tempfile.TemporaryDirectory() as directory:
+            for name, create in (
+                ("Library", optimized_library_management.Library),
+                ("SQLiteLibrary", lambda: SQLiteLibrary(os.path.join(directory, "library.db"))),
+            ):
+                # Every search is new to the cache, so the backend does the work
+                library = create()
+                library.clear_search_cache()
+                books = list(iter_books(size, book_class=optimized_library_management.Book))
+                start = time.perf_counter()
+                library.add_books(books)
+                load = time.perf_counter() - start
+                del books
+                search = _time_queries(lambda q: (library.search_books(q), library.clear_search_cache()), queries)
+                start = time.perf_counter()
+                for isbn in isbns:
+                    library.borrow_book(isbn)
+                    library.return_book(isbn)
+                borrow = time.perf_counter() - start
+                print(
+                    f"books={size:<8} {name:<14} load={size / load:10,.0f} books/s "
+                    f"search_p50={statistics.median(search) * 1000:8.3f}ms "
+                    f"borrow+return={len(isbns) / borrow:10,.0f} pairs/s"
+                )
+                if isinstance(library, SQLiteLibrary):
+                    library.close()
+
+
+def bench_startup(args) -> None:
+    size = args.size
+    books = list(iter_books(size, book_class=optimized_library_management.Book))
+    rng = random.Random(4)
+    isbns = [f"{rng.randrange(size):013d}" for _ in range(args.lookups)]
+
+    start = time.perf_counter()
+    library = optimized_library_management.Library()
+    library.add_books(books)
+    rebuild = time.perf_counter() - start
+    del books
+    print(f"books={size:<8} {'add_books':<24} {rebuild * 1000:10.1f}ms")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "library.snapshot")
+        start = time.perf_counter()
+        library.save_snapshot(path)
+        print(f"books={size:<8} {'save_snapshot':<24} {(time.perf_counter() - start) * 1000:10.1f}ms "
+              f"{os.path.getsize(path) / 2 ** 20:8.1f} MiB")
+        del library
+        for verify in (True, False):
+            start = time.perf_counter()
+            snapshot = optimized_library_management.Library.open_snapshot(path, verify=verify)
+            elapsed = time.perf_counter() - start
+            print(f"books={size:<8} {f'open_snapshot verify={verify}':<24} {elapsed * 1000:10.1f}ms")
+
+        start = time.perf_counter()
+        for isbn in isbns:
+            snapshot._get_book(isbn)
+        elapsed = time.perf_counter() - start
+        print(f"books={size:<8} {'_get_book':<24} {elapsed / len(isbns) * 1e6:10.2f}us")
+        start = time.perf_counter()
+        snapshot.search_books("ther")
+        print(f"books={size:<8} {'first search':<24} {(time.perf_counter() - start) * 1000:10.1f}ms")
+        snapshot.books.close()
+
+
+def _borrow_and_return(library: ConcurrentLibrary, isbns: List[str], threads: int) -> float:
+    def run(part):
+        for isbn in part:
+            if library.borrow_book(isbn):
+                library.return_book(isbn)
+
+    workers = [threading.Thread(target=run, args=(isbns[i::threads],)) for i in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start
+
+
+def bench_threads(args) -> None:
+    gil = sys._is_gil_enabled() if hasattr(sys, "_is_gil_enabled") else True
+    print(f"Python {sys.version.split()[0]}, GIL {'enabled' if gil else 'disabled'}, {os.cpu_count()} CPUs")
+    books = list(iter_books(args.size, book_class=optimized_library_management.Book))
+    rng = random.Random(5)
+    isbns = [rng.choice(books).isbn for _ in range(args.operations)]
+    for name, stripes in (("one lock", 1), (f"{LOCK_STRIPES} stripes", LOCK_STRIPES)):
+        library = ConcurrentLibrary(stripes=stripes)
+        library.add_books(books)
+        for threads in args.threads:
+            elapsed = _borrow_and_return(library, isbns, threads)
+            print(f"books={args.size:<8} {name:<12} threads={threads:<3} {len(isbns) / elapsed:12,.0f} borrow+return/s")
+
+
+def _best_ms(query: Callable[[], object], repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        query()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+
+def bench_indexes(args) -> None:
+    checked_out = optimized_library_management.BookStatus.CHECKED_OUT
+    normalize = optimized_library_management.normalize_author
+    for size in args.sizes:
+        books = list(iter_books(size, book_class=optimized_library_management.Book))
+        library = optimized_library_management.Library()
+        start = time.perf_counter()
+        library.add_books(books)
+        print(f"books={size:<8} add_books {time.perf_counter() - start:6.2f}s")
+        rng = random.Random(6)
+        library.borrow_many(book.isbn for book in rng.sample(books, size // 100))
+        author = rng.choice(books).author
+        values = library.books.values
+
+        queries = (
+            ("count checked out",
+             lambda: library.count_by_status(checked_out),
+             lambda: sum(1 for book in values() if book.status == checked_out)),
+            ("list checked out",
+             lambda: library.books_by_status(checked_out),
+             lambda: [book for book in values() if book.status == checked_out]),
+            ("list by author",
+             lambda: library.books_by_author(author),
+             lambda: [book for book in values() if normalize(book.author) == normalize(author)]),
+        )
+        for name, indexed, scan in queries:
+            result, expected = indexed(), scan()
+            if isinstance(result, list):
+                # The status index lists books in the order they got the status, not the order they were added
+                result, expected = sorted(book.isbn for book in result), sorted(book.isbn for book in expected)
+            assert result == expected, name
+            indexed_ms, scan_ms = _best_ms(indexed, args.repeat), _best_ms(scan, args.repeat)
+            print(f"books={size:<8} {name:<18} index={indexed_ms:9.4f}ms scan={scan_ms:9.2f}ms speedup={scan_ms / indexed_ms:9.0f}x")
+
+
+def _sizes(value: str) -> List[int]:
+    return [int(size) for size in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    search_parser = subparsers.add_parser("search", help="Trigram index vs linear scan for search_books")
+    search_parser.add_argument("--sizes", type=_sizes, default=[1000, 10000, 100000, 1000000])
+    search_parser.add_argument("--queries", type=int, default=200)
+    search_parser.set_defaults(func=bench_search)
+
+    ingest_parser = subparsers.add_parser("ingest", help="Loading a catalog one book at a time vs in one batch")
+    ingest_parser.add_argument("--sizes", type=_sizes, default=[100000, 1000000])
+    ingest_parser.set_defaults(func=bench_ingest)
+
+    memory_parser = subparsers.add_parser("memory", help="Dict-of-objects vs columnar storage, measured with tracemalloc")
+    memory_parser.add_argument("--size", type=int, default=1000000)
+    memory_parser.add_argument("--lookups", type=int, default=100000)
+    memory_parser.set_defaults(func=bench_memory)
+
+    sqlite_parser = subparsers.add_parser("sqlite", help="In-memory Library vs SQLiteLibrary on a file")
+    sqlite_parser.add_argument("--sizes", type=_sizes, default=[10000, 100000])
+    sqlite_parser.add_argument("--queries", type=int, default=200)
+    sqlite_parser.add_argument("--borrows", type=int, default=10000)
+    sqlite_parser.set_defaults(func=bench_sqlite)
+
+    startup_parser = subparsers.add_parser("startup", help="Re-adding every book vs opening a snapshot")
+    startup_parser.add_argument("--size", type=int, default=1000000)
+    startup_parser.add_argument("--lookups", type=int, default=100000)
+    startup_parser.set_defaults(func=bench_startup)
+
+    threads_parser = subparsers.add_parser("threads", help="ConcurrentLibrary borrow/return throughput by thread count")
+    threads_parser.add_argument("--threads", type=_sizes, default=[1, 2, 4, 8])
+    threads_parser.add_argument("--size", type=int, default=100000)
+    threads_parser.add_argument("--operations", type=int, default=200000)
+    threads_parser.set_defaults(func=bench_threads)
+
+    indexes_parser = subparsers.add_parser("indexes", help="Status and author indexes vs full scans")
+    indexes_parser.add_argument("--sizes", type=_sizes, default=[100000, 1000000])
+    indexes_parser.add_argument("--repeat", type=int, default=5)
+    indexes_parser.set_defaults(func=bench_indexes)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,656 @@
+# Columnar Library Management System
+# An array-backed storage engine for the Library in optimized_library_management.py, for very large catalogs.
+
+import re
+import weakref
+from array import array
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple
+from collections.abc import MutableMapping
+
+from optimized_library_management import Book, BookStatus, BulkResult, Library, SEARCH_CACHE_SIZE, SecondaryIndexes, normalize_author
+from trigram_index import COMPACT_MIN_DEAD, TrigramIndex
+
+# Markers in the ISBN hash table; packed ISBNs are always positive
+_EMPTY = -1
+_DELETED = -2
+_INITIAL_CAPACITY = 8
+# Packed ISBNs must fit in a signed 64-bit integer
+_MAX_PACKED_DIGITS = 17
+_NONZERO_BYTE = re.compile(rb"[^\x00]")
+# Prune the table's references to collected views once there are this many more
+_VIEWS_MIN_PRUNE = 1024
+
+def pack_isbn(isbn: str) -> int:
+    """
+    Packs an ISBN into a positive integer, or returns -1 if it cannot be packed.
+
+    The digits are prefixed with 1, or with 2 for an ISBN-10 ending in the
+    check character X, so leading zeros survive and unpacking is exact.
+
+    Args:
+        isbn (str): The ISBN, e.g. "0987654321" or "080442957X".
+
+    Returns:
+        int: The packed ISBN, or -1 for ISBNs with other characters or too many digits.
+    """
+    digits, marker = isbn, "1"
+    if isbn.endswith("X"):
+        digits, marker = isbn[:-1], "2"
+    if not digits or len(digits) > _MAX_PACKED_DIGITS or not (digits.isascii() and digits.isdigit()):
+        return -1
+    return int(marker + digits)
+
+def unpack_isbn(packed: int) -> str:
+    """
+    Reverses pack_isbn.
+
+    Args:
+        packed (int): A value returned by pack_isbn.
+
+    Returns:
+        str: The original ISBN.
+    """
+    text = str(packed)
+    return text[1:] + "X" if text[0] == "2" else text[1:]
+
+class BookView(Book):
+    """
+    A Book backed by one row of a BookTable, created when a book is looked up.
+
+    Reads come from the table and setting `status` writes to it, so a view
+    behaves like the stored Book object of the dict-based Library. Views
+    compare equal to Books with the same fields.
+    """
+    __slots__ = ("_table", "_row")
+
+    def __init__(self, table: "BookTable", row: int):
+        """
+        Initializes a view of a row.
+
+        Args:
+            table (BookTable): The table holding the book.
+            row (int): The book's row.
+        """
+        self._table = table
+        self._row = row
+
+    @property
+    def title(self) -> str:
+        return self._table.title(self._row)
+
+    @property
+    def author(self) -> str:
+        return self._table.author(self._row)
+
+    @property
+    def isbn(self) -> str:
+        return self._table.isbn(self._row)
+
+    @property
+    def status(self) -> BookStatus:
+        return self._table.status(self._row)
+
+    @status.setter
+    def status(self, status: BookStatus) -> None:
+        self._table.set_status(self._row, status)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Book):
+            return NotImplemented
+        return (self.title, self.author, self.isbn, self.status) == (other.title, other.author, other.isbn, other.status)
+
+    __hash__ = None
+
+class BookTable(MutableMapping):
+    """
+    A mapping of ISBN to Book that stores the books column by column.
+
+    Per book it keeps the UTF-8 title in one shared buffer (8 bytes of offset
+    plus the text), a 4-byte id into a table of distinct authors, the ISBN
+    packed into 8 bytes, and two bits for status and liveness, plus a count
+    of the checked-out books that status changes keep up to date. ISBNs are
+    found through an open-addressing hash table of packed ISBN and row
+    (12 bytes per slot, at most half full). ISBNs that cannot be packed are
+    kept in a small dict.
+
+    Titles are not deduplicated because they are nearly unique in a catalog,
+    while authors repeat. Iteration follows insertion order, like the
+    OrderedDict of the dict-based Library. Removed rows are only marked as
+    removed until `compact` drops them. The table keeps weak references to
+    the views it hands out, so compacting moves them to their books' new
+    rows and gives views of removed books a copy of their book; a view never
+    points at another book.
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty table.
+        """
+        self._titles = bytearray()
+        self._title_offsets = array("Q", [0])
+        self._author_ids: Dict[str, int] = {}
+        self._authors: List[str] = []
+        self._author_column = array("I")
+        self._isbns = array("q")
+        self._status_bits = bytearray()
+        self._live_bits = bytearray()
+        self._slot_keys = array("q", [_EMPTY]) * _INITIAL_CAPACITY
+        self._slot_rows = array("i", [0]) * _INITIAL_CAPACITY
+        self._used_slots = 0
+        # Rows and ISBNs of the books whose ISBN cannot be packed
+        self._other_rows: Dict[str, int] = {}
+        self._other_isbns: Dict[int, str] = {}
+        self._count = 0
+        # Live rows whose status bit is set
+        self.checked_out = 0
+        # The views handed out, pruned of collected ones as the list grows
+        self._views: List[weakref.ref] = []
+        self._views_kept = 0
+
+    # Column access, by row
+
+    def title(self, row: int) -> str:
+        offsets = self._title_offsets
+        return self._titles[offsets[row]:offsets[row + 1]].decode("utf-8")
+
+    def author(self, row: int) -> str:
+        return self._authors[self._author_column[row]]
+
+    def isbn(self, row: int) -> str:
+        packed = self._isbns[row]
+        return self._other_isbns[row] if packed < 0 else unpack_isbn(packed)
+
+    def status(self, row: int) -> BookStatus:
+        checked_out = self._status_bits[row >> 3] >> (row & 7) & 1
+        return BookStatus.CHECKED_OUT if checked_out else BookStatus.AVAILABLE
+
+    def set_status(self, row: int, status: BookStatus) -> None:
+        bit = 1 << (row & 7)
+        was_checked_out = bool(self._status_bits[row >> 3] & bit)
+        checked_out = status == BookStatus.CHECKED_OUT
+        if checked_out == was_checked_out:
+            return
+        if checked_out:
+            self._status_bits[row >> 3] |= bit
+        else:
+            self._status_bits[row >> 3] &= ~bit & 0xFF
+        # Views of removed books can still change their bit, which counts nothing
+        if self.live(row):
+            self.checked_out += 1 if checked_out else -1
+
+    def live(self, row: int) -> bool:
+        return bool(self._live_bits[row >> 3] >> (row & 7) & 1)
+
+    @property
+    def removed_rows(self) -> int:
+        return len(self._isbns) - self._count
+
+    def view(self, row: int) -> "BookView":
+        """
+        Returns a view of a row that follows its book when the table compacts.
+        """
+        view = BookView(self, row)
+        views = self._views
+        if len(views) >= 2 * self._views_kept + _VIEWS_MIN_PRUNE:
+            views[:] = [ref for ref in views if ref() is not None]
+            self._views_kept = len(views)
+        views.append(weakref.ref(view))
+        return view
+
+    def rows(self) -> Iterator[int]:
+        """
+        Yields the rows of the books in the table, in insertion order.
+        """
+        live = self._live_bits
+        for row in range(len(self._isbns)):
+            if live[row >> 3] >> (row & 7) & 1:
+                yield row
+
+    # ISBN hash table
+
+    def _probe(self, packed: int) -> Iterator[int]:
+        """
+        Yields the slots to try for a packed ISBN, in CPython's dict probe order.
+        """
+        mask = len(self._slot_keys) - 1
+        perturb = packed
+        slot = packed & mask
+        while True:
+            yield slot
+            perturb >>= 5
+            slot = (slot * 5 + perturb + 1) & mask
+
+    def _row(self, isbn: str) -> int:
+        """
+        Returns the row of a live ISBN, or -1.
+        """
+        packed = pack_isbn(isbn)
+        if packed < 0:
+            return self._other_rows.get(isbn, -1)
+        # The probe sequence of _probe, inlined on this hot path
+        keys = self._slot_keys
+        mask = len(keys) - 1
+        perturb = packed
+        slot = packed & mask
+        while True:
+            key = keys[slot]
+            if key == packed:
+                return self._slot_rows[slot]
+            if key == _EMPTY:
+                return -1
+            perturb >>= 5
+            slot = (slot * 5 + perturb + 1) & mask
+
+    def _insert_slot(self, packed: int, row: int) -> None:
+        keys = self._slot_keys
+        for slot in self._probe(packed):
+            if keys[slot] < 0:
+                if keys[slot] == _EMPTY:
+                    self._used_slots += 1
+                keys[slot] = packed
+                self._slot_rows[slot] = row
+                return
+
+    def _grow(self) -> None:
+        """
+        Rebuilds the hash table without deleted slots, doubling it if it is more than a quarter full.
+        """
+        capacity = len(self._slot_keys)
+        if self._count * 4 > capacity:
+            capacity *= 2
+        self._rebuild_slots(capacity, {})
+
+    def _rebuild_slots(self, capacity: int, new_rows: Mapping[int, int]) -> None:
+        """
+        Rebuilds the hash table with a capacity, moving rows listed in `new_rows`.
+        """
+        live = [(key, new_rows.get(row, row)) for key, row in zip(self._slot_keys, self._slot_rows) if key >= 0]
+        self._slot_keys = array("q", [_EMPTY]) * capacity
+        self._slot_rows = array("i", [0]) * capacity
+        self._used_slots = 0
+        for key, row in live:
+            self._insert_slot(key, row)
+
+    # Compaction
+
+    def compact(self) -> None:
+        """
+        Drops the removed rows, renumbering the others in order, and moves
+        the views handed out to the new rows. Indexes over the rows must be
+        rebuilt afterwards.
+        """
+        old_rows = list(self.rows())
+        new_rows = {old: new for new, old in enumerate(old_rows)}
+        for ref in self._views:
+            view = ref()
+            if view is None or view._table is not self:
+                continue
+            if view._row in new_rows:
+                view._row = new_rows[view._row]
+            else:
+                # A removed book keeps its fields and status in a table of its own
+                row = view._row
+                copy = Book(self.title(row), self.author(row), self.isbn(row), self.status(row))
+                view._table = BookTable()
+                view._table[copy.isbn] = copy
+                view._row = 0
+        self._views = [ref for ref in self._views if ref() is not None and ref()._table is self]
+        self._views_kept = len(self._views)
+
+        titles = bytearray()
+        title_offsets = array("Q", [0])
+        for row in old_rows:
+            titles += self._titles[self._title_offsets[row]:self._title_offsets[row + 1]]
+            title_offsets.append(len(titles))
+        self._titles, self._title_offsets = titles, title_offsets
+        self._author_column = array("I", (self._author_column[row] for row in old_rows))
+        self._isbns = array("q", (self._isbns[row] for row in old_rows))
+        status_bits = bytearray(len(old_rows) + 7 >> 3)
+        for new, old in enumerate(old_rows):
+            if self._status_bits[old >> 3] >> (old & 7) & 1:
+                status_bits[new >> 3] |= 1 << (new & 7)
+        self._status_bits = status_bits
+        self._live_bits = bytearray(b"\xff") * (len(old_rows) >> 3)
+        if len(old_rows) & 7:
+            self._live_bits.append((1 << (len(old_rows) & 7)) - 1)
+        self._other_rows = {isbn: new_rows[row] for isbn, row in self._other_rows.items()}
+        self._other_isbns = {row: isbn for isbn, row in self._other_rows.items()}
+        capacity = _INITIAL_CAPACITY
+        while capacity < self._count * 4:
+            capacity *= 2
+        self._rebuild_slots(capacity, new_rows)
+
+    # Mapping interface
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, isbn) -> bool:
+        return isinstance(isbn, str) and self._row(isbn) >= 0
+
+    def __getitem__(self, isbn: str) -> BookView:
+        row = self._row(isbn) if isinstance(isbn, str) else -1
+        if row < 0:
+            raise KeyError(isbn)
+        return self.view(row)
+
+    def __setitem__(self, isbn: str, book: Book) -> None:
+        if isbn != book.isbn:
+            raise ValueError(f"Book with ISBN {book.isbn} stored under ISBN {isbn}.")
+        if isbn in self:
+            del self[isbn]
+        row = len(self._isbns)
+        title = book.title.encode("utf-8")
+        self._titles += title
+        self._title_offsets.append(len(self._titles))
+        author_id = self._author_ids.get(book.author)
+        if author_id is None:
+            author_id = self._author_ids[book.author] = len(self._authors)
+            self._authors.append(book.author)
+        self._author_column.append(author_id)
+        if row & 7 == 0:
+            self._status_bits.append(0)
+            self._live_bits.append(0)
+        self._live_bits[row >> 3] |= 1 << (row & 7)
+        packed = pack_isbn(isbn)
+        self._isbns.append(packed)
+        if packed < 0:
+            self._other_rows[isbn] = row
+            self._other_isbns[row] = isbn
+        else:
+            if (self._used_slots + 1) * 2 > len(self._slot_keys):
+                self._grow()
+            self._insert_slot(packed, row)
+        self._count += 1
+        self.set_status(row, book.status)
+
+    def __delitem__(self, isbn: str) -> None:
+        packed = pack_isbn(isbn) if isinstance(isbn, str) else -1
+        if packed < 0:
+            row = self._other_rows.pop(isbn)
+        else:
+            keys = self._slot_keys
+            for slot in self._probe(packed):
+                if keys[slot] == packed:
+                    row = self._slot_rows[slot]
+                    keys[slot] = _DELETED
+                    break
+                if keys[slot] == _EMPTY:
+                    raise KeyError(isbn)
+        self._live_bits[row >> 3] &= ~(1 << (row & 7)) & 0xFF
+        self._count -= 1
+        if self.status(row) == BookStatus.CHECKED_OUT:
+            self.checked_out -= 1
+
+    def __iter__(self) -> Iterator[str]:
+        for row in self.rows():
+            yield self.isbn(row)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({len(self)} books)"
+
+class TableTrigramIndex(TrigramIndex):
+    """
+    A TrigramIndex whose document ids are the rows of a BookTable.
+
+    Rows only grow between compactions of the table, like the ids of
+    TrigramIndex, so the index keeps no ISBNs or fields of its own:
+    candidates are verified against the table's columns, removed books are
+    the table's dead rows, and matching rows are resolved back to ISBNs
+    through the table. Books must be in the table when they are added to the
+    index and leave the table before they are removed from it. The table and
+    the index are compacted together, by ColumnarLibrary.
+    """
+
+    def __init__(self, table: BookTable):
+        """
+        Initializes an empty index.
+
+        Args:
+            table (BookTable): The table holding the indexed books.
+        """
+        super().__init__()
+        self._table = table
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, isbn) -> bool:
+        return isbn in self._table
+
+    def add(self, isbn: str, *fields: str) -> None:
+        self.add_many([(isbn, *fields)])
+
+    def add_many(self, entries: Iterable[Sequence]) -> None:
+        row_of, post = self._table._row, self._post
+        for isbn, *fields in entries:
+            row = row_of(isbn)
+            if row < 0:
+                raise KeyError(isbn)
+            post(row, tuple(map(str.lower, fields)))
+            self._count += 1
+
+    def remove_many(self, isbns: Iterable[str]) -> None:
+        # The table has already marked the rows as removed
+        for _ in isbns:
+            self._count -= 1
+            self._dead += 1
+
+    def compact(self) -> None:
+        """
+        Rebuilds the posting lists from the table's live rows, e.g. after the table compacts.
+        """
+        self._postings = {}
+        self._dead = 0
+        for row in self._table.rows():
+            self._post(row, self._lowered(row))
+
+    def _lowered(self, row: int) -> Optional[Tuple[str, ...]]:
+        table = self._table
+        if not table.live(row):
+            return None
+        return table.title(row).lower(), table.author(row).lower()
+
+    def search(self, term: str) -> List[str]:
+        term = term.lower()
+        table = self._table
+        if len(term) < 3:
+            rows: Iterable[int] = table.rows()
+        else:
+            rows = self._candidates(term)
+        results = []
+        for row in rows:
+            fields = self._lowered(row)
+            if fields is not None and any(term in field for field in fields):
+                results.append(table.isbn(row))
+        return results
+
+class TableIndexes:
+    """
+    The status and author indexes of a ColumnarLibrary, read from its BookTable.
+
+    The status of every book is already a bit in the table, and the table
+    counts the checked-out books as their bits change, so counting by status
+    reads that count and listing scans the bits a byte at a time. For authors the index keeps the
+    rows of each of the table's author ids, 4 bytes per book, plus the ids
+    of every normalized name. Removed rows are skipped when read until the
+    table compacts. Nothing is stored per ISBN.
+    """
+
+    def __init__(self, table: BookTable):
+        """
+        Initializes the indexes of an empty table.
+
+        Args:
+            table (BookTable): The table holding the books.
+        """
+        self._table = table
+        # Indexed by author id
+        self._author_rows: List[array] = []
+        self._author_ids: Dict[str, List[int]] = {}
+
+    def add(self, isbn: str, author: str, status: BookStatus) -> None:
+        table = self._table
+        row = table._row(isbn)
+        author_id = table._author_column[row]
+        # Authors new to the table get their row lists in id order
+        for new_id in range(len(self._author_rows), author_id + 1):
+            self._author_ids.setdefault(normalize_author(table._authors[new_id]), []).append(new_id)
+            self._author_rows.append(array("I"))
+        self._author_rows[author_id].append(row)
+
+    def remove(self, isbn: str, author: str, status: BookStatus) -> None:
+        # The table has already cleared the row's liveness bit
+        pass
+
+    def move(self, isbn: str, old: BookStatus, new: BookStatus) -> None:
+        # Setting the status sets the table's bit, which is the index
+        pass
+
+    def compact(self) -> None:
+        """
+        Rebuilds the author rows after the table compacts.
+        """
+        author_rows = [array("I") for _ in self._author_rows]
+        for row, author_id in enumerate(self._table._author_column):
+            author_rows[author_id].append(row)
+        self._author_rows = author_rows
+
+    def count(self, status: BookStatus) -> int:
+        table = self._table
+        return table.checked_out if status == BookStatus.CHECKED_OUT else len(table) - table.checked_out
+
+    def rows_with_status(self, status: BookStatus) -> List[int]:
+        """
+        Returns the rows of the books with a status, in insertion order.
+        """
+        table = self._table
+        status_bits = int.from_bytes(table._status_bits, "little")
+        live_bits = int.from_bytes(table._live_bits, "little")
+        bits = (status_bits if status == BookStatus.CHECKED_OUT else ~status_bits) & live_bits
+        data = bits.to_bytes(len(table._live_bits), "little")
+        rows = []
+        # Only the bytes with a matching row are visited, found by the regex engine
+        for match in _NONZERO_BYTE.finditer(data):
+            position = match.start()
+            byte = data[position]
+            while byte:
+                lowest = byte & -byte
+                rows.append(position * 8 + lowest.bit_length() - 1)
+                byte ^= lowest
+        return rows
+
+    def rows_by_author(self, author: str) -> List[int]:
+        """
+        Returns the rows of an author's books, in insertion order.
+        """
+        author_ids = self._author_ids.get(normalize_author(author), ())
+        rows: Iterable[int] = self._author_rows[author_ids[0]] if len(author_ids) == 1 else sorted(
+            row for author_id in author_ids for row in self._author_rows[author_id]
+        )
+        live = self._table.live
+        return [row for row in rows if live(row)]
+
+    def with_status(self, status: BookStatus) -> List[str]:
+        return [self._table.isbn(row) for row in self.rows_with_status(status)]
+
+    def by_author(self, author: str) -> List[str]:
+        return [self._table.isbn(row) for row in self.rows_by_author(author)]
+
+    def check(self, books: Mapping[str, Book]) -> List[str]:
+        """
+        Compares the indexes with the books, as SecondaryIndexes.check does.
+
+        The status listings are the books' own bits, so for statuses only the
+        counts are checked, against a recount of the books.
+        """
+        problems = []
+        recount = {status: 0 for status in BookStatus}
+        for book in books.values():
+            recount[book.status] += 1
+        for status in BookStatus:
+            counted = self.count(status)
+            if counted != recount[status]:
+                problems.append(f"The status index counts {counted} books as {status.value!r}, but {recount[status]} are.")
+        indexed = SecondaryIndexes()
+        for isbn, book in books.items():
+            indexed._by_status[book.status][isbn] = None
+        for key in self._author_ids:
+            isbns = self.by_author(key)
+            if isbns:
+                indexed._by_author[key] = dict.fromkeys(isbns)
+        return problems + indexed.check(books)
+
+class ColumnarLibrary(Library):
+    """
+    A Library that keeps its books in a BookTable instead of an OrderedDict of Book objects.
+
+    The public API is the same. `books[isbn]` and searches return BookView
+    objects; setting a view's status changes the stored book. Books passed to
+    `add_book` are copied into the table, so changing them afterwards does
+    not change the library. `books_by_status` lists books in the order they
+    were added. Once removed rows reach COMPACT_MIN_DEAD and outnumber the
+    books, removing books compacts the table and rebuilds the indexes over
+    its new rows.
+    """
+
+    def __init__(self, search_cache_size: int = SEARCH_CACHE_SIZE, **kwargs):
+        """
+        Initializes an empty library.
+
+        Args:
+            search_cache_size (int): Maximum number of cached searches; 0 disables caching.
+            **kwargs: `logger` and `on_event`, as for Library.
+        """
+        super().__init__(search_cache_size, **kwargs)
+        self.books: BookTable = BookTable()
+        self._index = TableTrigramIndex(self.books)
+        self._secondary: TableIndexes = TableIndexes(self.books)
+
+    def books_by_status(self, status: BookStatus) -> List[Book]:
+        """
+        Lists the books with a status, e.g. the available ones.
+
+        Args:
+            status (BookStatus): The status to list.
+
+        Returns:
+            List[Book]: The books with that status, in the order they were added.
+        """
+        return [self.books.view(row) for row in self._secondary.rows_with_status(status)]
+
+    def books_by_author(self, author: str) -> List[Book]:
+        """
+        Lists an author's books.
+
+        Args:
+            author (str): The author's name; case and repeated spaces are ignored.
+
+        Returns:
+            List[Book]: The author's books, in the order they were added.
+        """
+        return [self.books.view(row) for row in self._secondary.rows_by_author(author)]
+
+    def remove_book(self, isbn: str) -> None:
+        super().remove_book(isbn)
+        self._compact_if_needed()
+
+    def remove_books(self, isbns: Iterable[str], atomic: bool = True) -> BulkResult:
+        result = super().remove_books(isbns, atomic)
+        self._compact_if_needed()
+        return result
+
+    def compact(self) -> None:
+        """
+        Drops the removed rows from the table and rebuilds the indexes over the new rows.
+        """
+        self.books.compact()
+        self._index.compact()
+        self._secondary.compact()
+
+    def _compact_if_needed(self) -> None:
+        # After the events are emitted, so listeners see the removed books in place
+        removed = self.books.removed_rows
+        if removed >= COMPACT_MIN_DEAD and removed > len(self.books):
+            self.compact()
@@ -0,0 +1,233 @@
+# Concurrent Library Management System
+# A thread-safe Library with per-ISBN lock striping, and an asyncio facade for it.
+
+import asyncio
+import threading
+from concurrent.futures import Executor
+from contextlib import ExitStack, contextmanager
+from functools import partial
+from typing import Iterable, Iterator, List, Optional
+
+from optimized_library_management import (
+    Book,
+    BookNotFoundError,
+    BookStatus,
+    BulkResult,
+    Library,
+    LibraryEvent,
+    SEARCH_CACHE_SIZE,
+    SearchCacheInfo,
+)
+
+# Number of locks that ISBNs are spread over; operations on ISBNs in different stripes run in parallel
+LOCK_STRIPES = 64
+
+class ConcurrentLibrary(Library):
+    """
+    A Library that can be used from many threads at once.
+
+    Each ISBN maps to one of a fixed number of locks. `borrow_book` and
+    `return_book` are compare-and-set operations under that lock: they
+    change the status only if it is the expected one, and return whether
+    they did, so two threads can never both borrow one book. Bulk status
+    changes take the locks of all their ISBNs, in a fixed order.
+
+    Adding and removing books take the locks of their ISBNs, so a book is
+    never borrowed before its status is indexed or while it is removed. As
+    they change the shared search index, they also take one library-wide
+    lock, as do searches, which read that index and update the search cache.
+    Looking books up, reading their status and counting books by status take
+    no lock at all; a single dict lookup, attribute read or `len` is atomic
+    in CPython.
+
+    Event callbacks may run while locks are held, so they must not change
+    the library.
+    """
+
+    def __init__(self, search_cache_size: int = SEARCH_CACHE_SIZE, stripes: int = LOCK_STRIPES, **kwargs):
+        """
+        Initializes an empty library.
+
+        Args:
+            search_cache_size (int): Maximum number of cached searches; 0 disables caching.
+            stripes (int): Number of per-ISBN locks.
+            **kwargs: `logger` and `on_event`, as for Library.
+        """
+        super().__init__(search_cache_size, **kwargs)
+        self._stripes = [threading.Lock() for _ in range(stripes)]
+        self._structure_lock = threading.Lock()
+
+    def _stripe(self, isbn: str) -> int:
+        return hash(isbn) % len(self._stripes)
+
+    @contextmanager
+    def _locked(self, isbns: Iterable[str]) -> Iterator[None]:
+        """
+        Holds the locks of several ISBNs, taken in stripe order so that threads cannot deadlock.
+        """
+        with ExitStack() as stack:
+            for stripe in sorted({self._stripe(isbn) for isbn in isbns}):
+                stack.enter_context(self._stripes[stripe])
+            yield
+
+    def add_book(self, book: Book) -> None:
+        # The stripe lock keeps a concurrent borrow from seeing the book before it is indexed
+        with self._structure_lock, self._stripes[self._stripe(book.isbn)]:
+            super().add_book(book)
+
+    def add_books(self, books: Iterable[Book], atomic: bool = True) -> BulkResult:
+        books = list(books)
+        with self._structure_lock, self._locked(book.isbn for book in books):
+            return super().add_books(books, atomic)
+
+    def remove_book(self, isbn: str) -> None:
+        # The stripe lock keeps a concurrent borrow from changing the book while it is removed
+        with self._structure_lock, self._stripes[self._stripe(isbn)]:
+            super().remove_book(isbn)
+
+    def remove_books(self, isbns: Iterable[str], atomic: bool = True) -> BulkResult:
+        isbns = list(isbns)
+        with self._structure_lock, self._locked(isbns):
+            return super().remove_books(isbns, atomic)
+
+    def search_books(self, search_term: str) -> List[Book]:
+        with self._structure_lock:
+            return super().search_books(search_term)
+
+    def search_cache_info(self) -> SearchCacheInfo:
+        with self._structure_lock:
+            return super().search_cache_info()
+
+    def clear_search_cache(self) -> None:
+        with self._structure_lock:
+            super().clear_search_cache()
+
+    def books_by_status(self, status: BookStatus) -> List[Book]:
+        # Copying a status group is atomic; the lock keeps its books from being removed meanwhile
+        with self._structure_lock:
+            return super().books_by_status(status)
+
+    def books_by_author(self, author: str) -> List[Book]:
+        with self._structure_lock:
+            return super().books_by_author(author)
+
+    def check_indexes(self) -> List[str]:
+        with self._structure_lock, self._locked(self.books):
+            return super().check_indexes()
+
+    def borrow_book(self, isbn: str) -> bool:
+        """
+        Marks a book as borrowed (checked out) if it is available.
+
+        Args:
+            isbn (str): The ISBN of the book to borrow.
+
+        Returns:
+            bool: True if this call borrowed the book, False if it was already checked out.
+
+        Raises:
+            BookNotFoundError: If the book with the given ISBN is not found in the library.
+        """
+        return self._compare_and_set(isbn, BookStatus.AVAILABLE, BookStatus.CHECKED_OUT)
+
+    def return_book(self, isbn: str) -> bool:
+        """
+        Marks a book as returned (available) if it is checked out.
+
+        Args:
+            isbn (str): The ISBN of the book to return.
+
+        Returns:
+            bool: True if this call returned the book, False if it was not checked out.
+
+        Raises:
+            BookNotFoundError: If the book with the given ISBN is not found in the library.
+        """
+        return self._compare_and_set(isbn, BookStatus.CHECKED_OUT, BookStatus.AVAILABLE)
+
+    def borrow_many(self, isbns: Iterable[str], atomic: bool = True) -> BulkResult:
+        isbns = list(isbns)
+        with self._locked(isbns):
+            return super().borrow_many(isbns, atomic)
+
+    def return_many(self, isbns: Iterable[str], atomic: bool = True) -> BulkResult:
+        isbns = list(isbns)
+        with self._locked(isbns):
+            return super().return_many(isbns, atomic)
+
+    def _compare_and_set(self, isbn: str, expected: BookStatus, status: BookStatus) -> bool:
+        """
+        Changes a book's status if it is `expected`, under the book's lock.
+
+        Returns:
+            bool: Whether the status was changed.
+
+        Raises:
+            BookNotFoundError: If the book is not in the library.
+        """
+        book = self._get_book(isbn)
+        with self._stripes[self._stripe(isbn)]:
+            # The book may have been removed, or replaced, since it was looked up
+            if self.books.get(isbn) is not book:
+                raise BookNotFoundError(f"Book with ISBN {isbn} not found in the library.")
+            changed = book.status == expected
+            if changed:
+                self._set_status(book, status)
+        if changed:
+            self._emit(LibraryEvent.BORROWED if status == BookStatus.CHECKED_OUT else LibraryEvent.RETURNED, [book])
+        else:
+            self._emit(LibraryEvent.NOT_AVAILABLE if expected == BookStatus.AVAILABLE else LibraryEvent.NOT_CHECKED_OUT, [book])
+        return changed
+
+class AsyncLibrary:
+    """
+    An asyncio interface to a ConcurrentLibrary.
+
+    Every call runs in an executor thread, so a search or a contended lock
+    never blocks the event loop.
+    """
+
+    def __init__(self, library: Optional[ConcurrentLibrary] = None, executor: Optional[Executor] = None):
+        """
+        Wraps a library.
+
+        Args:
+            library (ConcurrentLibrary, optional): The library to use; a new empty one by default.
+            executor (Executor, optional): Where calls run; the event loop's default executor by default.
+        """
+        self.library = library if library is not None else ConcurrentLibrary()
+        self.executor = executor
+
+    async def _run(self, method, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(method, *args))
+
+    async def get_book(self, isbn: str) -> Book:
+        return await self._run(self.library._get_book, isbn)
+
+    async def add_book(self, book: Book) -> None:
+        await self._run(self.library.add_book, book)
+
+    async def add_books(self, books: Iterable[Book], atomic: bool = True) -> BulkResult:
+        return await self._run(self.library.add_books, list(books), atomic)
+
+    async def remove_book(self, isbn: str) -> None:
+        await self._run(self.library.remove_book, isbn)
+
+    async def remove_books(self, isbns: Iterable[str], atomic: bool = True) -> BulkResult:
+        return await self._run(self.library.remove_books, list(isbns), atomic)
+
+    async def search_books(self, search_term: str) -> List[Book]:
+        return await self._run(self.library.search_books, search_term)
+
+    async def borrow_book(self, isbn: str) -> bool:
+        return await self._run(self.library.borrow_book, isbn)
+
+    async def return_book(self, isbn: str) -> bool:
+        return await self._run(self.library.return_book, isbn)
+
+    async def borrow_many(self, isbns: Iterable[str], atomic: bool = True) -> BulkResult:
+        return await self._run(self.library.borrow_many, list(isbns), atomic)
+
+    async def return_many(self, isbns: Iterable[str], atomic: bool = True) -> BulkResult:
+        return await self._run(self.library.return_many, list(isbns), atomic)
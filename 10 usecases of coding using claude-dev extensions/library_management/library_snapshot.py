@@ -0,0 +1,479 @@
+# Library Snapshots
+# A memory-mapped binary file format for saving a Library and opening it again without re-adding every book.
+
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections.abc import MutableMapping
+from typing import Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Set, Tuple
+from zlib import crc32
+
+from optimized_library_management import Book, BookStatus, SecondaryIndexes
+from trigram_index import TrigramIndex
+
+MAGIC = b"LIBSNAP\0"
+VERSION = 1
+# Magic, version, book count, hash table slots, size of the records section, CRC-32 of everything after the checksum
+HEADER = struct.Struct("<8sIQQQI")
+# Status (0 available, 1 checked out) and the UTF-8 lengths of the ISBN, title and author that follow
+RECORD = struct.Struct("<BHII")
+# Row + 1 in each hash table slot; 0 marks an empty slot
+_EMPTY = 0
+
+Record = Tuple[bytes, bytes]
+
+class SnapshotError(Exception):
+    """
+    Custom exception raised when a snapshot file is not a valid snapshot.
+    """
+    pass
+
+def encode_book(book: Book) -> Record:
+    """
+    Encodes a book as a snapshot record.
+
+    Args:
+        book (Book): The book to encode.
+
+    Returns:
+        Tuple[bytes, bytes]: The UTF-8 ISBN, used for the hash table, and the record.
+    """
+    isbn, title, author = book.isbn.encode("utf-8"), book.title.encode("utf-8"), book.author.encode("utf-8")
+    status = 1 if book.status == BookStatus.CHECKED_OUT else 0
+    return isbn, RECORD.pack(status, len(isbn), len(title), len(author)) + isbn + title + author
+
+def _little_endian(values: array) -> bytes:
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+def write_snapshot(path: str, records: Iterable[Record]) -> None:
+    """
+    Writes encoded books to a snapshot file.
+
+    The file is written next to `path` and renamed over it once complete, so
+    a crash leaves either the old snapshot or the new one. Books that are
+    memory-mapped from the old file stay readable.
+
+    Layout, all integers little-endian:
+
+    - HEADER.
+    - The offset of every record in the records section, plus its end (u64).
+    - The ISBN hash table: a power of two of u32 slots, at most half full,
+      probed linearly from the CRC-32 of the UTF-8 ISBN. Padded to 8 bytes.
+    - The records, in insertion order.
+
+    Args:
+        path (str): The snapshot file.
+        records (Iterable[Tuple[bytes, bytes]]): `encode_book` results, with unique ISBNs.
+    """
+    offsets = array("Q", [0])
+    hashes = array("I")
+    data = bytearray()
+    for isbn, record in records:
+        hashes.append(crc32(isbn))
+        data += record
+        offsets.append(len(data))
+    count = len(hashes)
+    capacity = 8
+    while capacity < count * 2:
+        capacity *= 2
+    mask = capacity - 1
+    slots = array("I", [_EMPTY]) * capacity
+    for row, key in enumerate(hashes):
+        slot = key & mask
+        while slots[slot] != _EMPTY:
+            slot = (slot + 1) & mask
+        slots[slot] = row + 1
+    sections = [_little_endian(offsets), _little_endian(slots), bytes(-len(slots) * 4 % 8), data]
+    prefix = HEADER.pack(MAGIC, VERSION, count, capacity, len(data), 0)[:-4]
+    checksum = crc32(prefix)
+    for section in sections:
+        checksum = crc32(section, checksum)
+
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, count, capacity, len(data), checksum))
+        for section in sections:
+            file.write(section)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+class SnapshotFile:
+    """
+    A read-only, memory-mapped snapshot.
+
+    Opening reads the header and, if asked, verifies the checksum; records
+    are only decoded when a row is read. Finding an ISBN probes the on-disk
+    hash table and compares ISBN bytes in the mapped records.
+    """
+
+    def __init__(self, path: str, verify: bool = True):
+        """
+        Maps a snapshot file.
+
+        Args:
+            path (str): The snapshot file.
+            verify (bool): Whether to check the CRC-32 of the whole file, which reads all of it.
+
+        Raises:
+            SnapshotError: If the file is not a snapshot, has another version, is truncated or fails the checksum.
+        """
+        self.path = path
+        with open(path, "rb") as file:
+            try:
+                self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise SnapshotError(f"{path} is empty.") from None
+        try:
+            self._load(verify)
+        except BaseException:
+            self.close()
+            raise
+
+    def _load(self, verify: bool) -> None:
+        mapped = self._map
+        if len(mapped) < HEADER.size:
+            raise SnapshotError(f"{self.path} is not a library snapshot.")
+        magic, version, count, capacity, data_size, checksum = HEADER.unpack_from(mapped)
+        if magic != MAGIC:
+            raise SnapshotError(f"{self.path} is not a library snapshot.")
+        if version != VERSION:
+            raise SnapshotError(f"{self.path} has snapshot version {version}; this module reads version {VERSION}.")
+        offsets_at = HEADER.size
+        slots_at = offsets_at + (count + 1) * 8
+        self._records_at = slots_at + capacity * 4 + (-capacity * 4 % 8)
+        if len(mapped) != self._records_at + data_size:
+            raise SnapshotError(f"{self.path} is truncated or has trailing data.")
+        if verify:
+            with memoryview(mapped) as view, view[HEADER.size:] as body:
+                if crc32(body, crc32(view[:HEADER.size - 4])) != checksum:
+                    raise SnapshotError(f"{self.path} failed its checksum.")
+        self.count = count
+        self._views: List[memoryview] = []
+        self._offsets = self._array(offsets_at, slots_at, "Q")
+        self._slots = self._array(slots_at, slots_at + capacity * 4, "I")
+
+    def _array(self, start: int, end: int, typecode: str):
+        """
+        Returns a section of the file as a sequence of integers, without copying on little-endian machines.
+        """
+        if sys.byteorder != "little":
+            values = array(typecode, self._map[start:end])
+            values.byteswap()
+            return values
+        view = memoryview(self._map)
+        self._views.append(view)
+        section = view[start:end]
+        self._views.append(section)
+        values = section.cast(typecode)
+        self._views.append(values)
+        return values
+
+    def close(self) -> None:
+        """
+        Unmaps the file. Rows can no longer be read afterwards.
+        """
+        for view in reversed(getattr(self, "_views", ())):
+            view.release()
+        self._views = []
+        self._map.close()
+
+    def find(self, isbn: str) -> int:
+        """
+        Returns the row of an ISBN, or -1 if the snapshot does not contain it.
+        """
+        key = isbn.encode("utf-8")
+        slots, offsets, mapped, base = self._slots, self._offsets, self._map, self._records_at
+        mask = len(slots) - 1
+        slot = crc32(key) & mask
+        while True:
+            row = slots[slot]
+            if row == _EMPTY:
+                return -1
+            row -= 1
+            start = base + offsets[row] + RECORD.size
+            if mapped[start:start + len(key)] == key and RECORD.unpack_from(mapped, start - RECORD.size)[1] == len(key):
+                return row
+            slot = (slot + 1) & mask
+
+    def record(self, row: int) -> bytes:
+        """
+        Returns the encoded record of a row.
+        """
+        return self._map[self._records_at + self._offsets[row]:self._records_at + self._offsets[row + 1]]
+
+    def isbn(self, row: int) -> str:
+        start = self._records_at + self._offsets[row]
+        isbn_length = RECORD.unpack_from(self._map, start)[1]
+        start += RECORD.size
+        return self._map[start:start + isbn_length].decode("utf-8")
+
+    def fields(self, row: int) -> Tuple[str, str, str, BookStatus]:
+        """
+        Decodes a row into its ISBN, title, author and status.
+        """
+        start = self._records_at + self._offsets[row]
+        status, isbn_length, title_length, author_length = RECORD.unpack_from(self._map, start)
+        start += RECORD.size
+        text = self._map[start:start + isbn_length + title_length + author_length]
+        return (
+            text[:isbn_length].decode("utf-8"),
+            text[isbn_length:isbn_length + title_length].decode("utf-8"),
+            text[isbn_length + title_length:].decode("utf-8"),
+            BookStatus.CHECKED_OUT if status else BookStatus.AVAILABLE,
+        )
+
+class SnapshotBooks(MutableMapping):
+    """
+    A mapping of ISBN to Book read from a snapshot, with changes kept in memory.
+
+    A book is decoded the first time it is looked up, and the Book object is
+    kept so that changes to its status stick. Books added after opening,
+    and the ISBNs of removed ones, are kept in an overlay. `compact` writes
+    the current books back to the snapshot file and maps it again.
+    Iteration follows insertion order: the snapshot's books, then the
+    added ones.
+    """
+
+    def __init__(self, path: str, verify: bool = True):
+        """
+        Opens a snapshot.
+
+        Args:
+            path (str): The snapshot file.
+            verify (bool): Whether to check the file's checksum.
+        """
+        self.snapshot = SnapshotFile(path, verify)
+        # Books of the snapshot that have been looked up
+        self._loaded: Dict[str, Book] = {}
+        # Books added since the snapshot was written, and snapshot books removed since
+        self._added: Dict[str, Book] = {}
+        self._removed: Set[str] = set()
+
+    @property
+    def path(self) -> str:
+        return self.snapshot.path
+
+    def _in_snapshot(self, isbn: str) -> bool:
+        return isbn not in self._removed and (isbn in self._loaded or self.snapshot.find(isbn) >= 0)
+
+    def __len__(self) -> int:
+        return self.snapshot.count - len(self._removed) + len(self._added)
+
+    def __contains__(self, isbn) -> bool:
+        return isinstance(isbn, str) and (isbn in self._added or self._in_snapshot(isbn))
+
+    def __getitem__(self, isbn: str) -> Book:
+        book = self._added.get(isbn) or self._loaded.get(isbn)
+        if book is not None:
+            return book
+        row = self.snapshot.find(isbn) if isinstance(isbn, str) and isbn not in self._removed else -1
+        if row < 0:
+            raise KeyError(isbn)
+        _, title, author, status = self.snapshot.fields(row)
+        book = self._loaded[isbn] = Book(title, author, isbn, status)
+        return book
+
+    def __setitem__(self, isbn: str, book: Book) -> None:
+        if isbn != book.isbn:
+            raise ValueError(f"Book with ISBN {book.isbn} stored under ISBN {isbn}.")
+        if isbn not in self._added and self._in_snapshot(isbn):
+            self._loaded[isbn] = book
+        else:
+            self._added[isbn] = book
+
+    def __delitem__(self, isbn: str) -> None:
+        if isbn in self._added:
+            del self._added[isbn]
+        elif isinstance(isbn, str) and self._in_snapshot(isbn):
+            self._loaded.pop(isbn, None)
+            self._removed.add(isbn)
+        else:
+            raise KeyError(isbn)
+
+    def __iter__(self) -> Iterator[str]:
+        removed, isbn = self._removed, self.snapshot.isbn
+        for row in range(self.snapshot.count):
+            key = isbn(row)
+            if key not in removed:
+                yield key
+        yield from list(self._added)
+
+    def entries(self) -> Iterator[Tuple[str, str, str, BookStatus]]:
+        """
+        Yields the ISBN, title, author and status of every book, without keeping decoded Books.
+        """
+        removed, loaded, fields = self._removed, self._loaded, self.snapshot.fields
+        for row in range(self.snapshot.count):
+            entry = fields(row)
+            if entry[0] in removed:
+                continue
+            book = loaded.get(entry[0])
+            yield entry if book is None else (book.isbn, book.title, book.author, book.status)
+        for book in list(self._added.values()):
+            yield book.isbn, book.title, book.author, book.status
+
+    def records(self) -> Iterator[Record]:
+        """
+        Yields every book encoded for a snapshot, copying the records of unchanged books as they are.
+        """
+        removed, loaded, snapshot = self._removed, self._loaded, self.snapshot
+        for row in range(snapshot.count):
+            isbn = snapshot.isbn(row)
+            if isbn in removed:
+                continue
+            book = loaded.get(isbn)
+            yield (isbn.encode("utf-8"), snapshot.record(row)) if book is None else encode_book(book)
+        for book in list(self._added.values()):
+            yield encode_book(book)
+
+    def compact(self) -> None:
+        """
+        Writes the current books to the snapshot file, maps it again and empties the overlay.
+
+        Books that were looked up stay loaded, so Book objects held by callers
+        keep reflecting the library.
+        """
+        write_snapshot(self.path, self.records())
+        snapshot = SnapshotFile(self.path, verify=False)
+        self.snapshot.close()
+        self.snapshot = snapshot
+        self._loaded.update(self._added)
+        self._added.clear()
+        self._removed.clear()
+
+    def close(self) -> None:
+        """
+        Unmaps the snapshot file.
+        """
+        self.snapshot.close()
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.path!r}, {len(self)} books)"
+
+class DeferredIndex:
+    """
+    A TrigramIndex that is only built when the first search needs it.
+
+    Until then, changes are ignored, because the index is built from the
+    library's books as they are at that time. This keeps opening a
+    snapshot from reading every title and author.
+    """
+
+    def __init__(self, entries: Callable[[], Iterable[Tuple[str, str, str, BookStatus]]]):
+        """
+        Initializes an index that is not built yet.
+
+        Args:
+            entries (Callable[[], Iterable[Tuple[str, str, str, BookStatus]]]):
+                Returns the current ISBN, title, author and status of every book.
+        """
+        self._entries = entries
+        self._index: Optional[TrigramIndex] = None
+
+    @property
+    def built(self) -> bool:
+        return self._index is not None
+
+    def add(self, key: str, *fields: str) -> None:
+        if self._index is not None:
+            self._index.add(key, *fields)
+
+    def add_many(self, entries: Iterable[Tuple[str, ...]]) -> None:
+        if self._index is not None:
+            self._index.add_many(entries)
+
+    def remove(self, key: str) -> None:
+        if self._index is not None:
+            self._index.remove(key)
+
+    def remove_many(self, keys: Iterable[str]) -> None:
+        if self._index is not None:
+            self._index.remove_many(keys)
+
+    def search(self, term: str) -> List[str]:
+        if self._index is None:
+            index = TrigramIndex()
+            index.add_many((isbn, title, author) for isbn, title, author, _ in self._entries())
+            self._index = index
+        return self._index.search(term)
+
+class DeferredSecondaryIndexes(SecondaryIndexes):
+    """
+    SecondaryIndexes that are only built when the first query needs them.
+
+    Like DeferredIndex, changes are ignored until then, because the indexes
+    are built from the library's books as they are at that time.
+    """
+
+    def __init__(self, entries: Callable[[], Iterable[Tuple[str, str, str, BookStatus]]]):
+        """
+        Initializes indexes that are not built yet.
+
+        Args:
+            entries (Callable[[], Iterable[Tuple[str, str, str, BookStatus]]]):
+                Returns the current ISBN, title, author and status of every book.
+        """
+        super().__init__()
+        self._entries: Optional[Callable[[], Iterable[Tuple[str, str, str, BookStatus]]]] = entries
+
+    @property
+    def built(self) -> bool:
+        return self._entries is None
+
+    def _build(self) -> None:
+        if self._entries is not None:
+            entries, self._entries = self._entries, None
+            for isbn, _, author, status in entries():
+                super().add(isbn, author, status)
+
+    def add(self, isbn: str, author: str, status: BookStatus) -> None:
+        if self.built:
+            super().add(isbn, author, status)
+
+    def remove(self, isbn: str, author: str, status: BookStatus) -> None:
+        if self.built:
+            super().remove(isbn, author, status)
+
+    def move(self, isbn: str, old: BookStatus, new: BookStatus) -> None:
+        if self.built:
+            super().move(isbn, old, new)
+
+    def count(self, status: BookStatus) -> int:
+        self._build()
+        return super().count(status)
+
+    def with_status(self, status: BookStatus) -> List[str]:
+        self._build()
+        return super().with_status(status)
+
+    def by_author(self, author: str) -> List[str]:
+        self._build()
+        return super().by_author(author)
+
+    def check(self, books: Mapping[str, Book]) -> List[str]:
+        self._build()
+        return super().check(books)
+
+def save_snapshot(books: Mapping[str, Book], path: str) -> None:
+    """
+    Writes a library's books to a snapshot file.
+
+    Saving snapshot-backed books to their own file compacts them.
+
+    Args:
+        books (Mapping[str, Book]): The library's books, by ISBN.
+        path (str): The snapshot file.
+    """
+    if isinstance(books, SnapshotBooks):
+        if os.path.realpath(path) == os.path.realpath(books.path):
+            books.compact()
+        else:
+            write_snapshot(path, books.records())
+    else:
+        write_snapshot(path, (encode_book(book) for book in books.values()))
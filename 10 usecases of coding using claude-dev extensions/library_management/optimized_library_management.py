@@ -1,11 +1,18 @@
 # Library Management System
 # This module implements a simple library management system with classes for books and library operations.
 
-from dataclasses import dataclass
+import logging
+from dataclasses import dataclass, fields
 from enum import Enum
-from typing import Dict, List, Optional
+from typing import Callable, Dict, Iterable, List, Mapping, NamedTuple, Optional, Tuple
 from collections import OrderedDict
-from functools import lru_cache
+
+from trigram_index import TrigramIndex
+
+# Default number of search results each Library keeps
+SEARCH_CACHE_SIZE = 100
+# Batches larger than this clear the search cache instead of checking every entry
+BULK_INVALIDATE_LIMIT = 1000
 
 class BookStatus(Enum):
     """
@@ -17,6 +24,30 @@ class BookStatus(Enum):
     AVAILABLE = "Available"
     CHECKED_OUT = "Checked out"
 
+def _slotted(cls):
+    """
+    Rebuilds a dataclass with `__slots__` for its fields.
+
+    Declaring `__slots__` next to a field with a default fails, because the
+    default is a class attribute with the same name as the slot. The generated
+    `__init__` already holds the defaults, so the class attributes can be
+    dropped. `@dataclass(slots=True, weakref_slot=True)` does this on Python 3.11+.
+
+    Args:
+        cls (type): A dataclass without `__slots__`.
+
+    Returns:
+        type: An equivalent dataclass whose instances have no `__dict__` but
+        can be weakly referenced.
+    """
+    names = tuple(field.name for field in fields(cls))
+    namespace = {key: value for key, value in cls.__dict__.items() if key not in names}
+    namespace.pop("__dict__", None)
+    namespace.pop("__weakref__", None)
+    namespace["__slots__"] = names + ("__weakref__",)
+    return type(cls)(cls.__name__, cls.__bases__, namespace)
+
+@_slotted
 @dataclass
 class Book:
     """
@@ -28,7 +59,6 @@ class Book:
         isbn (str): The ISBN (International Standard Book Number) of the book.
         status (BookStatus): The current status of the book (default is AVAILABLE).
     """
-    __slots__ = ['title', 'author', 'isbn', 'status']
     title: str
     author: str
     isbn: str
@@ -55,16 +85,262 @@ class BookAlreadyExistsError(Exception):
     """
     pass
 
+class BookNotAvailableError(Exception):
+    """
+    Custom exception raised by bulk borrowing when a book is already checked out.
+    """
+    pass
+
+class BookNotCheckedOutError(Exception):
+    """
+    Custom exception raised by bulk returning when a book is not checked out.
+    """
+    pass
+
+class LibraryEvent(Enum):
+    """
+    Enum of the changes a library reports to its event callback and logger.
+    """
+    ADDED = "added"
+    REMOVED = "removed"
+    BORROWED = "borrowed"
+    RETURNED = "returned"
+    NOT_AVAILABLE = "not available"
+    NOT_CHECKED_OUT = "not checked out"
+
+_EVENT_MESSAGES = {
+    LibraryEvent.ADDED: "Book '%s' added to the library.",
+    LibraryEvent.REMOVED: "Book '%s' removed from the library.",
+    LibraryEvent.BORROWED: "You have borrowed '%s'.",
+    LibraryEvent.RETURNED: "You have returned '%s'.",
+    LibraryEvent.NOT_AVAILABLE: "Book '%s' is not available.",
+    LibraryEvent.NOT_CHECKED_OUT: "Book '%s' was not checked out.",
+}
+
+EventCallback = Callable[[LibraryEvent, "Book"], None]
+
+class BulkResult(NamedTuple):
+    """
+    The outcome of a bulk operation.
+
+    Attributes:
+        succeeded (List[str]): The ISBNs the operation was applied to, in order.
+        failed (Dict[str, Exception]): The ISBNs that were skipped and why; always
+            empty for all-or-nothing operations, which raise instead.
+    """
+    succeeded: List[str]
+    failed: Dict[str, Exception]
+
+class SearchCacheInfo(NamedTuple):
+    """
+    Statistics of a SearchCache, like `functools.lru_cache`'s `cache_info()`.
+    """
+    hits: int
+    misses: int
+    invalidations: int
+    maxsize: int
+    currsize: int
+
+class SearchCache:
+    """
+    A bounded LRU cache of search results for one library.
+
+    Entries are keyed by the lowercased search term. When a book is added or
+    removed, only the entries whose term occurs in its title or author are
+    dropped, since those are exactly the searches whose results it changes.
+    Borrowing and returning do not change which books match a search, and the
+    cached lists hold the library's own Book objects, so they always show the
+    current status.
+    """
+
+    def __init__(self, maxsize: int = SEARCH_CACHE_SIZE):
+        """
+        Initializes an empty cache.
+
+        Args:
+            maxsize (int): Maximum number of cached searches; 0 disables caching.
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries: "OrderedDict[str, List[Book]]" = OrderedDict()
+
+    def get(self, term: str) -> Optional[List[Book]]:
+        """
+        Returns the cached results for a lowercased term, or None.
+        """
+        results = self._entries.get(term)
+        if results is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(term)
+        self.hits += 1
+        return results
+
+    def put(self, term: str, results: List[Book]) -> None:
+        """
+        Caches the results for a lowercased term, evicting the least recently used entry if full.
+        """
+        if self.maxsize <= 0:
+            return
+        self._entries[term] = results
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, books: List[Book]) -> None:
+        """
+        Drops the cached searches whose results change when books are added or removed.
+
+        Args:
+            books (List[Book]): The added or removed books.
+        """
+        if not self._entries or not books:
+            return
+        if len(books) > BULK_INVALIDATE_LIMIT:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            return
+        # One substring test per cached term; the separator keeps fields apart
+        text = "\0".join(field.lower() for book in books for field in (book.title, book.author))
+        stale = [term for term in self._entries if term in text]
+        for term in stale:
+            del self._entries[term]
+        self.invalidations += len(stale)
+
+    def clear(self) -> None:
+        """
+        Drops every cached search; the statistics are kept.
+        """
+        self._entries.clear()
+
+    def info(self) -> SearchCacheInfo:
+        """
+        Returns the cache statistics.
+        """
+        return SearchCacheInfo(self.hits, self.misses, self.invalidations, self.maxsize, len(self._entries))
+
+def normalize_author(author: str) -> str:
+    """
+    Returns the form of an author's name that author lookups compare: case-folded, with single spaces.
+    """
+    return " ".join(author.casefold().split())
+
+class SecondaryIndexes:
+    """
+    The ISBNs of a library's books grouped by status and by normalized author.
+
+    Each group is a dict used as an insertion-ordered set, so counting a
+    group is `len` and listing it takes time proportional to its size, not
+    to the size of the library. The Library updates the groups whenever it
+    adds, removes, borrows or returns a book; changing a Book's status
+    directly bypasses them.
+    """
+
+    def __init__(self):
+        """
+        Initializes empty indexes.
+        """
+        self._by_status: Dict[BookStatus, Dict[str, None]] = {status: {} for status in BookStatus}
+        self._by_author: Dict[str, Dict[str, None]] = {}
+
+    def add(self, isbn: str, author: str, status: BookStatus) -> None:
+        self._by_status[status][isbn] = None
+        self._by_author.setdefault(normalize_author(author), {})[isbn] = None
+
+    def remove(self, isbn: str, author: str, status: BookStatus) -> None:
+        del self._by_status[status][isbn]
+        key = normalize_author(author)
+        group = self._by_author[key]
+        del group[isbn]
+        if not group:
+            del self._by_author[key]
+
+    def move(self, isbn: str, old: BookStatus, new: BookStatus) -> None:
+        """
+        Records a book's status change.
+        """
+        if old != new:
+            del self._by_status[old][isbn]
+            self._by_status[new][isbn] = None
+
+    def count(self, status: BookStatus) -> int:
+        return len(self._by_status[status])
+
+    def with_status(self, status: BookStatus) -> List[str]:
+        """
+        Returns the ISBNs of the books with a status, in the order they got it.
+        """
+        return list(self._by_status[status])
+
+    def by_author(self, author: str) -> List[str]:
+        """
+        Returns the ISBNs of an author's books, in the order they were added.
+        """
+        return list(self._by_author.get(normalize_author(author), ()))
+
+    def check(self, books: Mapping[str, Book]) -> List[str]:
+        """
+        Compares the indexes with the books they should describe.
+
+        Args:
+            books (Mapping[str, Book]): The library's books, by ISBN.
+
+        Returns:
+            List[str]: A description of every difference; empty if the indexes are consistent.
+        """
+        expected = SecondaryIndexes()
+        for isbn, book in books.items():
+            expected.add(isbn, book.author, book.status)
+        problems = []
+        for kind, groups, expected_groups in (
+            ("status", self._by_status, expected._by_status),
+            ("author", self._by_author, expected._by_author),
+        ):
+            for key in sorted(groups.keys() | expected_groups.keys(), key=str):
+                indexed, actual = set(groups.get(key, ())), set(expected_groups.get(key, ()))
+                label = key.value if isinstance(key, BookStatus) else key
+                for isbn in sorted(actual - indexed):
+                    problems.append(f"Book with ISBN {isbn} is missing from the {kind} index under {label!r}.")
+                for isbn in sorted(indexed - actual):
+                    problems.append(f"Book with ISBN {isbn} is wrongly in the {kind} index under {label!r}.")
+        return problems
+
 class Library:
     """
     Represents a library and provides methods for managing books.
     """
 
-    def __init__(self):
+    def __init__(self, search_cache_size: int = SEARCH_CACHE_SIZE, logger: Optional[logging.Logger] = None, on_event: Optional[EventCallback] = None):
         """
-        Initializes an empty library with an OrderedDict to store books.
+        Initializes an empty library with an OrderedDict to store books,
+        a trigram index over their titles and authors and a cache of recent searches.
+
+        Changes are reported as INFO messages to the logger and, if given, to
+        `on_event(event, book)`; nothing is printed.
+
+        Args:
+            search_cache_size (int): Maximum number of cached searches; 0 disables caching.
+            logger (logging.Logger, optional): Logger for change messages; defaults to this module's logger.
+            on_event (Callable[[LibraryEvent, Book], None], optional): Called for every change.
         """
         self.books: OrderedDict[str, Book] = OrderedDict()
+        self._index = TrigramIndex()
+        self._secondary = SecondaryIndexes()
+        self._search_cache = SearchCache(search_cache_size)
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.on_event = on_event
+
+    def _emit(self, event: LibraryEvent, books: List[Book]) -> None:
+        """
+        Reports the same event for one or more books.
+        """
+        if self.on_event is not None:
+            for book in books:
+                self.on_event(event, book)
+        if self.logger.isEnabledFor(logging.INFO):
+            for book in books:
+                self.logger.info(_EVENT_MESSAGES[event], book.title)
 
     def add_book(self, book: Book) -> None:
         """
@@ -79,7 +355,46 @@ class Library:
         if book.isbn in self.books:
             raise BookAlreadyExistsError(f"Book with ISBN {book.isbn} already exists in the library.")
         self.books[book.isbn] = book
-        print(f"Book '{book.title}' added to the library.")
+        self._index.add(book.isbn, book.title, book.author)
+        self._secondary.add(book.isbn, book.author, book.status)
+        self._search_cache.invalidate([book])
+        self._emit(LibraryEvent.ADDED, [book])
+
+    def add_books(self, books: Iterable[Book], atomic: bool = True) -> BulkResult:
+        """
+        Adds several books, checking them all first and invalidating the search cache once.
+        
+        Args:
+            books (Iterable[Book]): The books to add.
+            atomic (bool): If True, add all of the books or none of them;
+                otherwise add the ones that can be and report the others.
+        
+        Returns:
+            BulkResult: The ISBNs added and, if not atomic, the ones skipped.
+        
+        Raises:
+            BookAlreadyExistsError: If atomic and an ISBN is already in the library
+                or appears twice in `books`. Nothing is added.
+        """
+        added: List[Book] = []
+        failed: Dict[str, Exception] = {}
+        seen = set()
+        for book in books:
+            if book.isbn in self.books or book.isbn in seen:
+                error = BookAlreadyExistsError(f"Book with ISBN {book.isbn} already exists in the library.")
+                if atomic:
+                    raise error
+                failed[book.isbn] = error
+                continue
+            seen.add(book.isbn)
+            added.append(book)
+        self.books.update((book.isbn, book) for book in added)
+        self._index.add_many((book.isbn, book.title, book.author) for book in added)
+        for book in added:
+            self._secondary.add(book.isbn, book.author, book.status)
+        self._search_cache.invalidate(added)
+        self._emit(LibraryEvent.ADDED, added)
+        return BulkResult([book.isbn for book in added], failed)
 
     def remove_book(self, isbn: str) -> None:
         """
@@ -93,24 +408,117 @@ class Library:
         """
         try:
             removed_book = self.books.pop(isbn)
-            print(f"Book '{removed_book.title}' removed from the library.")
         except KeyError:
             raise BookNotFoundError(f"Book with ISBN {isbn} not found in the library.")
+        self._index.remove(isbn)
+        self._secondary.remove(isbn, removed_book.author, removed_book.status)
+        self._search_cache.invalidate([removed_book])
+        self._emit(LibraryEvent.REMOVED, [removed_book])
+
+    def remove_books(self, isbns: Iterable[str], atomic: bool = True) -> BulkResult:
+        """
+        Removes several books, updating the search index and cache once.
+        
+        Args:
+            isbns (Iterable[str]): The ISBNs of the books to remove.
+            atomic (bool): If True, remove all of the books or none of them;
+                otherwise remove the ones that can be and report the others.
+        
+        Returns:
+            BulkResult: The ISBNs removed and, if not atomic, the ones skipped.
+        
+        Raises:
+            BookNotFoundError: If atomic and an ISBN is not in the library or
+                appears twice in `isbns`. Nothing is removed.
+        """
+        removed, failed = self._select(isbns, None, atomic)
+        for book in removed:
+            del self.books[book.isbn]
+            self._secondary.remove(book.isbn, book.author, book.status)
+        self._index.remove_many(book.isbn for book in removed)
+        self._search_cache.invalidate(removed)
+        self._emit(LibraryEvent.REMOVED, removed)
+        return BulkResult([book.isbn for book in removed], failed)
 
-    @lru_cache(maxsize=100)
     def search_books(self, search_term: str) -> List[Book]:
         """
         Searches for books in the library based on a search term.
+
+        Results of recent searches are cached, and repeating a search returns
+        the same list object; callers must not modify it.
         
         Args:
             search_term (str): The term to search for in book titles and authors.
         
         Returns:
-            List[Book]: A list of books matching the search term (case-insensitive).
+            List[Book]: The books whose title or author contains the search term
+            (case-insensitive), in the order they were added.
+        """
+        term = search_term.lower()
+        results = self._search_cache.get(term)
+        if results is None:
+            results = [self.books[isbn] for isbn in self._index.search(term)]
+            self._search_cache.put(term, results)
+        return results
+
+    def search_cache_info(self) -> SearchCacheInfo:
+        """
+        Returns hit, miss and invalidation counts and the size of the search cache.
+        
+        Returns:
+            SearchCacheInfo: The cache statistics.
+        """
+        return self._search_cache.info()
+
+    def clear_search_cache(self) -> None:
+        """
+        Drops all cached search results.
+        """
+        self._search_cache.clear()
+
+    def save_snapshot(self, path: str) -> None:
+        """
+        Saves the books to a snapshot file that `open_snapshot` can map without loading it.
+
+        The file is replaced atomically. If this library was opened from the
+        same file, saving compacts its in-memory changes into the file.
+        
+        Args:
+            path (str): The snapshot file.
+        """
+        # Imported here because library_snapshot builds on this module
+        from library_snapshot import save_snapshot
+        save_snapshot(self.books, path)
+
+    @classmethod
+    def open_snapshot(cls, path: str, verify: bool = True, **kwargs) -> "Library":
+        """
+        Opens a library saved with `save_snapshot`.
+
+        The file is memory-mapped and books are decoded when they are looked
+        up, through a hash index stored in the file, so opening takes about
+        the same time for any number of books. Changes are kept in memory
+        until the library is saved again. The search index is built on the
+        first search, and the status and author indexes on the first query
+        that needs them.
+        
+        Args:
+            path (str): The snapshot file.
+            verify (bool): Whether to check the file's checksum, which reads the whole file.
+            **kwargs: Passed to the constructor, e.g. `search_cache_size` or `logger`.
+        
+        Returns:
+            Library: The library, with `books` backed by the snapshot.
+        
+        Raises:
+            SnapshotError: If the file is not a valid snapshot.
         """
-        search_term = search_term.lower()
-        return [book for book in self.books.values() if 
-                search_term in {book.title.lower(), book.author.lower()}]
+        from library_snapshot import DeferredIndex, DeferredSecondaryIndexes, SnapshotBooks
+        library = cls(**kwargs)
+        library.books = SnapshotBooks(path, verify)
+        library._index = DeferredIndex(library.books.entries)
+        library._secondary = DeferredSecondaryIndexes(library.books.entries)
+        return library
 
     def display_search_results(self, results: List[Book]) -> None:
         """
@@ -138,10 +546,33 @@ class Library:
         """
         book = self._get_book(isbn)
         if book.status == BookStatus.AVAILABLE:
-            book.status = BookStatus.CHECKED_OUT
-            print(f"You have borrowed '{book.title}'.")
+            self._set_status(book, BookStatus.CHECKED_OUT)
+            self._emit(LibraryEvent.BORROWED, [book])
         else:
-            print(f"Book '{book.title}' is not available.")
+            self._emit(LibraryEvent.NOT_AVAILABLE, [book])
+
+    def borrow_many(self, isbns: Iterable[str], atomic: bool = True) -> BulkResult:
+        """
+        Marks several books as borrowed (checked out).
+        
+        Args:
+            isbns (Iterable[str]): The ISBNs of the books to borrow.
+            atomic (bool): If True, borrow all of the books or none of them;
+                otherwise borrow the ones that are available and report the others.
+        
+        Returns:
+            BulkResult: The ISBNs borrowed and, if not atomic, the ones skipped.
+        
+        Raises:
+            BookNotFoundError: If atomic and an ISBN is not in the library.
+            BookNotAvailableError: If atomic and a book is checked out or appears
+                twice in `isbns`. Nothing is borrowed.
+        """
+        borrowed, failed = self._select(isbns, BookStatus.AVAILABLE, atomic)
+        for book in borrowed:
+            self._set_status(book, BookStatus.CHECKED_OUT)
+        self._emit(LibraryEvent.BORROWED, borrowed)
+        return BulkResult([book.isbn for book in borrowed], failed)
 
     def return_book(self, isbn: str) -> None:
         """
@@ -155,10 +586,118 @@ class Library:
         """
         book = self._get_book(isbn)
         if book.status == BookStatus.CHECKED_OUT:
-            book.status = BookStatus.AVAILABLE
-            print(f"You have returned '{book.title}'.")
+            self._set_status(book, BookStatus.AVAILABLE)
+            self._emit(LibraryEvent.RETURNED, [book])
         else:
-            print(f"Book '{book.title}' was not checked out.")
+            self._emit(LibraryEvent.NOT_CHECKED_OUT, [book])
+
+    def return_many(self, isbns: Iterable[str], atomic: bool = True) -> BulkResult:
+        """
+        Marks several books as returned (available).
+        
+        Args:
+            isbns (Iterable[str]): The ISBNs of the books to return.
+            atomic (bool): If True, return all of the books or none of them;
+                otherwise return the ones that are checked out and report the others.
+        
+        Returns:
+            BulkResult: The ISBNs returned and, if not atomic, the ones skipped.
+        
+        Raises:
+            BookNotFoundError: If atomic and an ISBN is not in the library.
+            BookNotCheckedOutError: If atomic and a book is not checked out or
+                appears twice in `isbns`. Nothing is returned.
+        """
+        returned, failed = self._select(isbns, BookStatus.CHECKED_OUT, atomic)
+        for book in returned:
+            self._set_status(book, BookStatus.AVAILABLE)
+        self._emit(LibraryEvent.RETURNED, returned)
+        return BulkResult([book.isbn for book in returned], failed)
+
+    def count_by_status(self, status: BookStatus) -> int:
+        """
+        Counts the books with a status, without looking at the books.
+        
+        Args:
+            status (BookStatus): The status to count.
+        
+        Returns:
+            int: The number of books with that status.
+        """
+        return self._secondary.count(status)
+
+    def books_by_status(self, status: BookStatus) -> List[Book]:
+        """
+        Lists the books with a status, e.g. the available ones.
+        
+        Args:
+            status (BookStatus): The status to list.
+        
+        Returns:
+            List[Book]: The books with that status, in the order they got it.
+        """
+        return [self.books[isbn] for isbn in self._secondary.with_status(status)]
+
+    def books_by_author(self, author: str) -> List[Book]:
+        """
+        Lists an author's books.
+        
+        Args:
+            author (str): The author's name; case and repeated spaces are ignored.
+        
+        Returns:
+            List[Book]: The author's books, in the order they were added.
+        """
+        return [self.books[isbn] for isbn in self._secondary.by_author(author)]
+
+    def check_indexes(self) -> List[str]:
+        """
+        Checks the status and author indexes against the books, which reads every book.
+        
+        Returns:
+            List[str]: A description of every inconsistency; empty if there is none.
+        """
+        return self._secondary.check(self.books)
+
+    def _set_status(self, book: Book, status: BookStatus) -> None:
+        """
+        Changes a book's status and moves it to the matching status index.
+        """
+        self._secondary.move(book.isbn, book.status, status)
+        book.status = status
+
+    def _select(self, isbns: Iterable[str], status: Optional[BookStatus], atomic: bool) -> Tuple[List[Book], Dict[str, Exception]]:
+        """
+        Looks up the books of a bulk operation before anything is changed.
+        
+        Args:
+            isbns (Iterable[str]): The requested ISBNs.
+            status (BookStatus, optional): The status the books must have, if any.
+            atomic (bool): Whether to raise on the first book that cannot be used.
+        
+        Returns:
+            Tuple[List[Book], Dict[str, Exception]]: The usable books, in order,
+            and the errors of the others.
+        """
+        selected: List[Book] = []
+        failed: Dict[str, Exception] = {}
+        seen = set()
+        for isbn in isbns:
+            book = self.books.get(isbn)
+            if book is None or (status is None and isbn in seen):
+                error: Exception = BookNotFoundError(f"Book with ISBN {isbn} not found in the library.")
+            elif status == BookStatus.AVAILABLE and (book.status != status or isbn in seen):
+                error = BookNotAvailableError(f"Book with ISBN {isbn} is not available.")
+            elif status == BookStatus.CHECKED_OUT and (book.status != status or isbn in seen):
+                error = BookNotCheckedOutError(f"Book with ISBN {isbn} is not checked out.")
+            else:
+                seen.add(isbn)
+                selected.append(book)
+                continue
+            if atomic:
+                raise error
+            failed[isbn] = error
+        return selected, failed
 
     def _get_book(self, isbn: str) -> Book:
         """
@@ -182,6 +721,8 @@ def main():
     """
     Main function demonstrating the usage of the Library Management System.
     """
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
     # Create a new library instance
     library = Library()
 
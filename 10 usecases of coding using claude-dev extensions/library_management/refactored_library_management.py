@@ -2,6 +2,8 @@ from dataclasses import dataclass
 from enum import Enum
 from typing import Dict, List, Optional
 
+from trigram_index import TrigramIndex
+
 class BookStatus(Enum):
     AVAILABLE = "Available"
     CHECKED_OUT = "Checked out"
@@ -27,6 +29,7 @@ class BookAlreadyExistsError(Exception):
 class Library:
     def __init__(self):
         self.books: Dict[str, Book] = {}
+        self._index = TrigramIndex()
 
     def add_book(self, book: Book) -> None:
         """
@@ -41,6 +44,7 @@ class Library:
         if book.isbn in self.books:
             raise BookAlreadyExistsError(f"Book with ISBN {book.isbn} already exists in the library.")
         self.books[book.isbn] = book
+        self._index.add(book.isbn, book.title, book.author)
         print(f"Book '{book.title}' added to the library.")
 
     def remove_book(self, isbn: str) -> None:
@@ -56,6 +60,7 @@ class Library:
         if isbn not in self.books:
             raise BookNotFoundError(f"Book with ISBN {isbn} not found in the library.")
         removed_book = self.books.pop(isbn)
+        self._index.remove(isbn)
         print(f"Book '{removed_book.title}' removed from the library.")
 
     def search_books(self, search_term: str) -> List[Book]:
@@ -68,8 +73,7 @@ class Library:
         Returns:
             List[Book]: A list of books matching the search term.
         """
-        results = [book for book in self.books.values() if search_term.lower() in book.title.lower() or search_term.lower() in book.author.lower()]
-        return results
+        return [self.books[isbn] for isbn in self._index.search(search_term)]
 
     def display_search_results(self, results: List[Book]) -> None:
         """
@@ -0,0 +1,583 @@
+# SQLite Library Management System
+# A persistent Library stored in SQLite, with FTS5 trigram search over titles and authors.
+
+import logging
+import sqlite3
+import weakref
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from optimized_library_management import (
+    Book,
+    BookAlreadyExistsError,
+    BookNotAvailableError,
+    BookNotCheckedOutError,
+    BookNotFoundError,
+    BookStatus,
+    BulkResult,
+    Library,
+    LibraryEvent,
+    SEARCH_CACHE_SIZE,
+    normalize_author,
+)
+
+# The FTS5 trigram tokenizer, which supports substring queries, needs SQLite 3.34
+MIN_SQLITE_VERSION = (3, 34, 0)
+# Prepared statements kept per connection; the library uses a fixed set of them
+STATEMENT_CACHE_SIZE = 64
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    id INTEGER PRIMARY KEY,
+    isbn TEXT NOT NULL UNIQUE,
+    title TEXT NOT NULL,
+    author TEXT NOT NULL,
+    author_key TEXT NOT NULL,
+    status TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS books_by_status ON books (status, id);
+CREATE INDEX IF NOT EXISTS books_by_author ON books (author_key, id);
+CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+    title, author, content='books', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+    INSERT INTO books_fts(rowid, title, author) VALUES (new.id, new.title, new.author);
+END;
+CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+    INSERT INTO books_fts(books_fts, rowid, title, author) VALUES ('delete', old.id, old.title, old.author);
+END;
+CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF title, author ON books BEGIN
+    INSERT INTO books_fts(books_fts, rowid, title, author) VALUES ('delete', old.id, old.title, old.author);
+    INSERT INTO books_fts(rowid, title, author) VALUES (new.id, new.title, new.author);
+END;
+"""
+
+_SELECT_BOOK = "SELECT isbn, title, author, status FROM books WHERE isbn = ?"
+_INSERT_BOOK = "INSERT INTO books (isbn, title, author, author_key, status) VALUES (?, ?, ?, ?, ?)"
+_DELETE_BOOK = "DELETE FROM books WHERE isbn = ?"
+# Borrowing and returning are one conditional UPDATE each, so two callers cannot both succeed
+_SET_STATUS = "UPDATE books SET status = ? WHERE isbn = ? AND status = ?"
+_SEARCH_FTS = (
+    "SELECT b.isbn, b.title, b.author, b.status FROM books_fts JOIN books AS b ON b.id = books_fts.rowid "
+    "WHERE books_fts MATCH ? ORDER BY b.id"
+)
+# Terms shorter than a trigram cannot use the index. SQLite's own lower() only
+# folds ASCII, so the scan uses Python's, registered by connect()
+_SEARCH_SCAN = (
+    "SELECT isbn, title, author, status FROM books "
+    "WHERE instr(py_lower(title), ?) > 0 OR instr(py_lower(author), ?) > 0 ORDER BY id"
+)
+
+Row = Tuple[str, str, str, str]
+
+def _values(book: Book) -> Tuple[str, str, str, str, str]:
+    """
+    Returns the column values of a book, in the order of _INSERT_BOOK.
+    """
+    return book.isbn, book.title, book.author, normalize_author(book.author), book.status.value
+
+def connect(path: str) -> sqlite3.Connection:
+    """
+    Opens a library database, creating its tables if needed.
+
+    File databases use write-ahead logging, so readers do not block the
+    writer, with `synchronous=NORMAL`, which stays consistent after a crash.
+
+    Args:
+        path (str): The database file, or ":memory:".
+
+    Returns:
+        sqlite3.Connection: A connection in autocommit mode; the library opens
+        transactions itself.
+
+    Raises:
+        RuntimeError: If the SQLite library is too old for FTS5 trigram search.
+    """
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        raise RuntimeError(f"SQLite {sqlite3.sqlite_version} is too old; the library needs 3.34 or later.")
+    connection = sqlite3.connect(path, isolation_level=None, cached_statements=STATEMENT_CACHE_SIZE)
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA synchronous = NORMAL")
+    connection.create_function("py_lower", 1, str.lower, deterministic=True)
+    connection.executescript(SCHEMA)
+    return connection
+
+def fts_phrase(term: str) -> str:
+    """
+    Quotes a search term as an FTS5 phrase, so its characters are not read as query syntax.
+    """
+    return '"' + term.replace('"', '""') + '"'
+
+class SQLiteBookStore(MutableMapping):
+    """
+    A mapping of ISBN to Book backed by the `books` table.
+
+    Book objects are kept in a weak identity map: while a Book is referenced
+    anywhere, looking up its ISBN returns that same object, refreshed from
+    the database. Status changes made through the library therefore show up
+    on the Book objects callers hold, as with the in-memory Library.
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        """
+        Initializes the store.
+
+        Args:
+            connection (sqlite3.Connection): A connection returned by `connect`.
+        """
+        self.connection = connection
+        self._objects: "weakref.WeakValueDictionary[str, Book]" = weakref.WeakValueDictionary()
+
+    def book(self, row: Row) -> Book:
+        """
+        Returns the Book for a `(isbn, title, author, status)` row, reusing a live object.
+        """
+        isbn, title, author, status = row
+        book = self._objects.get(isbn)
+        if book is None:
+            book = Book(title, author, isbn, BookStatus(status))
+            self._objects[isbn] = book
+        else:
+            book.title, book.author, book.status = title, author, BookStatus(status)
+        return book
+
+    def remember(self, book: Book) -> None:
+        """
+        Makes lookups of a newly stored book return the given object.
+        """
+        self._objects[book.isbn] = book
+
+    def forget(self, isbn: str) -> None:
+        """
+        Drops a removed book from the identity map.
+        """
+        self._objects.pop(isbn, None)
+
+    def cached(self, isbn: str) -> Optional[Book]:
+        """
+        Returns the live Book object for an ISBN, if there is one.
+        """
+        return self._objects.get(isbn)
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT count(*) FROM books").fetchone()[0]
+
+    def __contains__(self, isbn) -> bool:
+        return self.connection.execute("SELECT 1 FROM books WHERE isbn = ?", (isbn,)).fetchone() is not None
+
+    def __getitem__(self, isbn: str) -> Book:
+        row = self.connection.execute(_SELECT_BOOK, (isbn,)).fetchone()
+        if row is None:
+            raise KeyError(isbn)
+        return self.book(row)
+
+    def __setitem__(self, isbn: str, book: Book) -> None:
+        if isbn != book.isbn:
+            raise ValueError(f"Book with ISBN {book.isbn} stored under ISBN {isbn}.")
+        self.connection.execute(
+            _INSERT_BOOK + " ON CONFLICT (isbn) DO UPDATE SET title = excluded.title, author = excluded.author, "
+            "author_key = excluded.author_key, status = excluded.status",
+            _values(book),
+        )
+        self.remember(book)
+
+    def __delitem__(self, isbn: str) -> None:
+        if self.connection.execute(_DELETE_BOOK, (isbn,)).rowcount == 0:
+            raise KeyError(isbn)
+        self.forget(isbn)
+
+    def __iter__(self) -> Iterator[str]:
+        for (isbn,) in self.connection.execute("SELECT isbn FROM books ORDER BY id"):
+            yield isbn
+
+    def values(self) -> List[Book]:
+        rows = self.connection.execute("SELECT isbn, title, author, status FROM books ORDER BY id").fetchall()
+        return [self.book(row) for row in rows]
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({len(self)} books)"
+
+class SQLiteLibrary(Library):
+    """
+    A Library stored in an SQLite database, so it survives restarts.
+
+    The public API is the same as Library's. `search_books` queries an FTS5
+    index with the trigram tokenizer, which matches substrings of titles and
+    authors without reading every row. Borrowing and returning are single
+    conditional UPDATEs, so concurrent callers, including other processes
+    using the same file, cannot both borrow one book. Bulk operations run in
+    one transaction.
+
+    The search cache only sees changes made through this instance. Use
+    `search_cache_size=0` when other processes write to the same database.
+    """
+
+    def __init__(self, path: str = ":memory:", search_cache_size: int = SEARCH_CACHE_SIZE, **kwargs):
+        """
+        Opens or creates a library database.
+
+        Args:
+            path (str): The database file; ":memory:" for a temporary library.
+            search_cache_size (int): Maximum number of cached searches; 0 disables caching.
+            **kwargs: `logger` and `on_event`, as for Library.
+        """
+        super().__init__(search_cache_size, **kwargs)
+        self.path = path
+        self.connection = connect(path)
+        self.books: SQLiteBookStore = SQLiteBookStore(self.connection)
+        # FTS5 replaces the in-memory trigram index
+        self._index = None
+
+    def close(self) -> None:
+        """
+        Closes the database connection.
+        """
+        self.connection.close()
+
+    def __enter__(self) -> "SQLiteLibrary":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Runs a block in a write transaction, rolled back if the block raises.
+        """
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def add_book(self, book: Book) -> None:
+        """
+        Adds a book to the library.
+
+        Args:
+            book (Book): The book to add to the library.
+
+        Raises:
+            BookAlreadyExistsError: If a book with the same ISBN already exists in the library.
+        """
+        try:
+            self.connection.execute(_INSERT_BOOK, _values(book))
+        except sqlite3.IntegrityError:
+            raise BookAlreadyExistsError(f"Book with ISBN {book.isbn} already exists in the library.") from None
+        self.books.remember(book)
+        self._search_cache.invalidate([book])
+        self._emit(LibraryEvent.ADDED, [book])
+
+    def add_books(self, books: Iterable[Book], atomic: bool = True) -> BulkResult:
+        """
+        Adds several books in one transaction.
+
+        Args:
+            books (Iterable[Book]): The books to add.
+            atomic (bool): If True, add all of the books or none of them;
+                otherwise add the ones that can be and report the others.
+
+        Returns:
+            BulkResult: The ISBNs added and, if not atomic, the ones skipped.
+
+        Raises:
+            BookAlreadyExistsError: If atomic and an ISBN is already in the library
+                or appears twice in `books`. Nothing is added.
+        """
+        books = list(books)
+        failed: Dict[str, Exception] = {}
+        if atomic:
+            try:
+                with self._transaction():
+                    self.connection.executemany(_INSERT_BOOK, map(_values, books))
+            except sqlite3.IntegrityError:
+                raise self._duplicate(books) from None
+            added = books
+        else:
+            added = []
+            with self._transaction():
+                for book in books:
+                    try:
+                        self.connection.execute(_INSERT_BOOK, _values(book))
+                    except sqlite3.IntegrityError:
+                        failed[book.isbn] = BookAlreadyExistsError(f"Book with ISBN {book.isbn} already exists in the library.")
+                        continue
+                    added.append(book)
+        for book in added:
+            self.books.remember(book)
+        self._search_cache.invalidate(added)
+        self._emit(LibraryEvent.ADDED, added)
+        return BulkResult([book.isbn for book in added], failed)
+
+    def _duplicate(self, books: List[Book]) -> BookAlreadyExistsError:
+        """
+        Returns the error for the first book of a rolled back batch that could not be added.
+        """
+        seen = set()
+        for book in books:
+            if book.isbn in seen or book.isbn in self.books:
+                break
+            seen.add(book.isbn)
+        return BookAlreadyExistsError(f"Book with ISBN {book.isbn} already exists in the library.")
+
+    def remove_book(self, isbn: str) -> None:
+        """
+        Removes a book from the library.
+
+        Args:
+            isbn (str): The ISBN of the book to remove.
+
+        Raises:
+            BookNotFoundError: If the book with the given ISBN is not found in the library.
+        """
+        removed, _ = self._remove([isbn], atomic=True)
+        self._search_cache.invalidate(removed)
+        self._emit(LibraryEvent.REMOVED, removed)
+
+    def remove_books(self, isbns: Iterable[str], atomic: bool = True) -> BulkResult:
+        """
+        Removes several books in one transaction.
+
+        Args:
+            isbns (Iterable[str]): The ISBNs of the books to remove.
+            atomic (bool): If True, remove all of the books or none of them;
+                otherwise remove the ones that can be and report the others.
+
+        Returns:
+            BulkResult: The ISBNs removed and, if not atomic, the ones skipped.
+
+        Raises:
+            BookNotFoundError: If atomic and an ISBN is not in the library or
+                appears twice in `isbns`. Nothing is removed.
+        """
+        removed, failed = self._remove(isbns, atomic)
+        self._search_cache.invalidate(removed)
+        self._emit(LibraryEvent.REMOVED, removed)
+        return BulkResult([book.isbn for book in removed], failed)
+
+    def _remove(self, isbns: Iterable[str], atomic: bool) -> Tuple[List[Book], Dict[str, Exception]]:
+        """
+        Deletes books in one transaction and returns them with the errors of the others.
+        """
+        rows: List[Row] = []
+        failed: Dict[str, Exception] = {}
+        with self._transaction():
+            for isbn in isbns:
+                row = self.connection.execute(_SELECT_BOOK, (isbn,)).fetchone()
+                if row is None:
+                    error = BookNotFoundError(f"Book with ISBN {isbn} not found in the library.")
+                    if atomic:
+                        raise error
+                    failed[isbn] = error
+                    continue
+                self.connection.execute(_DELETE_BOOK, (isbn,))
+                rows.append(row)
+        removed = [self.books.book(row) for row in rows]
+        for book in removed:
+            self.books.forget(book.isbn)
+        return removed, failed
+
+    def search_books(self, search_term: str) -> List[Book]:
+        """
+        Searches for books in the library based on a search term.
+
+        Results of recent searches are cached, and repeating a search returns
+        the same list object; callers must not modify it.
+
+        Args:
+            search_term (str): The term to search for in book titles and authors.
+
+        Returns:
+            List[Book]: The books whose title or author contains the search term
+            (case-insensitive), in the order they were added.
+        """
+        term = search_term.lower()
+        results = self._search_cache.get(term)
+        if results is None:
+            if len(term) >= 3:
+                rows = self.connection.execute(_SEARCH_FTS, (fts_phrase(term),)).fetchall()
+            else:
+                rows = self.connection.execute(_SEARCH_SCAN, (term, term)).fetchall()
+            results = [self.books.book(row) for row in rows]
+            self._search_cache.put(term, results)
+        return results
+
+    def count_by_status(self, status: BookStatus) -> int:
+        """
+        Counts the books with a status, using the index on `status`.
+
+        Args:
+            status (BookStatus): The status to count.
+
+        Returns:
+            int: The number of books with that status.
+        """
+        return self.connection.execute("SELECT count(*) FROM books WHERE status = ?", (status.value,)).fetchone()[0]
+
+    def books_by_status(self, status: BookStatus) -> List[Book]:
+        """
+        Lists the books with a status, e.g. the available ones.
+
+        Args:
+            status (BookStatus): The status to list.
+
+        Returns:
+            List[Book]: The books with that status, in the order they were added.
+        """
+        rows = self.connection.execute(
+            "SELECT isbn, title, author, status FROM books WHERE status = ? ORDER BY id", (status.value,)
+        ).fetchall()
+        return [self.books.book(row) for row in rows]
+
+    def books_by_author(self, author: str) -> List[Book]:
+        """
+        Lists an author's books.
+
+        Args:
+            author (str): The author's name; case and repeated spaces are ignored.
+
+        Returns:
+            List[Book]: The author's books, in the order they were added.
+        """
+        rows = self.connection.execute(
+            "SELECT isbn, title, author, status FROM books WHERE author_key = ? ORDER BY id", (normalize_author(author),)
+        ).fetchall()
+        return [self.books.book(row) for row in rows]
+
+    def check_indexes(self) -> List[str]:
+        """
+        Runs SQLite's integrity check, which compares every index with the table.
+
+        Returns:
+            List[str]: The problems SQLite reports; empty if there is none.
+        """
+        problems = [row[0] for row in self.connection.execute("PRAGMA integrity_check")]
+        return [] if problems == ["ok"] else problems
+
+    def borrow_book(self, isbn: str) -> None:
+        """
+        Marks a book as borrowed (checked out) in the library.
+
+        Args:
+            isbn (str): The ISBN of the book to borrow.
+
+        Raises:
+            BookNotFoundError: If the book with the given ISBN is not found in the library.
+        """
+        if self._set_status(isbn, BookStatus.AVAILABLE, BookStatus.CHECKED_OUT):
+            self._emit_for(LibraryEvent.BORROWED, isbn)
+        else:
+            self._emit_for(LibraryEvent.NOT_AVAILABLE, isbn)
+
+    def return_book(self, isbn: str) -> None:
+        """
+        Marks a book as returned (available) in the library.
+
+        Args:
+            isbn (str): The ISBN of the book to return.
+
+        Raises:
+            BookNotFoundError: If the book with the given ISBN is not found in the library.
+        """
+        if self._set_status(isbn, BookStatus.CHECKED_OUT, BookStatus.AVAILABLE):
+            self._emit_for(LibraryEvent.RETURNED, isbn)
+        else:
+            self._emit_for(LibraryEvent.NOT_CHECKED_OUT, isbn)
+
+    def borrow_many(self, isbns: Iterable[str], atomic: bool = True) -> BulkResult:
+        """
+        Marks several books as borrowed (checked out) in one transaction.
+
+        Args:
+            isbns (Iterable[str]): The ISBNs of the books to borrow.
+            atomic (bool): If True, borrow all of the books or none of them;
+                otherwise borrow the ones that are available and report the others.
+
+        Returns:
+            BulkResult: The ISBNs borrowed and, if not atomic, the ones skipped.
+
+        Raises:
+            BookNotFoundError: If atomic and an ISBN is not in the library.
+            BookNotAvailableError: If atomic and a book is checked out or appears
+                twice in `isbns`. Nothing is borrowed.
+        """
+        return self._set_status_many(isbns, BookStatus.AVAILABLE, BookStatus.CHECKED_OUT, atomic)
+
+    def return_many(self, isbns: Iterable[str], atomic: bool = True) -> BulkResult:
+        """
+        Marks several books as returned (available) in one transaction.
+
+        Args:
+            isbns (Iterable[str]): The ISBNs of the books to return.
+            atomic (bool): If True, return all of the books or none of them;
+                otherwise return the ones that are checked out and report the others.
+
+        Returns:
+            BulkResult: The ISBNs returned and, if not atomic, the ones skipped.
+
+        Raises:
+            BookNotFoundError: If atomic and an ISBN is not in the library.
+            BookNotCheckedOutError: If atomic and a book is not checked out or
+                appears twice in `isbns`. Nothing is returned.
+        """
+        return self._set_status_many(isbns, BookStatus.CHECKED_OUT, BookStatus.AVAILABLE, atomic)
+
+    def _emit_for(self, event: LibraryEvent, isbn: str) -> None:
+        """
+        Reports an event for one book, loading it only if someone is listening.
+        """
+        if self.on_event is not None or self.logger.isEnabledFor(logging.INFO):
+            self._emit(event, [self._get_book(isbn)])
+
+    def _set_status(self, isbn: str, expected: BookStatus, status: BookStatus) -> bool:
+        """
+        Changes a book's status if it is `expected`, in one UPDATE.
+
+        Returns:
+            bool: Whether the status was changed.
+
+        Raises:
+            BookNotFoundError: If the book is not in the library.
+        """
+        if self.connection.execute(_SET_STATUS, (status.value, isbn, expected.value)).rowcount:
+            book = self.books.cached(isbn)
+            if book is not None:
+                book.status = status
+            return True
+        if isbn not in self.books:
+            raise BookNotFoundError(f"Book with ISBN {isbn} not found in the library.")
+        return False
+
+    def _set_status_many(self, isbns: Iterable[str], expected: BookStatus, status: BookStatus, atomic: bool) -> BulkResult:
+        """
+        Changes the status of several books in one transaction.
+        """
+        changed: List[str] = []
+        failed: Dict[str, Exception] = {}
+        with self._transaction():
+            for isbn in isbns:
+                if self.connection.execute(_SET_STATUS, (status.value, isbn, expected.value)).rowcount:
+                    changed.append(isbn)
+                    continue
+                if isbn not in self.books:
+                    error: Exception = BookNotFoundError(f"Book with ISBN {isbn} not found in the library.")
+                elif expected == BookStatus.AVAILABLE:
+                    error = BookNotAvailableError(f"Book with ISBN {isbn} is not available.")
+                else:
+                    error = BookNotCheckedOutError(f"Book with ISBN {isbn} is not checked out.")
+                if atomic:
+                    raise error
+                failed[isbn] = error
+        books = []
+        for isbn in changed:
+            book = self.books.cached(isbn)
+            if book is not None:
+                book.status = status
+            if self.on_event is not None or self.logger.isEnabledFor(logging.INFO):
+                books.append(book if book is not None else self.books[isbn])
+        self._emit(LibraryEvent.BORROWED if status == BookStatus.CHECKED_OUT else LibraryEvent.RETURNED, books)
+        return BulkResult(changed, failed)
@@ -1,5 +1,21 @@
+import asyncio
+import gc
+import io
+import os
+import random
+import tempfile
+import threading
+import time
 import unittest
+import weakref
+from contextlib import redirect_stdout
 from optimized_library_management import Book, BookStatus, Library, BookNotFoundError, BookAlreadyExistsError
+from optimized_library_management import BookNotAvailableError, BookNotCheckedOutError, LibraryEvent, normalize_author
+from trigram_index import TrigramIndex
+from columnar_library_management import BookTable, BookView, ColumnarLibrary, pack_isbn, unpack_isbn
+from sqlite_library_management import SQLiteLibrary
+from library_snapshot import HEADER, SnapshotBooks, SnapshotError
+from concurrent_library_management import AsyncLibrary, ConcurrentLibrary
 
 class TestLibraryManagement(unittest.TestCase):
 
@@ -109,6 +125,15 @@ class TestLibraryManagement(unittest.TestCase):
         results = self.library.search_books("Book")
         self.assertEqual(len(results), 3)
 
+    def test_search_non_ascii_case_insensitive(self):
+        """Test that search folds the case of non-ASCII letters, for short and long terms."""
+        book = Book("Élan vital", "Émile Zola", "1111111111")
+        self.library.add_book(book)
+        self.library.add_book(self.book1)
+        self.assertEqual(self.library.search_books("É"), [book])
+        self.assertEqual(self.library.search_books("éla"), [book])
+        self.assertEqual(self.library.search_books("ÉMILE"), [book])
+
     def test_search_books_caching(self):
         """Test that search results are cached."""
         self.library.add_book(self.book1)
@@ -121,5 +146,892 @@ class TestLibraryManagement(unittest.TestCase):
         # Check that the results are the same object (cached)
         self.assertIs(results1, results2)
 
+    def test_search_substring(self):
+        """Test that search matches any part of a title or author."""
+        self.library.add_book(self.book1)
+        self.library.add_book(self.book2)
+        self.assertEqual(self.library.search_books("ockingb"), [self.book2])
+        self.assertEqual(self.library.search_books("scott fitz"), [self.book1])
+        self.assertEqual(self.library.search_books("e"), [self.book1, self.book2])
+
+    def test_search_after_remove(self):
+        """Test that removed books are no longer found."""
+        self.library.add_book(self.book1)
+        self.library.add_book(self.book2)
+        self.library.remove_book(self.book1.isbn)
+        self.assertEqual(self.library.search_books("Great"), [])
+        self.assertEqual(self.library.search_books("Harper Lee"), [self.book2])
+
+    def test_status_and_author_queries(self):
+        """Test counting and listing books by status and by author."""
+        book3 = Book("Go Set a Watchman", "  harper   LEE", "1111111111")
+        for book in (self.book1, self.book2, book3):
+            self.library.add_book(book)
+        self.library.borrow_book(self.book2.isbn)
+        self.library.borrow_book(book3.isbn)
+        self.assertEqual(self.library.count_by_status(BookStatus.AVAILABLE), 1)
+        self.assertEqual(self.library.count_by_status(BookStatus.CHECKED_OUT), 2)
+        self.assertEqual(self.library.books_by_status(BookStatus.CHECKED_OUT), [self.book2, book3])
+        self.assertEqual(self.library.books_by_author("Harper Lee"), [self.book2, book3])
+
+        self.library.return_book(self.book2.isbn)
+        self.library.remove_book(book3.isbn)
+        self.assertEqual(self.library.books_by_status(BookStatus.AVAILABLE), [self.book1, self.book2])
+        self.assertEqual(self.library.count_by_status(BookStatus.CHECKED_OUT), 0)
+        self.assertEqual(self.library.books_by_author("HARPER LEE"), [self.book2])
+        self.assertEqual(self.library.books_by_author("Nobody"), [])
+        self.assertEqual(self.library.check_indexes(), [])
+
+    def test_book_has_slots(self):
+        """Test that Book instances use __slots__ and keep their defaults."""
+        self.assertFalse(hasattr(self.book1, "__dict__"))
+        self.assertEqual(self.book1.status, BookStatus.AVAILABLE)
+        self.assertEqual(self.book1, Book("The Great Gatsby", "F. Scott Fitzgerald", "1234567890"))
+
+class TestSearchCache(unittest.TestCase):
+
+    def setUp(self):
+        self.library = Library()
+        self.book1 = Book("The Great Gatsby", "F. Scott Fitzgerald", "1234567890")
+        self.book2 = Book("To Kill a Mockingbird", "Harper Lee", "0987654321")
+        self.library.add_book(self.book1)
+        self.library.add_book(self.book2)
+
+    def test_add_invalidates_matching_searches(self):
+        """Test that adding a book refreshes the searches it matches and keeps the others."""
+        gatsby = self.library.search_books("Gatsby")
+        harper = self.library.search_books("Harper")
+        book3 = Book("Gatsby Revisited", "Anonymous", "5555")
+        self.library.add_book(book3)
+        self.assertEqual(self.library.search_books("Gatsby"), [self.book1, book3])
+        self.assertIs(self.library.search_books("Harper"), harper)
+        self.assertEqual(gatsby, [self.book1])
+
+    def test_remove_invalidates_matching_searches(self):
+        """Test that a removed book disappears from cached searches."""
+        self.assertEqual(self.library.search_books("mockingbird"), [self.book2])
+        self.library.remove_book(self.book2.isbn)
+        self.assertEqual(self.library.search_books("mockingbird"), [])
+        self.assertEqual(self.library.search_cache_info().invalidations, 1)
+
+    def test_cached_results_show_current_status(self):
+        """Test that borrowing is visible through a cached search result."""
+        results = self.library.search_books("gatsby")
+        self.library.borrow_book(self.book1.isbn)
+        self.assertIs(self.library.search_books("gatsby"), results)
+        self.assertEqual(results[0].status, BookStatus.CHECKED_OUT)
+
+    def test_case_insensitive_key_and_stats(self):
+        """Test that searches differing only in case share an entry and are counted."""
+        results = self.library.search_books("Gatsby")
+        self.assertIs(self.library.search_books("GATSBY"), results)
+        info = self.library.search_cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (1, 1, 1))
+        self.library.clear_search_cache()
+        self.assertEqual(self.library.search_cache_info().currsize, 0)
+
+    def test_lru_eviction(self):
+        """Test that the least recently used search is evicted when the cache is full."""
+        library = Library(search_cache_size=2)
+        library.add_book(self.book1)
+        first = library.search_books("great")
+        library.search_books("scott")
+        library.search_books("great")
+        library.search_books("gatsby")
+        self.assertIs(library.search_books("great"), first)
+        self.assertEqual(library.search_cache_info().currsize, 2)
+        self.assertEqual(library.search_cache_info().misses, 3)
+
+    def test_caching_disabled(self):
+        """Test that a cache size of 0 disables caching."""
+        library = Library(search_cache_size=0)
+        library.add_book(self.book1)
+        self.assertIsNot(library.search_books("great"), library.search_books("great"))
+
+    def test_library_is_not_kept_alive(self):
+        """Test that searching does not keep the library alive."""
+        library = Library()
+        library.add_book(self.book1)
+        library.search_books("great")
+        ref = weakref.ref(library)
+        del library
+        gc.collect()
+        self.assertIsNone(ref())
+
+class TestBulkOperations(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        self.library = Library(on_event=lambda event, book: self.events.append((event, book.isbn)))
+        self.books = [Book(f"Book{i}", f"Author{i}", str(i)) for i in range(5)]
+
+    def test_add_books(self):
+        """Test adding a batch of books, searchable afterwards."""
+        result = self.library.add_books(self.books)
+        self.assertEqual(result.succeeded, ["0", "1", "2", "3", "4"])
+        self.assertEqual(result.failed, {})
+        self.assertEqual(list(self.library.books), result.succeeded)
+        self.assertEqual(self.library.search_books("author3"), [self.books[3]])
+        self.assertEqual(self.events, [(LibraryEvent.ADDED, str(i)) for i in range(5)])
+
+    def test_add_books_atomic(self):
+        """Test that an atomic batch with a duplicate adds nothing."""
+        self.library.add_book(self.books[2])
+        with self.assertRaises(BookAlreadyExistsError):
+            self.library.add_books(self.books)
+        self.assertEqual(list(self.library.books), ["2"])
+        self.assertEqual(self.library.search_books("book"), [self.books[2]])
+
+    def test_add_books_best_effort(self):
+        """Test that a best-effort batch skips duplicates and reports them."""
+        self.library.add_book(self.books[2])
+        result = self.library.add_books(self.books + [Book("Again", "Author0", "0")], atomic=False)
+        self.assertEqual(result.succeeded, ["0", "1", "3", "4"])
+        self.assertEqual(set(result.failed), {"0", "2"})
+        self.assertIsInstance(result.failed["2"], BookAlreadyExistsError)
+        self.assertEqual(self.library.books["0"], self.books[0])
+
+    def test_add_books_invalidates_cache(self):
+        """Test that a batch refreshes the cached searches it changes."""
+        self.library.add_book(self.books[0])
+        self.assertEqual(self.library.search_books("book"), [self.books[0]])
+        self.library.add_books(self.books[1:])
+        self.assertEqual(self.library.search_books("book"), self.books)
+
+    def test_remove_books(self):
+        """Test removing a batch, atomically and best-effort."""
+        self.library.add_books(self.books)
+        with self.assertRaises(BookNotFoundError):
+            self.library.remove_books(["1", "missing"])
+        self.assertIn("1", self.library.books)
+        result = self.library.remove_books(["1", "missing", "3", "1"], atomic=False)
+        self.assertEqual(result.succeeded, ["1", "3"])
+        self.assertEqual(set(result.failed), {"missing", "1"})
+        self.assertEqual(list(self.library.books), ["0", "2", "4"])
+        self.assertEqual(self.library.search_books("book"), [self.books[0], self.books[2], self.books[4]])
+
+    def test_borrow_and_return_many(self):
+        """Test borrowing and returning batches, atomically and best-effort."""
+        self.library.add_books(self.books)
+        self.library.borrow_book("0")
+        with self.assertRaises(BookNotAvailableError):
+            self.library.borrow_many(["1", "0"])
+        self.assertEqual(self.books[1].status, BookStatus.AVAILABLE)
+        with self.assertRaises(BookNotAvailableError):
+            self.library.borrow_many(["1", "1"])
+        result = self.library.borrow_many(["0", "1", "2", "missing"], atomic=False)
+        self.assertEqual(result.succeeded, ["1", "2"])
+        self.assertIsInstance(result.failed["0"], BookNotAvailableError)
+        self.assertIsInstance(result.failed["missing"], BookNotFoundError)
+
+        with self.assertRaises(BookNotCheckedOutError):
+            self.library.return_many(["0", "3"])
+        self.assertEqual(self.books[0].status, BookStatus.CHECKED_OUT)
+        result = self.library.return_many(["0", "1", "2"])
+        self.assertEqual(result.succeeded, ["0", "1", "2"])
+        self.assertTrue(all(book.status == BookStatus.AVAILABLE for book in self.books))
+
+    def test_bulk_changes_keep_indexes(self):
+        """Test that bulk operations, including rejected ones, leave the status and author indexes consistent."""
+        self.library.add_books(self.books)
+        self.library.borrow_many(["1", "3"])
+        with self.assertRaises(BookNotAvailableError):
+            self.library.borrow_many(["0", "1"])
+        self.library.remove_books(["3", "4"])
+        self.library.return_many(["1", "missing"], atomic=False)
+        self.assertEqual(self.library.count_by_status(BookStatus.AVAILABLE), 3)
+        self.assertEqual(self.library.count_by_status(BookStatus.CHECKED_OUT), 0)
+        self.assertEqual(self.library.books_by_author("author2"), [self.books[2]])
+        self.assertEqual(self.library.books_by_author("Author4"), [])
+        self.assertEqual(self.library.check_indexes(), [])
+
+    def test_messages_are_logged_not_printed(self):
+        """Test that changes go to the logger instead of stdout."""
+        output = io.StringIO()
+        with redirect_stdout(output), self.assertLogs("optimized_library_management", "INFO") as logs:
+            self.library.add_book(self.books[0])
+            self.library.borrow_book("0")
+            self.library.borrow_book("0")
+        self.assertEqual(output.getvalue(), "")
+        self.assertEqual(logs.output, [
+            "INFO:optimized_library_management:Book 'Book0' added to the library.",
+            "INFO:optimized_library_management:You have borrowed 'Book0'.",
+            "INFO:optimized_library_management:Book 'Book0' is not available.",
+        ])
+        self.assertEqual([event for event, _ in self.events], [LibraryEvent.ADDED, LibraryEvent.BORROWED, LibraryEvent.NOT_AVAILABLE])
+
+class TestColumnarLibraryManagement(TestLibraryManagement):
+    """
+    Runs the Library tests against ColumnarLibrary. It stores copies of the
+    books it is given, so the tests that check the given Book objects read
+    the statuses through the library instead.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.library = ColumnarLibrary()
+
+    def status_of(self, book):
+        return self.library.books[book.isbn].status
+
+    def test_borrow_book(self):
+        """Test borrowing an available book."""
+        self.library.add_book(self.book1)
+        self.library.borrow_book(self.book1.isbn)
+        self.assertEqual(self.status_of(self.book1), BookStatus.CHECKED_OUT)
+
+    def test_borrow_unavailable_book(self):
+        """Test borrowing an unavailable book."""
+        self.library.add_book(self.book1)
+        self.library.borrow_book(self.book1.isbn)
+        self.library.borrow_book(self.book1.isbn)  # Try to borrow again
+        self.assertEqual(self.status_of(self.book1), BookStatus.CHECKED_OUT)
+
+    def test_return_book(self):
+        """Test returning a borrowed book."""
+        self.library.add_book(self.book1)
+        self.library.borrow_book(self.book1.isbn)
+        self.library.return_book(self.book1.isbn)
+        self.assertEqual(self.status_of(self.book1), BookStatus.AVAILABLE)
+
+    def test_return_available_book(self):
+        """Test returning an already available book."""
+        self.library.add_book(self.book1)
+        self.library.return_book(self.book1.isbn)
+        self.assertEqual(self.status_of(self.book1), BookStatus.AVAILABLE)
+
+    def test_status_and_author_queries(self):
+        """Test counting and listing books by status and by author."""
+        book3 = Book("Go Set a Watchman", "  harper   LEE", "1111111111")
+        for book in (self.book1, self.book2, book3):
+            self.library.add_book(book)
+        self.library.borrow_book(self.book2.isbn)
+        self.library.borrow_book(book3.isbn)
+        self.assertEqual(self.library.count_by_status(BookStatus.AVAILABLE), 1)
+        self.assertEqual(self.library.count_by_status(BookStatus.CHECKED_OUT), 2)
+        self.assertEqual([book.isbn for book in self.library.books_by_status(BookStatus.CHECKED_OUT)], [self.book2.isbn, book3.isbn])
+        self.assertEqual([book.isbn for book in self.library.books_by_author("Harper Lee")], [self.book2.isbn, book3.isbn])
+
+        self.library.return_book(self.book2.isbn)
+        self.library.remove_book(book3.isbn)
+        self.assertEqual(self.library.books_by_status(BookStatus.AVAILABLE), [self.book1, self.book2])
+        self.assertEqual(self.library.count_by_status(BookStatus.CHECKED_OUT), 0)
+        self.assertEqual(self.library.books_by_author("HARPER LEE"), [self.book2])
+        self.assertEqual(self.library.books_by_author("Nobody"), [])
+        self.assertEqual(self.library.check_indexes(), [])
+
+class TestColumnarBulkOperations(TestBulkOperations):
+    """Runs the bulk operation tests against ColumnarLibrary."""
+
+    def setUp(self):
+        super().setUp()
+        self.library = ColumnarLibrary(on_event=self.library.on_event)
+
+    def test_borrow_and_return_many(self):
+        """Test borrowing and returning batches, atomically and best-effort."""
+        self.library.add_books(self.books)
+        self.library.borrow_book("0")
+        with self.assertRaises(BookNotAvailableError):
+            self.library.borrow_many(["1", "0"])
+        self.assertEqual(self.library.books["1"].status, BookStatus.AVAILABLE)
+        with self.assertRaises(BookNotAvailableError):
+            self.library.borrow_many(["1", "1"])
+        result = self.library.borrow_many(["0", "1", "2", "missing"], atomic=False)
+        self.assertEqual(result.succeeded, ["1", "2"])
+        self.assertIsInstance(result.failed["0"], BookNotAvailableError)
+        self.assertIsInstance(result.failed["missing"], BookNotFoundError)
+
+        with self.assertRaises(BookNotCheckedOutError):
+            self.library.return_many(["0", "3"])
+        self.assertEqual(self.library.books["0"].status, BookStatus.CHECKED_OUT)
+        result = self.library.return_many(["0", "1", "2"])
+        self.assertEqual(result.succeeded, ["0", "1", "2"])
+        self.assertTrue(all(book.status == BookStatus.AVAILABLE for book in self.library.books.values()))
+
+class TestColumnarLibrary(unittest.TestCase):
+
+    def setUp(self):
+        self.library = ColumnarLibrary()
+        self.book1 = Book("The Great Gatsby", "F. Scott Fitzgerald", "1234567890")
+        self.book2 = Book("To Kill a Mockingbird", "Harper Lee", "0987654321")
+
+    def test_pack_isbn(self):
+        """Test that packing keeps leading zeros and X check characters, and rejects other ISBNs."""
+        for isbn in ("0987654321", "080442957X", "9780306406157", "0"):
+            self.assertEqual(unpack_isbn(pack_isbn(isbn)), isbn)
+        for isbn in ("978-0306406157", "nonexistent_isbn", "", "X", "1" * 18, "١٢٣"):
+            self.assertEqual(pack_isbn(isbn), -1)
+
+    def test_views(self):
+        """Test that stored books come back as equal views that write status through."""
+        self.library.add_book(self.book1)
+        self.library.add_book(self.book2)
+        view = self.library.books[self.book1.isbn]
+        self.assertIsInstance(view, BookView)
+        self.assertEqual(view, self.book1)
+        self.assertEqual(str(view), str(self.book1))
+        self.library.borrow_book(self.book1.isbn)
+        self.assertEqual(view.status, BookStatus.CHECKED_OUT)
+        self.assertEqual(self.book1.status, BookStatus.AVAILABLE)
+        self.assertEqual(self.library.search_books("mocking"), [self.book2])
+
+    def test_unpackable_isbns(self):
+        """Test books whose ISBN cannot be packed."""
+        book = Book("Odd", "Someone", "isbn-7")
+        self.library.add_book(book)
+        self.assertIn("isbn-7", self.library.books)
+        self.assertEqual(self.library.books["isbn-7"], book)
+        self.library.remove_book("isbn-7")
+        self.assertNotIn("isbn-7", self.library.books)
+        with self.assertRaises(BookNotFoundError):
+            self.library.borrow_book("isbn-7")
+
+    def test_search_index_is_keyed_by_row(self):
+        """Test that the search index keeps no ISBNs and still compacts after many removals."""
+        books = [Book(f"Title {i}", f"Author {i % 7}", f"{i:010d}") for i in range(3000)]
+        self.library.add_books(books)
+        self.library.remove_books(book.isbn for book in books[:2000])
+        index = self.library._index
+        self.assertEqual((index._ids, index._keys, index._fields), ({}, [], []))
+        self.assertEqual(index._dead, 0)
+        self.assertEqual(len(index), 1000)
+        self.assertEqual(self.library.search_books("title 2999"), [books[2999]])
+        self.assertEqual(self.library.search_books("title 1999"), [])
+        self.assertEqual(len(self.library.search_books("or 3")), 143)
+
+    def test_removed_rows_are_compacted(self):
+        """Test that many removals compact the table and indexes, keeping views on their books."""
+        books = [Book(f"Title {i}", f"Author {i % 7}", f"{i:010d}" if i % 10 else f"isbn-{i}") for i in range(3000)]
+        self.library.add_books(books)
+        self.library.borrow_many([books[5].isbn, books[2500].isbn, books[2510].isbn])
+        kept, removed = self.library.books[books[2500].isbn], self.library.books[books[5].isbn]
+        # Half of the rows removed is not yet enough
+        self.library.remove_books(book.isbn for book in books[:1500])
+        self.assertEqual(self.library.books.removed_rows, 1500)
+        self.library.remove_book(books[1500].isbn)
+        table = self.library.books
+        self.assertEqual((table.removed_rows, len(table._isbns), len(table)), (0, 1499, 1499))
+        self.assertEqual(list(table), [book.isbn for book in books[1501:]])
+        self.assertEqual((kept.title, kept.status), ("Title 2500", BookStatus.CHECKED_OUT))
+        self.assertEqual((removed.title, removed.isbn, removed.status), ("Title 5", books[5].isbn, BookStatus.CHECKED_OUT))
+        removed.status = BookStatus.AVAILABLE
+        self.library.return_book(books[2500].isbn)
+        self.assertEqual(kept.status, BookStatus.AVAILABLE)
+        self.assertEqual(self.library.count_by_status(BookStatus.CHECKED_OUT), 1)
+        self.assertEqual([book.isbn for book in self.library.books_by_status(BookStatus.CHECKED_OUT)], [books[2510].isbn])
+        self.assertEqual(self.library.books_by_author("author 3"), [book for book in books[1501:] if book.author == "Author 3"])
+        self.assertEqual(self.library.search_books("title 2990"), [books[2990]])
+        self.library.add_book(Book("Title 3000", "Author 0", "isbn-3000"))
+        self.assertEqual(self.library.search_books("title 3000"), [Book("Title 3000", "Author 0", "isbn-3000")])
+        self.assertEqual(self.library.check_indexes(), [])
+
+    def test_indexes_are_read_from_table(self):
+        """Test that the status and author queries use the table's bits and author ids, with no per-ISBN entries."""
+        books = [
+            Book("Mockingbird", "Harper Lee", "1"),
+            Book("Gatsby", "F. Scott Fitzgerald", "2"),
+            Book("Watchman", "HARPER  lee", "3"),
+            Book("Unpackable", "Harper Lee", "isbn-4"),
+        ]
+        self.library.add_books(books)
+        self.library.borrow_many(["3", "isbn-4", "2"])
+        self.library.remove_book("1")
+        self.library.add_book(books[0])
+        self.library.return_book("2")
+        self.assertEqual(self.library.count_by_status(BookStatus.CHECKED_OUT), 2)
+        self.assertEqual(self.library.count_by_status(BookStatus.AVAILABLE), 2)
+        self.assertEqual([book.isbn for book in self.library.books_by_status(BookStatus.CHECKED_OUT)], ["3", "isbn-4"])
+        self.assertEqual([book.isbn for book in self.library.books_by_status(BookStatus.AVAILABLE)], ["2", "1"])
+        by_author = self.library.books_by_author("harper lee")
+        self.assertEqual([book.isbn for book in by_author], ["3", "isbn-4", "1"])
+        self.assertTrue(all(isinstance(book, BookView) for book in by_author))
+        self.assertEqual(self.library.check_indexes(), [])
+        self.assertEqual(self.library._secondary._author_ids, {"harper lee": [0, 2], "f. scott fitzgerald": [1]})
+
+    def test_checked_out_count_follows_status_changes(self):
+        """Test that the table's checked-out count changes only with live rows, and that the check recounts it."""
+        self.library.add_books([Book(f"Title {i}", "Author", str(i)) for i in range(10)])
+        self.library.borrow_many(["1", "2", "3"])
+        removed = self.library.books["2"]
+        self.library.remove_book("2")
+        self.assertEqual(self.library.books.checked_out, 2)
+        removed.status = BookStatus.AVAILABLE
+        removed.status = BookStatus.CHECKED_OUT
+        self.library.books["1"].status = BookStatus.CHECKED_OUT
+        self.assertEqual(self.library.count_by_status(BookStatus.CHECKED_OUT), 2)
+        self.assertEqual(self.library.count_by_status(BookStatus.AVAILABLE), 7)
+        self.assertEqual(self.library.check_indexes(), [])
+        self.library.books._status_bits[0] |= 1
+        self.assertEqual(self.library.check_indexes(), [
+            "The status index counts 7 books as 'Available', but 6 are.",
+            "The status index counts 2 books as 'Checked out', but 3 are.",
+        ])
+
+    def test_matches_dict_library(self):
+        """Test that a random workload gives the same results as the dict-based Library."""
+        rng = random.Random(7)
+        reference = Library()
+        isbns = [f"{i:010d}" for i in range(3000)] + ["isbn-a", "isbn-b"]
+        for step in range(6000):
+            isbn = rng.choice(isbns)
+            action = rng.random()
+            for library in (reference, self.library):
+                if action < 0.5:
+                    if isbn not in library.books:
+                        library.add_book(Book(f"Title {isbn[-3:]}", f"Author {isbn[-2:]}", isbn))
+                elif action < 0.65:
+                    if isbn in library.books:
+                        library.remove_book(isbn)
+                elif action < 0.85:
+                    if isbn in library.books:
+                        library.borrow_book(isbn)
+                elif isbn in library.books:
+                    library.return_book(isbn)
+            if step % 500 == 0:
+                term = f"title {rng.randint(0, 99)}"
+                self.assertEqual(self.library.search_books(term), reference.search_books(term))
+        self.assertEqual(list(self.library.books), list(reference.books))
+        self.assertEqual(list(self.library.books.values()), list(reference.books.values()))
+
+    def test_table_growth_and_reuse(self):
+        """Test that the ISBN hash table grows and reuses deleted slots."""
+        table = BookTable()
+        for i in range(1000):
+            table[str(i)] = Book("T", "A", str(i))
+        for i in range(0, 1000, 2):
+            del table[str(i)]
+        for i in range(0, 1000, 4):
+            table[str(i)] = Book("T2", "A", str(i))
+        self.assertEqual(len(table), 750)
+        self.assertEqual(table["4"].title, "T2")
+        self.assertNotIn("2", table)
+        self.assertEqual(len(list(table)), 750)
+        with self.assertRaises(KeyError):
+            del table["2"]
+
+class TestSQLiteLibraryManagement(TestLibraryManagement):
+    """Runs the Library tests against the SQLite backend."""
+
+    def setUp(self):
+        super().setUp()
+        self.library = SQLiteLibrary()
+        self.addCleanup(self.library.close)
+
+class TestSQLiteBulkOperations(TestBulkOperations):
+    """Runs the bulk operation tests against the SQLite backend."""
+
+    def setUp(self):
+        super().setUp()
+        self.library = SQLiteLibrary(on_event=self.library.on_event)
+        self.addCleanup(self.library.close)
+
+class TestSQLiteLibrary(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "library.db")
+        self.book1 = Book("The Great Gatsby", "F. Scott Fitzgerald", "1234567890")
+        self.book2 = Book("To Kill a Mockingbird", "Harper Lee", "0987654321")
+
+    def test_books_persist(self):
+        """Test that books and their status survive reopening the database."""
+        with SQLiteLibrary(self.path) as library:
+            self.assertEqual(library.connection.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+            library.add_books([self.book1, self.book2])
+            library.borrow_book(self.book2.isbn)
+        with SQLiteLibrary(self.path) as library:
+            self.assertEqual(list(library.books), [self.book1.isbn, self.book2.isbn])
+            self.assertEqual(library.books[self.book2.isbn].status, BookStatus.CHECKED_OUT)
+            self.assertEqual(library.search_books("mocking"), [self.book2])
+
+    def test_search_is_not_fts_syntax(self):
+        """Test that quotes and FTS5 operators in a search term are matched literally."""
+        with SQLiteLibrary() as library:
+            quoted = Book('The "Real" Thing AND More', "Tom Stoppard", "1")
+            library.add_books([quoted, self.book1])
+            self.assertEqual(library.search_books('"real" thing and'), [quoted])
+            self.assertEqual(library.search_books("NEAR(a b)"), [])
+            self.assertEqual(library.search_books("t"), [quoted, self.book1])
+
+    def test_borrow_without_listener_skips_lookup(self):
+        """Test that borrowing and returning only load the book when an event will be reported."""
+        with SQLiteLibrary() as library:
+            library.add_book(self.book1)
+            statements = []
+            library.connection.set_trace_callback(statements.append)
+            library.borrow_book(self.book1.isbn)
+            library.return_book(self.book1.isbn)
+            self.assertFalse([statement for statement in statements if statement.startswith("SELECT")])
+
+    def test_concurrent_borrows(self):
+        """Test that two connections borrowing the same book cannot both succeed."""
+        with SQLiteLibrary(self.path) as library:
+            library.add_book(self.book1)
+        borrowed = []
+
+        def borrow():
+            with SQLiteLibrary(self.path, on_event=lambda event, book: borrowed.append(event)) as library:
+                library.borrow_book(self.book1.isbn)
+
+        threads = [threading.Thread(target=borrow) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(borrowed.count(LibraryEvent.BORROWED), 1)
+        self.assertEqual(borrowed.count(LibraryEvent.NOT_AVAILABLE), 7)
+
+class TestSnapshotLibraryManagement(TestLibraryManagement):
+    """Runs the Library tests against a library opened from an empty snapshot."""
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "library.snapshot")
+        Library().save_snapshot(path)
+        self.library = Library.open_snapshot(path)
+        self.addCleanup(self.library.books.close)
+
+class TestSnapshotBulkOperations(TestBulkOperations):
+    """Runs the bulk operation tests against a library opened from an empty snapshot."""
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "library.snapshot")
+        Library().save_snapshot(path)
+        self.library = Library.open_snapshot(path, on_event=self.library.on_event)
+        self.addCleanup(self.library.books.close)
+
+class TestLibrarySnapshot(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "library.snapshot")
+        self.books = [Book(f"Title {i} é", f"Author {i % 7}", f"{i:010d}") for i in range(200)]
+        self.books.append(Book("Ünïcode 書名", "Someone", "isbn-x"))
+        self.library = Library()
+        self.library.add_books(self.books)
+        self.library.borrow_many(["0000000003", "isbn-x"])
+        self.library.save_snapshot(self.path)
+
+    def open(self, **kwargs) -> Library:
+        library = Library.open_snapshot(self.path, **kwargs)
+        self.addCleanup(library.books.close)
+        return library
+
+    def test_round_trip(self):
+        """Test that a snapshot opens with the same books, order and statuses."""
+        library = self.open()
+        self.assertIsInstance(library.books, SnapshotBooks)
+        self.assertEqual(len(library.books), len(self.books))
+        self.assertEqual(list(library.books), list(self.library.books))
+        self.assertEqual(list(library.books.values()), list(self.library.books.values()))
+        self.assertEqual(library.search_books("title 1"), self.library.search_books("title 1"))
+
+    def test_lookup_is_lazy(self):
+        """Test that looking up a book decodes only that book and does not build the search index."""
+        library = self.open()
+        self.assertEqual(library._get_book("isbn-x"), self.books[-1])
+        self.assertIn("0000000004", library.books)
+        self.assertNotIn("missing", library.books)
+        self.assertEqual(len(library.books._loaded), 1)
+        self.assertFalse(library._index.built)
+        with self.assertRaises(BookNotFoundError):
+            library.borrow_book("missing")
+
+    def test_overlay_and_compaction(self):
+        """Test that changes survive saving over the snapshot and reopening it."""
+        library = self.open()
+        held = library.books["0000000005"]
+        library.remove_books(["0000000001", "0000000002"])
+        library.add_book(Book("Returned", "Author 1", "0000000001"))
+        library.borrow_book("0000000005")
+        library.return_book("0000000003")
+        expected = list(library.books)
+        self.assertEqual(expected[-1], "0000000001")
+        self.assertEqual(library.search_books("returned")[0].isbn, "0000000001")
+
+        library.save_snapshot(self.path)
+        self.assertEqual(list(library.books), expected)
+        library.return_book("0000000005")
+        self.assertEqual(held.status, BookStatus.AVAILABLE)
+
+        reopened = self.open()
+        self.assertEqual(list(reopened.books), expected)
+        self.assertEqual(reopened.books["0000000005"].status, BookStatus.CHECKED_OUT)
+        self.assertEqual(reopened.books["0000000003"].status, BookStatus.AVAILABLE)
+        self.assertEqual(reopened.search_books("author 1")[-1].title, "Returned")
+
+    def test_invalid_files(self):
+        """Test that damaged, truncated or foreign files are rejected."""
+        with open(self.path, "rb") as file:
+            data = bytearray(file.read())
+        damaged = bytearray(data)
+        damaged[-1] ^= 1
+        future = bytearray(data)
+        future[8] = 2
+        for contents in (damaged, future, data[:-1], b"not a snapshot", b"", b"x" * HEADER.size):
+            with open(self.path, "wb") as file:
+                file.write(contents)
+            with self.assertRaises(SnapshotError):
+                Library.open_snapshot(self.path)
+        with open(self.path, "wb") as file:
+            file.write(damaged)
+        self.assertEqual(len(self.open(verify=False).books), len(self.books))
+
+class TestConcurrentLibraryManagement(TestLibraryManagement):
+    """Runs the Library tests against ConcurrentLibrary."""
+
+    def setUp(self):
+        super().setUp()
+        self.library = ConcurrentLibrary()
+
+class TestConcurrentBulkOperations(TestBulkOperations):
+    """Runs the bulk operation tests against ConcurrentLibrary."""
+
+    def setUp(self):
+        super().setUp()
+        self.library = ConcurrentLibrary(on_event=self.library.on_event)
+
+class YieldingBook(Book):
+    """A Book that lets other threads run whenever its status is read, so that check-then-set races show up."""
+    __slots__ = ()
+
+    @property
+    def status(self) -> BookStatus:
+        status = Book.status.__get__(self)
+        time.sleep(0)
+        return status
+
+    @status.setter
+    def status(self, status: BookStatus) -> None:
+        Book.status.__set__(self, status)
+
+class TestConcurrentLibrary(unittest.TestCase):
+
+    def setUp(self):
+        self.library = ConcurrentLibrary(stripes=8)
+        self.books = [YieldingBook(f"Book{i}", f"Author{i % 5}", f"{i:04d}") for i in range(50)]
+        self.library.add_books(self.books)
+
+    def run_threads(self, target, count: int = 8) -> None:
+        errors = []
+
+        def run(seed):
+            try:
+                target(random.Random(seed))
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=run, args=(seed,)) for seed in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_compare_and_set(self):
+        """Test that borrow_book and return_book report whether they changed the book."""
+        self.assertTrue(self.library.borrow_book("0001"))
+        self.assertFalse(self.library.borrow_book("0001"))
+        self.assertTrue(self.library.return_book("0001"))
+        self.assertFalse(self.library.return_book("0001"))
+        with self.assertRaises(BookNotFoundError):
+            self.library.borrow_book("missing")
+
+    def test_each_book_is_borrowed_once(self):
+        """Test that threads racing for the same books borrow each one exactly once."""
+        borrowed = []
+
+        def borrow_all(rng):
+            isbns = [book.isbn for book in self.books]
+            rng.shuffle(isbns)
+            borrowed.extend(isbn for isbn in isbns if self.library.borrow_book(isbn))
+
+        self.run_threads(borrow_all)
+        self.assertEqual(sorted(borrowed), sorted(book.isbn for book in self.books))
+
+    def test_no_double_borrows(self):
+        """Test that a book never has two borrowers while threads borrow and return at random."""
+        holders = {book.isbn: 0 for book in self.books}
+        holders_lock = threading.Lock()
+
+        def borrow_and_return(rng):
+            # A few books, so that threads keep competing for them
+            for _ in range(1000):
+                isbn = rng.choice(self.books[:4]).isbn
+                if self.library.borrow_book(isbn):
+                    with holders_lock:
+                        holders[isbn] += 1
+                        self.assertEqual(holders[isbn], 1, isbn)
+                    time.sleep(0)
+                    with holders_lock:
+                        holders[isbn] -= 1
+                    self.assertTrue(self.library.return_book(isbn))
+
+        self.run_threads(borrow_and_return)
+        self.assertTrue(all(book.status == BookStatus.AVAILABLE for book in self.books))
+
+    def test_changes_during_borrows(self):
+        """Test adding, removing, searching and bulk borrowing while other threads borrow."""
+        def work(rng):
+            for step in range(500):
+                isbn = f"{rng.randrange(80):04d}"
+                action = rng.random()
+                try:
+                    if action < 0.2:
+                        self.library.add_book(YieldingBook(f"Book{isbn}", "Someone", isbn))
+                    elif action < 0.3:
+                        self.library.remove_book(isbn)
+                    elif action < 0.4:
+                        self.library.search_books(f"book{isbn[-2:]}")
+                    elif action < 0.5:
+                        self.library.borrow_many([isbn, f"{rng.randrange(80):04d}"], atomic=False)
+                    elif action < 0.75:
+                        self.library.borrow_book(isbn)
+                    else:
+                        self.library.return_book(isbn)
+                except (BookNotFoundError, BookAlreadyExistsError):
+                    pass
+
+        self.run_threads(work)
+        self.library.clear_search_cache()
+        for book in self.library.books.values():
+            self.assertIn(book, self.library.search_books(book.title))
+
+    def test_async_facade(self):
+        """Test that concurrent coroutines borrowing one book succeed once."""
+        library = AsyncLibrary(self.library)
+
+        async def borrow_together():
+            return await asyncio.gather(*(library.borrow_book("0003") for _ in range(20)))
+
+        results = asyncio.run(borrow_together())
+        self.assertEqual(results.count(True), 1)
+        self.assertEqual(asyncio.run(library.get_book("0003")).status, BookStatus.CHECKED_OUT)
+        self.assertEqual(asyncio.run(library.search_books("book3")), [self.books[3]] + self.books[30:40])
+
+class TestSecondaryIndexes(unittest.TestCase):
+
+    def test_normalize_author(self):
+        """Test that author lookups ignore case and spacing."""
+        self.assertEqual(normalize_author("  F.  Scott\tFITZGERALD "), "f. scott fitzgerald")
+        self.assertEqual(normalize_author("STRASSE"), normalize_author("straße"))
+
+    def test_check_indexes_reports_direct_changes(self):
+        """Test that the consistency check finds a status changed behind the library's back."""
+        library = Library()
+        book = Book("Book", "Author", "1")
+        library.add_book(book)
+        book.status = BookStatus.CHECKED_OUT
+        self.assertEqual(library.check_indexes(), [
+            "Book with ISBN 1 is wrongly in the status index under 'Available'.",
+            "Book with ISBN 1 is missing from the status index under 'Checked out'.",
+        ])
+
+    def test_random_workloads(self):
+        """Test that the indexes match full scans after random changes, for every Library variant."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "library.snapshot")
+        seeded = Library()
+        seeded.add_books(Book(f"Title {i}", f"Author {i % 13}", f"{i:05d}") for i in range(300))
+        seeded.save_snapshot(path)
+        snapshot = Library.open_snapshot(path)
+        self.addCleanup(snapshot.books.close)
+        sqlite = SQLiteLibrary()
+        self.addCleanup(sqlite.close)
+
+        for library in (Library(), ColumnarLibrary(), ConcurrentLibrary(), sqlite, snapshot):
+            rng = random.Random(11)
+            for _ in range(3000):
+                isbn = f"{rng.randrange(400):05d}"
+                action = rng.random()
+                if action < 0.3:
+                    if isbn not in library.books:
+                        library.add_book(Book(f"Title {isbn}", f"AUTHOR  {int(isbn) % 13}", isbn))
+                elif action < 0.45:
+                    if isbn in library.books:
+                        library.remove_book(isbn)
+                elif action < 0.75:
+                    if isbn in library.books:
+                        library.borrow_book(isbn)
+                elif isbn in library.books:
+                    library.return_book(isbn)
+            books = list(library.books.values())
+            for status in BookStatus:
+                expected = [book.isbn for book in books if book.status == status]
+                self.assertEqual(library.count_by_status(status), len(expected))
+                self.assertEqual(sorted(book.isbn for book in library.books_by_status(status)), sorted(expected))
+            for author in ("author 3", "Author 12", "nobody"):
+                expected = [book.isbn for book in books if normalize_author(book.author) == author.lower()]
+                self.assertEqual([book.isbn for book in library.books_by_author(author)], expected)
+            self.assertEqual(library.check_indexes(), [])
+
+    def test_snapshot_builds_indexes_on_demand(self):
+        """Test that opening a snapshot does not read every book to build the status and author indexes."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "library.snapshot")
+        library = Library()
+        library.add_books(Book(f"Title {i}", f"Author {i % 3}", str(i)) for i in range(10))
+        library.borrow_many(["2", "5"])
+        library.save_snapshot(path)
+
+        opened = Library.open_snapshot(path)
+        self.addCleanup(opened.books.close)
+        opened.borrow_book("7")
+        self.assertFalse(opened._secondary.built)
+        self.assertEqual(opened.count_by_status(BookStatus.CHECKED_OUT), 3)
+        self.assertTrue(opened._secondary.built)
+        opened.return_book("2")
+        self.assertEqual([book.isbn for book in opened.books_by_status(BookStatus.CHECKED_OUT)], ["5", "7"])
+        self.assertEqual([book.isbn for book in opened.books_by_author("author 1")], ["1", "4", "7"])
+
+class TestTrigramIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = TrigramIndex()
+
+    def test_verifies_candidates(self):
+        """Test that sharing every trigram of the query is not a match."""
+        self.index.add("1", "abcxbcd")
+        self.index.add("2", "xabcdx")
+        self.assertEqual(self.index.search("ABCD"), ["2"])
+
+    def test_fields_are_searched_separately(self):
+        """Test that a match cannot span two fields."""
+        self.index.add("1", "Dune", "Frank Herbert")
+        self.assertEqual(self.index.search("dunefrank"), [])
+        self.assertEqual(self.index.search("herb"), ["1"])
+
+    def test_results_in_insertion_order(self):
+        """Test that results follow insertion order, also after re-adding a key."""
+        for key in ("1", "2", "3"):
+            self.index.add(key, "Book" + key)
+        self.index.remove("1")
+        self.index.add("1", "Book1")
+        self.assertEqual(self.index.search("book"), ["2", "3", "1"])
+        self.assertEqual(self.index.search("k1"), ["1"])
+
+    def test_compaction(self):
+        """Test that compacting the posting lists keeps the live entries."""
+        for i in range(3000):
+            self.index.add(i, f"Title {i}", f"Author {i % 7}")
+        for i in range(0, 3000, 3):
+            self.index.remove(i)
+        for i in range(1, 3000, 3):
+            self.index.remove(i)
+        self.assertEqual(len(self.index), 1000)
+        self.assertEqual(self.index.search("title 2"), [i for i in range(2, 3000, 3) if "title 2" in f"title {i}"])
+        self.assertEqual(self.index.search("author 3"), [i for i in range(2, 3000, 3) if i % 7 == 3])
+        with self.assertRaises(KeyError):
+            self.index.remove(0)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,216 @@
+# Trigram Index
+# A character-trigram inverted index for case-insensitive substring search over book titles and authors.
+
+from array import array
+from bisect import bisect_left
+from typing import Dict, Hashable, Iterable, List, Optional, Sequence, Set, Tuple
+
+# Rebuild the posting lists once this many removed entries are still in them
+COMPACT_MIN_DEAD = 1024
+# Stop intersecting once this few candidates are left; verifying them is cheaper
+VERIFY_CANDIDATES = 32
+# Intersect by scanning a posting list unless it is this many times longer than
+# the candidates, in which case each candidate is binary-searched in it instead
+SCAN_RATIO = 16
+
+
+def trigrams(text: str) -> Set[str]:
+    """
+    Returns the set of three-character substrings of a text.
+
+    Args:
+        text (str): Lowercased text.
+
+    Returns:
+        Set[str]: The distinct trigrams; empty if the text is shorter than three characters.
+    """
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _contains(postings: array, doc_id: int) -> bool:
+    """
+    Returns whether a sorted posting list contains a document id.
+    """
+    i = bisect_left(postings, doc_id)
+    return i < len(postings) and postings[i] == doc_id
+
+
+class TrigramIndex:
+    """
+    Maps the trigrams of each entry's fields to the entries containing them.
+
+    Every entry gets an increasing integer id, so the posting lists are
+    append-only sorted arrays and results come back in insertion order. A
+    query looks up the posting lists of its trigrams, intersects them from the
+    shortest one up and verifies the surviving candidates with a substring
+    test, since sharing all trigrams does not imply containing the query.
+    Queries shorter than three characters fall back to scanning the stored
+    lowercased fields.
+
+    Removed entries stay in the posting lists and are skipped until they
+    outnumber the live ones, when the lists are rebuilt.
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty index.
+        """
+        self._postings: Dict[str, array] = {}
+        self._ids: Dict[Hashable, int] = {}
+        # Indexed by id; None once the entry is removed
+        self._keys: List[Optional[Hashable]] = []
+        self._fields: List[Optional[Tuple[str, ...]]] = []
+        self._dead = 0
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._ids
+
+    def add(self, key: Hashable, *fields: str) -> None:
+        """
+        Indexes an entry.
+
+        Args:
+            key (Hashable): The entry's key, e.g. an ISBN.
+            *fields (str): The searchable texts, e.g. title and author.
+
+        Raises:
+            KeyError: If the key is already indexed.
+        """
+        if key in self._ids:
+            raise KeyError(key)
+        lowered = tuple(map(str.lower, fields))
+        doc_id = len(self._keys)
+        self._ids[key] = doc_id
+        self._keys.append(key)
+        self._fields.append(lowered)
+        self._post(doc_id, lowered)
+
+    def add_many(self, entries: Iterable[Sequence]) -> None:
+        """
+        Indexes several entries.
+
+        Args:
+            entries (Iterable[Sequence]): `(key, *fields)` tuples, like the arguments of `add`.
+
+        Raises:
+            KeyError: If a key is already indexed; the entries before it stay indexed.
+        """
+        ids, keys, all_fields, post = self._ids, self._keys, self._fields, self._post
+        for key, *fields in entries:
+            if key in ids:
+                raise KeyError(key)
+            lowered = tuple(map(str.lower, fields))
+            doc_id = len(keys)
+            ids[key] = doc_id
+            keys.append(key)
+            all_fields.append(lowered)
+            post(doc_id, lowered)
+
+    def _post(self, doc_id: int, fields: Tuple[str, ...]) -> None:
+        """
+        Appends a new id to the posting lists of its fields' trigrams.
+        """
+        grams = set()
+        for field in fields:
+            grams |= trigrams(field)
+        postings = self._postings
+        for gram in grams:
+            posting = postings.get(gram)
+            if posting is None:
+                postings[gram] = posting = array("I")
+            posting.append(doc_id)
+
+    def remove(self, key: Hashable) -> None:
+        """
+        Removes an entry.
+
+        Args:
+            key (Hashable): The entry's key.
+
+        Raises:
+            KeyError: If the key is not indexed.
+        """
+        self.remove_many((key,))
+
+    def remove_many(self, keys: Iterable[Hashable]) -> None:
+        """
+        Removes several entries, compacting the posting lists at most once.
+
+        Args:
+            keys (Iterable[Hashable]): The entries' keys.
+
+        Raises:
+            KeyError: If a key is not indexed; the entries before it stay removed.
+        """
+        try:
+            for key in keys:
+                doc_id = self._ids.pop(key)
+                self._keys[doc_id] = None
+                self._fields[doc_id] = None
+                self._dead += 1
+        finally:
+            if self._dead >= COMPACT_MIN_DEAD and self._dead > len(self._ids):
+                self.compact()
+
+    def compact(self) -> None:
+        """
+        Rebuilds the posting lists without the removed entries.
+        """
+        entries = [(key, fields) for key, fields in zip(self._keys, self._fields) if key is not None]
+        self._postings = {}
+        self._ids = {}
+        self._keys = [key for key, _ in entries]
+        self._fields = [fields for _, fields in entries]
+        self._dead = 0
+        for doc_id, (key, fields) in enumerate(entries):
+            self._ids[key] = doc_id
+            self._post(doc_id, fields)
+
+    def _candidates(self, term: str) -> Iterable[int]:
+        """
+        Returns the ids of the entries containing every trigram of a lowercased term.
+        """
+        posting_lists = []
+        for gram in trigrams(term):
+            posting = self._postings.get(gram)
+            if posting is None:
+                return ()
+            posting_lists.append(posting)
+        posting_lists.sort(key=len)
+        if len(posting_lists) == 1:
+            return posting_lists[0]
+        candidates = set(posting_lists[0])
+        for posting in posting_lists[1:]:
+            if len(candidates) <= VERIFY_CANDIDATES:
+                break
+            if len(posting) <= SCAN_RATIO * len(candidates):
+                candidates.intersection_update(posting)
+            else:
+                candidates = {doc_id for doc_id in candidates if _contains(posting, doc_id)}
+        return sorted(candidates)
+
+    def search(self, term: str) -> List[Hashable]:
+        """
+        Finds the entries with a field containing a term, ignoring case.
+
+        Args:
+            term (str): The substring to look for.
+
+        Returns:
+            List[Hashable]: The matching keys, in insertion order.
+        """
+        term = term.lower()
+        keys, all_fields = self._keys, self._fields
+        if len(term) < 3:
+            doc_ids: Iterable[int] = range(len(keys))
+        else:
+            doc_ids = self._candidates(term)
+        results = []
+        for doc_id in doc_ids:
+            fields = all_fields[doc_id]
+            if fields is not None and any(term in field for field in fields):
+                results.append(keys[doc_id])
+        return results
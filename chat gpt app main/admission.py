@@ -0,0 +1,256 @@
+"""
+Admission control for the chat proxy.
+
+A global limiter (and optional per-model limiters) bounds how many upstream
+streams run at once, with a bounded FIFO wait queue in front of it. A
+per-client token bucket, off unless RATE_LIMIT_PER_MINUTE is set, caps the
+request rate of each API key or IP.
+"""
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional
+
+from metrics import ADMISSION_ACTIVE, ADMISSION_QUEUE_DEPTH, ADMISSION_REJECTIONS
+
+MAX_CONCURRENT_STREAMS = int(os.getenv("MAX_CONCURRENT_STREAMS", "64"))
+MAX_QUEUED_REQUESTS = int(os.getenv("MAX_QUEUED_REQUESTS", "128"))
+QUEUE_TIMEOUT = float(os.getenv("QUEUE_TIMEOUT", "10"))
+# Per-model concurrency budgets, e.g. "gpt-3.5-turbo=32,anthropic:claude-3-haiku=8";
+# a budget applies to the backend the router picks for a request
+MODEL_CONCURRENCY = os.getenv("MODEL_CONCURRENCY", "")
+# Per-client token bucket; a rate of 0 (the default) disables rate limiting
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "0"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "20"))
+RATE_LIMIT_MAX_CLIENTS = int(os.getenv("RATE_LIMIT_MAX_CLIENTS", "100000"))
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request is not admitted.
+
+    Attributes:
+        status_code (int): 429 for rate limits, 503 for overload.
+        retry_after (int): Seconds the client should wait before retrying.
+    """
+
+    def __init__(self, status_code: int, detail: str, retry_after: float):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class ConcurrencyLimiter:
+    """
+    Bounds concurrent work with a FIFO wait queue of bounded length and a
+    bounded wait time.
+    """
+
+    def __init__(self, name: str, max_concurrent: int, max_queue: int = MAX_QUEUED_REQUESTS, queue_timeout: float = QUEUE_TIMEOUT):
+        """
+        Args:
+            name (str): Label used in metrics.
+            max_concurrent (int): Maximum number of holders at a time.
+            max_queue (int): Maximum number of waiting requests; more are rejected at once.
+            queue_timeout (float): Seconds a request may wait before it is rejected.
+        """
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._waiters: "deque[asyncio.Future]" = deque()
+        ADMISSION_ACTIVE.set(0, limiter=name)
+        ADMISSION_QUEUE_DEPTH.set(0, limiter=name)
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def _update_gauges(self) -> None:
+        ADMISSION_ACTIVE.set(self.active, limiter=self.name)
+        ADMISSION_QUEUE_DEPTH.set(len(self._waiters), limiter=self.name)
+
+    def _reject(self, reason: str, detail: str) -> AdmissionRejected:
+        ADMISSION_REJECTIONS.inc(limiter=self.name, reason=reason)
+        return AdmissionRejected(503, detail, self.queue_timeout / 2)
+
+    async def acquire(self) -> None:
+        """
+        Takes a slot, waiting in line if none is free.
+
+        Raises:
+            AdmissionRejected: If the queue is full or the wait times out.
+        """
+        if self.active < self.max_concurrent and not self._waiters:
+            self.active += 1
+            self._update_gauges()
+            return
+        if len(self._waiters) >= self.max_queue:
+            raise self._reject("queue_full", f"Too many queued requests for {self.name}.")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._update_gauges()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as we gave up: pass it on
+                self.release()
+            else:
+                waiter.cancel()
+                self._waiters.remove(waiter)
+            self._update_gauges()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            raise self._reject("queue_timeout", f"Timed out waiting for a {self.name} slot.") from None
+        self._update_gauges()
+
+    def release(self) -> None:
+        """Frees a slot, handing it directly to the oldest waiter if there is one."""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self._update_gauges()
+                return
+        self.active -= 1
+        self._update_gauges()
+
+
+class RateLimiter:
+    """
+    Per-client token buckets, with the least recently seen clients forgotten
+    beyond `max_clients`.
+    """
+
+    def __init__(self, rate_per_minute: float = RATE_LIMIT_PER_MINUTE, burst: int = RATE_LIMIT_BURST, max_clients: int = RATE_LIMIT_MAX_CLIENTS):
+        """
+        Args:
+            rate_per_minute (float): Sustained requests per minute per client; 0 disables limiting.
+            burst (int): Bucket size, i.e. requests a client may make back to back.
+            max_clients (int): Maximum number of buckets kept.
+        """
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()
+
+    def check(self, client_key: str) -> None:
+        """
+        Takes one token from the client's bucket.
+
+        Raises:
+            AdmissionRejected: With status 429 if the bucket is empty.
+        """
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        bucket = self._buckets.get(client_key)
+        if bucket is None:
+            bucket = self._buckets[client_key] = [float(self.burst), now]
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(client_key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            ADMISSION_REJECTIONS.inc(limiter="client_rate", reason="rate_limited")
+            raise AdmissionRejected(429, "Rate limit exceeded.", (1 - bucket[0]) / self.rate)
+        bucket[0] -= 1
+
+
+def parse_model_budgets(spec: str) -> Dict[str, int]:
+    """
+    Parses a "model=limit,model=limit" budget specification.
+    """
+    budgets = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        model, _, limit = item.partition("=")
+        budgets[model.strip()] = int(limit)
+    return budgets
+
+
+class AdmissionController:
+    """
+    Combines the per-client rate limit, the global concurrency limit and the
+    per-model concurrency budgets.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = MAX_CONCURRENT_STREAMS,
+        max_queue: int = MAX_QUEUED_REQUESTS,
+        queue_timeout: float = QUEUE_TIMEOUT,
+        model_budgets: Optional[Dict[str, int]] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+    ):
+        if model_budgets is None:
+            model_budgets = parse_model_budgets(MODEL_CONCURRENCY)
+        self.global_limiter = ConcurrencyLimiter("global", max_concurrent, max_queue, queue_timeout)
+        self.model_limiters = {
+            model: ConcurrencyLimiter(f"model:{model}", limit, max_queue, queue_timeout)
+            for model, limit in model_budgets.items()
+        }
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+
+    def check_rate(self, client_key: str) -> None:
+        """Applies the per-client rate limit. Raises AdmissionRejected (429)."""
+        self.rate_limiter.check(client_key)
+
+    async def admit(self, model: Optional[str] = None):
+        """
+        Waits for a global slot and, if a model with a budget is given, a model slot.
+
+        Returns:
+            callable: Releases the slots. Safe to call more than once.
+
+        Raises:
+            AdmissionRejected: If either limiter rejects the request (503).
+        """
+        limiters = [self.global_limiter]
+        if model in self.model_limiters:
+            limiters.append(self.model_limiters[model])
+        return await self._acquire_all(limiters)
+
+    async def admit_backend(self, backend):
+        """
+        Waits for a slot in the budget of a backend chosen by the router, if
+        it has one: the budget of its "provider:model" name, else of its model.
+
+        Returns:
+            callable: Releases the slot. Safe to call more than once.
+
+        Raises:
+            AdmissionRejected: If the backend's limiter rejects the request (503).
+        """
+        limiter = self.model_limiters.get(backend.name) or self.model_limiters.get(backend.model)
+        return await self._acquire_all([limiter] if limiter is not None else [])
+
+    async def _acquire_all(self, limiters: List[ConcurrencyLimiter]):
+        acquired = []
+        try:
+            for limiter in limiters:
+                await limiter.acquire()
+                acquired.append(limiter)
+        except BaseException:
+            for limiter in reversed(acquired):
+                limiter.release()
+            raise
+
+        released = False
+
+        def release():
+            nonlocal released
+            if released:
+                return
+            released = True
+            for limiter in reversed(acquired):
+                limiter.release()
+
+        return release
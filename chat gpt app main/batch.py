@@ -0,0 +1,60 @@
+"""
+Bounded fan-out for /chat/batch.
+
+A fixed number of workers pull items in order and push results to a queue,
+so results come back in completion order while at most `concurrency` items
+are in progress, however long the batch is.
+"""
+import asyncio
+import os
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional, Sequence, Tuple
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "32"))
+
+
+async def fan_out(
+    items: Sequence[Any],
+    handler: Callable[[int, Any], Awaitable[Any]],
+    concurrency: int = BATCH_CONCURRENCY,
+) -> AsyncIterator[Tuple[int, Any, Optional[Exception]]]:
+    """
+    Runs `handler(index, item)` for every item with bounded concurrency.
+
+    A failing item does not stop the others: its exception is yielded in
+    place of a result. Closing the iterator early cancels the items still
+    in progress.
+
+    Args:
+        items (list): The batch.
+        handler (callable): Async function processing one item.
+        concurrency (int): Maximum number of items in progress at once.
+
+    Yields:
+        tuple: `(index, result, None)` or `(index, None, exception)`, in completion order.
+    """
+    results: asyncio.Queue = asyncio.Queue()
+    next_index = 0
+
+    async def worker():
+        nonlocal next_index
+        while next_index < len(items):
+            index = next_index
+            next_index += 1
+            try:
+                result = await handler(index, items[index])
+            except Exception as e:
+                await results.put((index, None, e))
+            else:
+                await results.put((index, result, None))
+
+    loop = asyncio.get_running_loop()
+    workers = [loop.create_task(worker()) for _ in range(max(1, min(concurrency, len(items))))]
+    try:
+        for _ in range(len(items)):
+            yield await results.get()
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
@@ -0,0 +1,294 @@
+"""
+Benchmarks for the chat proxy, run against the local mock upstream.
+
+Usage:
+    python benchmark_chat.py client [--requests N] [--concurrency C] [--certfile CERT --keyfile KEY]
+    python benchmark_chat.py streaming [--tokens N] [--token-interval S]
+    python benchmark_chat.py index [--requests N]
+    python benchmark_chat.py startup [--workers W] [--runs N]
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from mock_upstream import completion_chunk, serve_in_thread, stop_server
+from streaming import coalesce, parse_delta, sse_event
+from upstream import create_upstream_client
+
+PAYLOAD = {
+    "model": "gpt-3.5-turbo",
+    "messages": [{"role": "user", "content": "Hello"}],
+    "stream": True,
+}
+
+
+def _summary(name: str, ttfts: list, elapsed: float) -> None:
+    ttfts_ms = sorted(t * 1000 for t in ttfts)
+    p95 = ttfts_ms[int(0.95 * (len(ttfts_ms) - 1))]
+    print(
+        f"{name:<22} requests={len(ttfts_ms):<5} "
+        f"ttft_mean={statistics.mean(ttfts_ms):7.2f}ms "
+        f"ttft_p50={statistics.median(ttfts_ms):7.2f}ms "
+        f"ttft_p95={p95:7.2f}ms "
+        f"total={elapsed:6.2f}s"
+    )
+
+
+async def _stream_once(client: httpx.AsyncClient, url: str) -> float:
+    start = time.perf_counter()
+    ttft = None
+    async with client.stream("POST", url, json=PAYLOAD) as response:
+        async for line in response.aiter_lines():
+            if ttft is None and line.startswith("data: "):
+                ttft = time.perf_counter() - start
+    return ttft
+
+
+async def _run_client_benchmark(url: str, requests: int, concurrency: int, verify: bool) -> None:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    # Baseline: a fresh client (and connection) per request, as main.py used to do
+    async def per_request():
+        async with semaphore:
+            async with httpx.AsyncClient(timeout=None, verify=verify) as client:
+                return await _stream_once(client, url)
+
+    start = time.perf_counter()
+    ttfts = await asyncio.gather(*(per_request() for _ in range(requests)))
+    _summary("client-per-request", ttfts, time.perf_counter() - start)
+
+    # Shared pooled client, as created by the application lifespan hook
+    client = create_upstream_client(verify=verify)
+    try:
+        async def shared():
+            async with semaphore:
+                return await _stream_once(client, url)
+
+        await shared()  # Warm the pool so the steady state is measured
+        start = time.perf_counter()
+        ttfts = await asyncio.gather(*(shared() for _ in range(requests)))
+        _summary("shared-pooled-client", ttfts, time.perf_counter() - start)
+    finally:
+        await client.aclose()
+
+
+def bench_client(args) -> None:
+    ssl_options = {}
+    if args.certfile:
+        ssl_options = {"ssl_certfile": args.certfile, "ssl_keyfile": args.keyfile}
+    server, base_url = serve_in_thread(**ssl_options)
+    try:
+        url = f"{base_url}/v1/chat/completions"
+        print(f"Mock upstream at {url}")
+        asyncio.run(_run_client_benchmark(url, args.requests, args.concurrency, verify=False))
+    finally:
+        stop_server(server)
+
+
+def _sse_lines(tokens: int) -> list:
+    lines = [completion_chunk("gpt-3.5-turbo", {"role": "assistant"})]
+    lines += [completion_chunk("gpt-3.5-turbo", {"content": f"tok{i} "}) for i in range(tokens)]
+    lines += [completion_chunk("gpt-3.5-turbo", {}, finish_reason="stop"), "data: [DONE]\n\n"]
+    return [line.strip() for line in lines]
+
+
+def _parse_before(lines: list) -> list:
+    # The original per-line loop: json.loads and two debug prints per chunk
+    deltas = []
+    for line in lines:
+        if line.startswith("data: "):
+            data = line[6:]
+            if data.strip() == "[DONE]":
+                break
+            print("Received data chunk from OpenAI:", data)
+            chunk = json.loads(data)
+            content = chunk['choices'][0]['delta'].get('content', '')
+            if content:
+                print("Streaming content:", content)
+                deltas.append(content)
+    return deltas
+
+
+def _parse_after(lines: list) -> list:
+    deltas = []
+    for line in lines:
+        if line.startswith("data: "):
+            data = line[6:]
+            if data == "[DONE]":
+                break
+            content = parse_delta(data)
+            if content:
+                deltas.append(content)
+    return deltas
+
+
+async def _count_writes(tokens: int, interval: float, coalesced: bool) -> int:
+    # Every yielded chunk becomes one ASGI body message, i.e. one socket write
+    async def upstream():
+        for i in range(tokens):
+            yield f"tok{i} "
+            await asyncio.sleep(interval)
+
+    source = coalesce(upstream()) if coalesced else upstream()
+    writes = 0
+    async for text in source:
+        sse_event(text)
+        writes += 1
+    return writes
+
+
+def bench_streaming(args) -> None:
+    lines = _sse_lines(args.tokens)
+    rounds = max(1, 200000 // len(lines))
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            _parse_before(lines)
+        before = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(rounds):
+        _parse_after(lines)
+    after = time.perf_counter() - start
+
+    chunks = rounds * len(lines)
+    print(f"parse before: {chunks / before:12,.0f} chunks/sec")
+    print(f"parse after:  {chunks / after:12,.0f} chunks/sec ({before / after:.1f}x)")
+
+    writes_before = asyncio.run(_count_writes(args.tokens, args.token_interval, coalesced=False))
+    writes_after = asyncio.run(_count_writes(args.tokens, args.token_interval, coalesced=True))
+    print(
+        f"writes per {args.tokens}-token response at {args.token_interval * 1000:.0f}ms/token: "
+        f"before={writes_before} after={writes_after}"
+    )
+
+
+async def _time_index(app, requests: int) -> float:
+    # Calls the ASGI app directly so only the server-side cost is measured
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": "/", "raw_path": b"/", "query_string": b"", "root_path": "",
+        "headers": [(b"host", b"bench"), (b"accept-encoding", b"gzip")],
+        "client": ("127.0.0.1", 1), "server": ("bench", 80),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    await app(dict(scope), receive, send)
+    start = time.perf_counter()
+    for _ in range(requests):
+        await app(dict(scope), receive, send)
+    return (time.perf_counter() - start) / requests
+
+
+def bench_index(args) -> None:
+    from starlette.applications import Starlette
+    from starlette.routing import Route
+    from starlette.templating import Jinja2Templates
+    from static_assets import RenderedPage
+
+    directory = tempfile.mkdtemp()
+    with open(os.path.join(directory, "index.html"), "w") as f:
+        f.write("<!DOCTYPE html><html><head><title>Chat</title></head><body>"
+                + "<div class='message'>placeholder</div>" * 200 + "</body></html>")
+    templates = Jinja2Templates(directory=directory)
+    page = RenderedPage(templates, "index.html")
+    async def render_per_request(request):
+        return templates.TemplateResponse(request, "index.html")
+
+    async def render_once(request):
+        return page.response(request)
+
+    per_request = Starlette(routes=[Route("/", render_per_request)])
+    rendered_once = Starlette(routes=[Route("/", render_once)])
+
+    before = asyncio.run(_time_index(per_request, args.requests))
+    after = asyncio.run(_time_index(rendered_once, args.requests))
+    page.render()
+    print(f"GET / per request: template={before * 1e6:.1f}us rendered_once={after * 1e6:.1f}us "
+          f"bytes: identity={len(page.bodies['identity'])} gzip={len(page.bodies['gzip'])}")
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _time_startup(extra_args: list, timeout: float = 60.0) -> float:
+    # Seconds from process start until GET / answers
+    port = _free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "main.py", "--host", "127.0.0.1", "--port", str(port), *extra_args],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"main.py exited with status {process.returncode}")
+            with contextlib.suppress(httpx.HTTPError):
+                if httpx.get(f"http://127.0.0.1:{port}/", timeout=1).status_code == 200:
+                    return time.perf_counter() - start
+            time.sleep(0.02)
+        raise RuntimeError("server did not start in time")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def bench_startup(args) -> None:
+    modes = [("reload", ["--reload"]), ("production x1", ["--workers", "1"])]
+    if args.workers > 1:
+        modes.append((f"production x{args.workers}", ["--workers", str(args.workers)]))
+    for name, extra_args in modes:
+        times = [_time_startup(extra_args) for _ in range(args.runs)]
+        print(f"{name:<16} startup_mean={statistics.mean(times):.2f}s min={min(times):.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    client_parser = subparsers.add_parser("client", help="Per-request vs shared pooled upstream client")
+    client_parser.add_argument("--requests", type=int, default=200)
+    client_parser.add_argument("--concurrency", type=int, default=1)
+    client_parser.add_argument("--certfile", help="Serve the mock over TLS to include the TLS handshake")
+    client_parser.add_argument("--keyfile")
+    client_parser.set_defaults(func=bench_client)
+
+    streaming_parser = subparsers.add_parser("streaming", help="Chunk parsing rate and writes per response")
+    streaming_parser.add_argument("--tokens", type=int, default=300)
+    streaming_parser.add_argument("--token-interval", type=float, default=0.005)
+    streaming_parser.set_defaults(func=bench_streaming)
+
+    index_parser = subparsers.add_parser("index", help="Per-request overhead of GET /")
+    index_parser.add_argument("--requests", type=int, default=2000)
+    index_parser.set_defaults(func=bench_index)
+
+    startup_parser = subparsers.add_parser("startup", help="Time until the app answers GET / (needs static/index.html)")
+    startup_parser.add_argument("--workers", type=int, default=2)
+    startup_parser.add_argument("--runs", type=int, default=3)
+    startup_parser.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Response cache for repeated chat prompts.
+
+Completed streams are stored as their list of content deltas and replayed
+chunk by chunk, so a cache hit looks like a (much faster) upstream stream.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, List, Optional
+
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "300"))
+
+# Message fields that affect the completion; anything else is ignored in the key
+_KEY_FIELDS = ("role", "name", "content")
+
+
+def payload_key(model: str, messages: List[dict]) -> str:
+    """
+    Returns a normalized hash of the final upstream payload.
+
+    Messages are reduced to the fields the model sees and serialized as
+    canonical JSON, so key order and extra client-side fields do not matter.
+    """
+    normalized = [{field: message[field] for field in _KEY_FIELDS if field in message} for message in messages]
+    canonical = json.dumps(
+        {"model": model, "messages": normalized},
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class _Entry:
+    __slots__ = ("chunks", "size", "expires_at")
+
+    def __init__(self, chunks: List[str], size: int, expires_at: float):
+        self.chunks = chunks
+        self.size = size
+        self.expires_at = expires_at
+
+
+class ResponseCache:
+    """
+    LRU cache of completed responses bounded by entry count, total size and TTL.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        max_bytes: int = RESPONSE_CACHE_MAX_BYTES,
+        ttl: float = RESPONSE_CACHE_TTL,
+    ):
+        """
+        Args:
+            max_entries (int): Maximum number of cached responses.
+            max_bytes (int): Maximum total size of the cached content in bytes.
+            ttl (float): Seconds a response stays valid after it was stored.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[List[str]]:
+        """
+        Returns the cached chunks for a key, or None on a miss.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at < time.monotonic():
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry.chunks
+
+    def put(self, key: str, chunks: List[str]) -> None:
+        """
+        Stores the chunks of a completed response, evicting least recently used
+        entries as needed. Responses larger than the whole cache are not stored.
+        """
+        size = sum(len(chunk) for chunk in chunks)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = _Entry(chunks, size, time.monotonic() + self.ttl)
+        self.total_bytes += size
+        while len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        self.total_bytes -= self._entries.pop(key).size
+
+    def stats(self) -> dict:
+        """Returns hit/miss counters and current occupancy."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+        }
+
+
+async def replay(chunks: List[str]) -> AsyncIterator[str]:
+    """
+    Yields cached chunks one by one, giving other tasks a turn between chunks
+    just like a live upstream stream would.
+    """
+    for chunk in chunks:
+        yield chunk
+        await asyncio.sleep(0)
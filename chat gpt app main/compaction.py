@@ -0,0 +1,206 @@
+"""
+Context compaction with a rolling summary.
+
+Instead of silently dropping the history that no longer fits the context
+budget, the dropped turns are replaced by a summary message. Summaries are
+written in the background, off the request path, and cached by a hash of the
+conversation prefix they cover. A later turn that drops more history reuses
+the longest cached summary and only summarizes the newly dropped turns on
+top of it. Until a summary is ready the request falls back to plain trimming.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional
+
+from tokens import TokenCounter, TrimResult
+
+logger = logging.getLogger(__name__)
+
+# "summary" enables compaction; anything else keeps drop-oldest trimming
+CONTEXT_COMPACTION = os.getenv("CONTEXT_COMPACTION", "truncate").lower()
+SUMMARY_CACHE_SIZE = int(os.getenv("SUMMARY_CACHE_SIZE", "10000"))
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "4"))
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+SUMMARY_INSTRUCTIONS = (
+    "You maintain a running summary of a conversation between a user and an assistant. "
+    "Update the summary with the new messages. Keep every fact, name, number, decision "
+    "and open question the assistant may need later. Answer with the summary only."
+)
+
+Summarizer = Callable[[Optional[str], List[dict]], Awaitable[str]]
+
+
+class Summary(NamedTuple):
+    """A cached summary and the prompt tokens of its summary message."""
+    text: str
+    tokens: int
+
+
+def prefix_hashes(messages: List[dict]) -> List[bytes]:
+    """
+    Returns a rolling hash for every prefix: entry i identifies messages[:i + 1].
+    """
+    hashes = []
+    digest = b""
+    for message in messages:
+        h = hashlib.blake2b(digest, digest_size=16)
+        h.update(str(message.get("role", "")).encode("utf-8"))
+        h.update(b"\0")
+        h.update(str(message.get("content", "")).encode("utf-8"))
+        digest = h.digest()
+        hashes.append(digest)
+    return hashes
+
+
+def summary_prompt(previous: Optional[str], messages: List[dict]) -> List[dict]:
+    """
+    Builds the messages asking the model to fold `messages` into `previous`.
+    """
+    transcript = "\n".join(f"{message.get('role')}: {message.get('content')}" for message in messages)
+    text = f"Summary so far:\n{previous}\n\n" if previous else ""
+    return [
+        {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+        {"role": "user", "content": f"{text}New messages:\n{transcript}"},
+    ]
+
+
+async def summarize_with_router(router, admission, previous: Optional[str], messages: List[dict]) -> str:
+    """
+    Writes a summary with the best available backend, like any other request.
+
+    Args:
+        router (BackendRouter): Picks the backend.
+        admission (AdmissionController): The summary holds an upstream slot while it streams.
+        previous (str, optional): Summary of the turns before `messages`.
+        messages (list): Turns to fold into the summary.
+
+    Returns:
+        str: The updated summary.
+    """
+    release = await admission.admit()
+    try:
+        summary = router.stream(summary_prompt(previous, messages), admit=admission.admit_backend)
+        return "".join([content async for content in summary]).strip()
+    finally:
+        release()
+
+
+class Compactor:
+    """
+    Fits conversations into a token budget, replacing dropped turns with a
+    cached rolling summary.
+    """
+
+    def __init__(self, token_counter: TokenCounter, summarize: Summarizer, max_entries: int = SUMMARY_CACHE_SIZE, concurrency: int = SUMMARY_CONCURRENCY):
+        """
+        Args:
+            token_counter (TokenCounter): Counts and trims prompts.
+            summarize (callable): `async summarize(previous, messages) -> str`.
+            max_entries (int): Maximum number of cached summaries (LRU eviction).
+            concurrency (int): Summaries written at once.
+        """
+        self.token_counter = token_counter
+        self.summarize = summarize
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.summaries_written = 0
+        self.failures = 0
+        self._summaries: "OrderedDict[bytes, Summary]" = OrderedDict()
+        self._pending: Dict[bytes, asyncio.Task] = {}
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def _lookup(self, hashes: List[bytes], longest: int):
+        # The longest cached summary of a prefix of at most `longest` history messages
+        for length in range(longest, 0, -1):
+            summary = self._summaries.get(hashes[length - 1])
+            if summary is not None:
+                self._summaries.move_to_end(hashes[length - 1])
+                return length, summary
+        return 0, None
+
+    def _schedule(self, history: List[dict], hashes: List[bytes], covered: int, previous: Optional[Summary], target: int) -> None:
+        # Summarizes history[:target] in the background, on top of the summary of history[:covered]
+        key = hashes[target - 1]
+        if key in self._summaries or key in self._pending:
+            return
+        turns = history[covered:target]
+        task = asyncio.get_running_loop().create_task(self._write(key, previous.text if previous else None, turns))
+        self._pending[key] = task
+
+    async def _write(self, key: bytes, previous: Optional[str], turns: List[dict]) -> None:
+        try:
+            async with self._semaphore:
+                text = await self.summarize(previous, turns)
+            message = {"role": "system", "content": SUMMARY_PREFIX + text}
+            self._summaries[key] = Summary(text, self.token_counter.count_message(message))
+            if len(self._summaries) > self.max_entries:
+                self._summaries.popitem(last=False)
+            self.summaries_written += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failures += 1
+            logger.warning("Could not summarize %d messages: %s", len(turns), e)
+        finally:
+            self._pending.pop(key, None)
+
+    async def compact(self, messages: List[dict], max_tokens: int, counts: Optional[List[int]] = None) -> TrimResult:
+        """
+        Fits a conversation into `max_tokens`.
+
+        Args:
+            messages (list): System message, history and the new user message.
+            max_tokens (int): Prompt token budget.
+            counts (list, optional): Precomputed per-message token counts.
+
+        Returns:
+            TrimResult: Like `TokenCounter.trim`; when a summary is used it is
+            the second message and `trimmed_messages` counts the history
+            messages it replaces or that were dropped.
+        """
+        if counts is None:
+            counts = await self.token_counter.count_each_async(messages)
+        trimmed = self.token_counter.trim(messages, max_tokens, counts)
+        if not trimmed.trimmed_messages:
+            return trimmed
+
+        history = messages[1:-1]
+        hashes = prefix_hashes(history)
+        covered, summary = self._lookup(hashes, trimmed.trimmed_messages)
+        if summary is None:
+            # Nothing summarized yet: trim now, summarize for the next turn
+            self.misses += 1
+            self._schedule(history, hashes, 0, None, trimmed.trimmed_messages)
+            return trimmed
+
+        self.hits += 1
+        summary_message = {"role": "system", "content": SUMMARY_PREFIX + summary.text}
+        rest = [messages[0], *history[covered:], messages[-1]]
+        rest_counts = [counts[0], *counts[1 + covered:-1], counts[-1]]
+        inner = self.token_counter.trim(rest, max_tokens - summary.tokens, rest_counts)
+        dropped = covered + inner.trimmed_messages
+        if dropped > covered:
+            # Fold the turns dropped beyond the summary into it for later turns
+            self._schedule(history, hashes, covered, summary, dropped)
+        return TrimResult(
+            [messages[0], summary_message, *inner.messages[1:]],
+            [counts[0], summary.tokens, *inner.counts[1:]],
+            inner.token_count + summary.tokens,
+            dropped,
+            sum(counts[1:1 + dropped]),
+        )
+
+    async def drain(self) -> None:
+        """Waits for the summaries being written."""
+        while self._pending:
+            await asyncio.gather(*list(self._pending.values()), return_exceptions=True)
+
+    def close(self) -> None:
+        """Cancels the summaries being written."""
+        for task in self._pending.values():
+            task.cancel()
@@ -0,0 +1,209 @@
+"""
+Async load generator for the chat app.
+
+Drives POST /chat at a fixed concurrency and writes a JSON report with
+time-to-first-token percentiles, throughput and error rates. Thresholds turn
+the report into a regression gate: the exit code is 1 if any is exceeded.
+
+By default every prompt is unique and sent with Cache-Control: no-store, so
+each request reaches the upstream. --same-message and --use-cache measure
+the response cache and single-flight instead.
+
+Usage:
+    python mock_upstream.py --port 8001 --tokens 50 --token-rate 100 &
+    UPSTREAM_BASE_URL=http://127.0.0.1:8001/v1 uvicorn main:app --port 8000 &
+    python loadtest.py --url http://127.0.0.1:8000 --concurrency 50 --requests 2000 \\
+        --output report.json --max-p95-ttft-ms 250 --max-error-rate 0.01
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from collections import Counter
+from typing import List, Optional
+
+import httpx
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """
+    Returns the q-th percentile (0-100) of values by linear interpolation,
+    or None for an empty list.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def _distribution(values: List[float]) -> dict:
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+async def _one_request(client: httpx.AsyncClient, url: str, body: dict, headers: dict) -> dict:
+    start = time.perf_counter()
+    result = {"status": None, "ttft": None, "latency": None, "bytes": 0, "error": None}
+    try:
+        async with client.stream("POST", url, json=body, headers=headers) as response:
+            result["status"] = response.status_code
+            async for chunk in response.aiter_bytes():
+                if result["ttft"] is None and chunk:
+                    result["ttft"] = time.perf_counter() - start
+                result["bytes"] += len(chunk)
+        if result["status"] != 200:
+            result["error"] = f"HTTP {result['status']}"
+        elif not result["bytes"]:
+            result["error"] = "empty stream"
+    except httpx.HTTPError as e:
+        result["error"] = type(e).__name__
+    result["latency"] = time.perf_counter() - start
+    return result
+
+
+async def run_load(
+    base_url: str,
+    concurrency: int,
+    requests: Optional[int] = None,
+    duration: Optional[float] = None,
+    message: str = "Hello",
+    unique: bool = True,
+    no_cache: bool = True,
+    timeout: float = 60.0,
+) -> dict:
+    """
+    Runs a closed-loop load test: `concurrency` workers each send requests
+    back to back until `requests` have been sent or `duration` has elapsed.
+
+    Args:
+        base_url (str): Base URL of the chat app.
+        concurrency (int): Number of concurrent workers.
+        requests (int, optional): Total number of requests to send.
+        duration (float, optional): Seconds to run for.
+        message (str): Message sent in every request.
+        unique (bool): Append a counter to each message so no two prompts are identical.
+        no_cache (bool): Send Cache-Control: no-store to bypass the response cache.
+        timeout (float): Per-request read timeout in seconds.
+
+    Returns:
+        dict: The report.
+    """
+    url = base_url.rstrip("/") + "/chat"
+    headers = {"Cache-Control": "no-store"} if no_cache else {}
+    results = []
+    sent = 0
+    deadline = time.perf_counter() + duration if duration else None
+
+    def next_request() -> Optional[int]:
+        nonlocal sent
+        if requests is not None and sent >= requests:
+            return None
+        if deadline is not None and time.perf_counter() >= deadline:
+            return None
+        sent += 1
+        return sent
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(10.0, read=timeout)) as client:
+        async def worker():
+            while (number := next_request()) is not None:
+                text = f"{message} #{number}" if unique else message
+                results.append(await _one_request(client, url, {"message": text, "conversation_history": []}, headers))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    ok = [r for r in results if r["error"] is None]
+    ttfts_ms = [r["ttft"] * 1000 for r in ok if r["ttft"] is not None]
+    latencies_ms = [r["latency"] * 1000 for r in ok]
+    return {
+        "config": {
+            "url": url,
+            "concurrency": concurrency,
+            "requests": requests,
+            "duration": duration,
+            "unique": unique,
+            "no_cache": no_cache,
+        },
+        "requests": len(results),
+        "succeeded": len(ok),
+        "errors": len(results) - len(ok),
+        "error_rate": (len(results) - len(ok)) / len(results) if results else 0.0,
+        "elapsed_s": elapsed,
+        "throughput_rps": len(ok) / elapsed if elapsed else 0.0,
+        "throughput_bytes_per_s": sum(r["bytes"] for r in ok) / elapsed if elapsed else 0.0,
+        "ttft_ms": _distribution(ttfts_ms),
+        "latency_ms": _distribution(latencies_ms),
+        "status_codes": dict(Counter(str(r["status"]) for r in results)),
+        "error_kinds": dict(Counter(r["error"] for r in results if r["error"])),
+    }
+
+
+def check_thresholds(report: dict, max_p95_ttft_ms=None, max_p99_ttft_ms=None, max_error_rate=None, min_throughput_rps=None) -> List[str]:
+    """
+    Compares a report with regression thresholds.
+
+    Returns:
+        list: A description of every violated threshold (empty if all pass).
+    """
+    failures = []
+    p95 = report["ttft_ms"]["p95"]
+    p99 = report["ttft_ms"]["p99"]
+    if max_p95_ttft_ms is not None and (p95 is None or p95 > max_p95_ttft_ms):
+        failures.append(f"p95 TTFT {p95} ms > {max_p95_ttft_ms} ms")
+    if max_p99_ttft_ms is not None and (p99 is None or p99 > max_p99_ttft_ms):
+        failures.append(f"p99 TTFT {p99} ms > {max_p99_ttft_ms} ms")
+    if max_error_rate is not None and report["error_rate"] > max_error_rate:
+        failures.append(f"error rate {report['error_rate']:.4f} > {max_error_rate}")
+    if min_throughput_rps is not None and report["throughput_rps"] < min_throughput_rps:
+        failures.append(f"throughput {report['throughput_rps']:.1f} rps < {min_throughput_rps} rps")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Base URL of the chat app")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--requests", type=int, help="Total requests (default 100 unless --duration is given)")
+    parser.add_argument("--duration", type=float, help="Seconds to run for")
+    parser.add_argument("--message", default="Hello")
+    parser.add_argument("--same-message", dest="unique", action="store_false", help="Send the same prompt every time")
+    parser.add_argument("--use-cache", dest="no_cache", action="store_false", help="Let the response cache answer")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    parser.add_argument("--max-p95-ttft-ms", type=float)
+    parser.add_argument("--max-p99-ttft-ms", type=float)
+    parser.add_argument("--max-error-rate", type=float)
+    parser.add_argument("--min-throughput-rps", type=float)
+    args = parser.parse_args()
+
+    requests = args.requests if args.requests is not None or args.duration else 100
+    report = asyncio.run(run_load(
+        args.url, args.concurrency, requests, args.duration, args.message, args.unique, args.no_cache, args.timeout
+    ))
+    failures = check_thresholds(
+        report, args.max_p95_ttft_ms, args.max_p99_ttft_ms, args.max_error_rate, args.min_throughput_rps
+    )
+    report["threshold_failures"] = failures
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    if failures:
+        print("FAILED: " + "; ".join(failures), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,119 @@
 import asyncio
+import logging
 import os
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import StreamingResponse, HTMLResponse
-from fastapi.staticfiles import StaticFiles
+import time
+from contextlib import aclosing, asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, HTMLResponse, PlainTextResponse
+from starlette.background import BackgroundTask
+from starlette.requests import HTTPConnection
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
+from typing import List, Optional
 import openai
 import tiktoken
 from dotenv import load_dotenv
 import json  # Correct import for JSON parsing
-import httpx
 
 # Load environment variables from .env file
 load_dotenv()
 
-app = FastAPI()
+# Debug output is level-gated; messages are only formatted when enabled
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+# httpx and httpcore log every upstream request at INFO; the metrics count them instead
+for name in ("httpx", "httpcore"):
+    logging.getLogger(name).setLevel(logging.WARNING)
 
-# Serve static files
-app.mount("/static", StaticFiles(directory="static"), name="static")
+import metrics
+from admission import AdmissionController, AdmissionRejected
+from batch import BATCH_CONCURRENCY, BATCH_MAX_CONCURRENCY, BATCH_MAX_ITEMS, fan_out
+from cache import ResponseCache, payload_key, replay
+from compaction import CONTEXT_COMPACTION, Compactor, summarize_with_router
+from server import WEB_CONCURRENCY, server_options
+from sessions import create_session_store
+from providers import CHAT_BACKENDS, BackendRouter, NoBackendAvailable, create_backends
+from singleflight import SingleFlight
+from static_assets import PrecompressedStaticFiles, RenderedPage, precompress
+from streaming import coalesce, sse_event
+from tokens import TokenCounter
+from upstream import UpstreamError, create_upstream_client
+from upstream_pool import UpstreamPool
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled client for the whole application, so upstream connections
+    # (and their TCP/TLS handshakes) are reused across requests
+    app.state.http_client = create_upstream_client()
+    # Configured endpoints with hedging, retries and failover
+    app.state.upstream = UpstreamPool(app.state.http_client)
+    # Providers and models behind /chat, picked by observed latency and errors
+    app.state.router = BackendRouter(create_backends(CHAT_BACKENDS, app.state.http_client, app.state.upstream))
+    # Server-side conversation history for clients using conversation_id
+    app.state.session_store = create_session_store()
+    # Completed responses, replayed for identical prompts
+    app.state.response_cache = ResponseCache()
+    # Identical in-flight requests share one upstream stream
+    app.state.single_flight = SingleFlight()
+    # Concurrency limits, wait queue and per-client rate limits for /chat
+    app.state.admission = AdmissionController()
+    # Optionally replace dropped history with a rolling summary
+    app.state.compactor = None
+    if CONTEXT_COMPACTION == "summary":
+        app.state.compactor = Compactor(
+            token_counter,
+            lambda previous, turns: summarize_with_router(app.state.router, app.state.admission, previous, turns),
+        )
+    register_state_metrics(app)
+    if STATIC_PRECOMPRESS:
+        written = precompress(STATIC_DIR)
+        logger.debug("Precompressed %d static files", written)
+    try:
+        index_page.render()
+    except Exception as e:
+        logger.warning("Could not render the index page: %s", e)
+    try:
+        yield
+    finally:
+        if app.state.compactor is not None:
+            app.state.compactor.close()
+        await app.state.http_client.aclose()
+        app.state.session_store.close()
+        token_counter.close()
+
+def register_state_metrics(app: FastAPI):
+    # Cache and coalescing counters are read from their owners at scrape time
+    cache = app.state.response_cache
+    single_flight = app.state.single_flight
+    upstream = app.state.upstream
+    registry = metrics.REGISTRY
+    registry.callback("chat_response_cache_hits_total", "Response cache hits.", lambda: cache.hits, "counter")
+    registry.callback("chat_response_cache_misses_total", "Response cache misses.", lambda: cache.misses, "counter")
+    registry.callback("chat_response_cache_bytes", "Bytes held by the response cache.", lambda: cache.total_bytes)
+    registry.callback("chat_coalesced_requests_total", "Requests served by joining an identical in-flight stream.", lambda: single_flight.coalesced, "counter")
+    registry.callback("chat_upstream_streams_in_flight", "Upstream streams currently open.", lambda: single_flight.in_flight)
+    registry.callback("chat_upstream_healthy_endpoints", "Upstream endpoints not in failure cooldown.", lambda: upstream.healthy_endpoints)
+    registry.callback("chat_token_cache_hits_total", "Token count cache hits.", lambda: token_counter.hits, "counter")
+    registry.callback("chat_token_cache_misses_total", "Token count cache misses.", lambda: token_counter.misses, "counter")
+    compactor = app.state.compactor
+    if compactor is not None:
+        registry.callback("chat_compaction_summary_hits_total", "Prompts compacted with a cached summary.", lambda: compactor.hits, "counter")
+        registry.callback("chat_compaction_summary_misses_total", "Prompts trimmed because no summary was ready.", lambda: compactor.misses, "counter")
+        registry.callback("chat_compaction_summaries_total", "Summaries written in the background.", lambda: compactor.summaries_written, "counter")
+        registry.callback("chat_compaction_failures_total", "Summaries that could not be written.", lambda: compactor.failures, "counter")
+
+app = FastAPI(lifespan=lifespan)
+
+# Serve static files, precompressed, with ETag and Cache-Control
+STATIC_DIR = os.getenv("STATIC_DIR", "static")
+# Compressed copies are normally written at build time (python static_assets.py);
+# set STATIC_PRECOMPRESS=1 to write missing ones at startup instead
+STATIC_PRECOMPRESS = os.getenv("STATIC_PRECOMPRESS", "0").lower() not in ("0", "false", "no")
+app.mount("/static", PrecompressedStaticFiles(directory=STATIC_DIR), name="static")
+
+# The index page does not depend on the request, so it is rendered once
+templates = Jinja2Templates(directory=STATIC_DIR)
+index_page = RenderedPage(templates, "index.html")
 
 # Set up OpenAI API key
 openai.api_key = os.getenv("OPENAI_API_KEY")
@@ -25,82 +121,405 @@ openai.api_key = os.getenv("OPENAI_API_KEY")
 # Initialize tiktoken encoder
 encoder = tiktoken.encoding_for_model("gpt-3.5-turbo")
 
+# Memoized token accounting; repeated history turns are never re-encoded
+token_counter = TokenCounter(encoder, max_entries=int(os.getenv("TOKEN_CACHE_SIZE", "10000")))
+MAX_CONTEXT_TOKENS = int(os.getenv("MAX_CONTEXT_TOKENS", "4000"))
+MODEL = "gpt-3.5-turbo"
+SYSTEM_MESSAGE = {"role": "system", "content": "You are a helpful assistant."}
+
 class ChatInput(BaseModel):
     message: str
-    conversation_history: list
+    conversation_history: list = []
+    # When set, the server keeps the history and conversation_history is ignored
+    conversation_id: Optional[str] = None
+    # Models ("model" or "provider:model") the router may use; any configured one if empty
+    models: Optional[List[str]] = None
+
+class BatchInput(BaseModel):
+    items: List[ChatInput]
+    # Items processed at once; capped at BATCH_MAX_CONCURRENCY
+    concurrency: Optional[int] = None
+
+async def fit_context(state, messages: list, counts: Optional[list] = None):
+    # Count tokens and drop the oldest history messages that do not fit, or
+    # replace them with a summary when compaction is on; large uncached
+    # histories are tokenized in a thread pool
+    if state.compactor is not None:
+        trimmed = await state.compactor.compact(messages, MAX_CONTEXT_TOKENS, counts)
+    else:
+        trimmed = await token_counter.trim_async(messages, MAX_CONTEXT_TOKENS, counts)
+    logger.debug("Token count after trimming: %d", trimmed.token_count)
+    metrics.PROMPT_TOKENS.observe(trimmed.token_count)
+    metrics.TRIMMED_TOKENS_PER_REQUEST.observe(trimmed.trimmed_tokens)
+    if trimmed.trimmed_messages:
+        metrics.TRIMMED_TOKENS.inc(trimmed.trimmed_tokens)
+        metrics.TRIMMED_MESSAGES.inc(trimmed.trimmed_messages)
+    return trimmed
+
+def cache_policy(request: Request):
+    # Identical prompts are answered from the response cache unless the
+    # client opts out with Cache-Control: no-cache (skip lookup) or
+    # no-store (skip lookup and storing)
+    cache_control = request.headers.get("cache-control", "").lower()
+    store_in_cache = "no-store" not in cache_control
+    use_cache = store_in_cache and "no-cache" not in cache_control
+    return use_cache, store_in_cache
+
+def route_label(state, models: Optional[List[str]]) -> str:
+    # The label the cache key is built from. Raises NoBackendAvailable for
+    # unknown models.
+    state.router.allowed_backends(models)
+    if not models:
+        return "*"
+    return ",".join(sorted(models))
+
+def completion_source(state, cache_key: str, messages: list, models: Optional[List[str]], store_in_cache: bool):
+    # Streams from the routed backend, joining an identical in-flight stream
+    # if there is one, and caches the completed response. The budget of the
+    # backend the router picks is taken there.
+    def store_response(chunks):
+        if store_in_cache and chunks:
+            state.response_cache.put(cache_key, chunks)
+
+    return state.single_flight.stream(
+        cache_key,
+        lambda: state.router.stream(messages, models, admit=state.admission.admit_backend),
+        on_complete=store_response,
+    )
+
+def record_completion(started: float, reply: str, source_label: str) -> int:
+    # Stream duration and throughput metrics; returns the completion tokens
+    duration = time.perf_counter() - started
+    reply_tokens = token_counter.count_text(reply) if reply else 0
+    metrics.STREAM_DURATION.observe(duration, source=source_label)
+    metrics.COMPLETION_TOKENS.inc(reply_tokens)
+    if reply_tokens and duration > 0:
+        metrics.TOKENS_PER_SECOND.observe(reply_tokens / duration, source=source_label)
+    return reply_tokens
+
+def client_key(request: HTTPConnection) -> str:
+    # Rate limits are per API key when the client sends one, else per IP
+    api_key = request.headers.get("x-api-key") or request.headers.get("authorization")
+    if api_key:
+        return "key:" + api_key
+    return "ip:" + (request.client.host if request.client else "unknown")
 
 @app.post("/chat")
-async def chat(chat_input: ChatInput):
+async def chat(chat_input: ChatInput, request: Request):
+    started = time.perf_counter()
+    admission = request.app.state.admission
     try:
+        admission.check_rate(client_key(request))
+
         # Prepare the messages for the API call
-        messages = [{"role": "system", "content": "You are a helpful assistant."}]
-        messages.extend(chat_input.conversation_history)
-        messages.append({"role": "user", "content": chat_input.message})
+        system_message = SYSTEM_MESSAGE
+        user_message = {"role": "user", "content": chat_input.message}
+        conversation_id = chat_input.conversation_id
+        session_store = request.app.state.session_store
+        if conversation_id:
+            # History and its token counts come from the session store
+            history, history_counts = await session_store.load_async(conversation_id)
+            messages = [system_message, *history, user_message]
+            system_count, user_count = await token_counter.count_each_async([system_message, user_message])
+            counts = [system_count, *history_counts, user_count]
+        else:
+            messages = [system_message, *chat_input.conversation_history, user_message]
+            counts = None
 
         # Log the prepared messages
-        print("Sending messages to OpenAI:", messages)  # Debugging line
+        logger.debug("Sending messages to OpenAI: %s", messages)
+
+        trimmed = await fit_context(request.app.state, messages, counts)
+        messages = trimmed.messages
 
-        # Count tokens in the conversation
-        token_count = sum(len(encoder.encode(msg["content"])) for msg in messages)
+        # The router picks a backend among the allowed models
+        models = chat_input.models
+        label = route_label(request.app.state, models)
 
-        # If token count exceeds 4000, trim the conversation history
-        while token_count > 4000:
-            removed_message = messages.pop(1)  # Remove the oldest message after the system message
-            token_count -= len(encoder.encode(removed_message["content"]))
-        
-        print("Token count after trimming:", token_count)  # Debugging line
+        response_cache = request.app.state.response_cache
+        use_cache, store_in_cache = cache_policy(request)
+        cache_key = payload_key(label, messages)
+        cached_chunks = response_cache.get(cache_key) if use_cache else None
+
+        # Cache hits never reach upstream, so only misses wait for a slot
+        release = None
+        if cached_chunks is None:
+            release = await admission.admit()
 
         # Create a generator for streaming the response
         async def generate_response():
-            async with httpx.AsyncClient(timeout=None) as client:
-                async with client.stream(
-                    "POST",
-                    "https://api.openai.com/v1/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {openai.api_key}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "model": "gpt-3.5-turbo",
-                        "messages": messages,
-                        "stream": True
-                    }
-                ) as response:
-                    print("OpenAI API response status:", response.status_code)  # Debugging line
-                    if response.status_code != 200:
-                        print("Error from OpenAI API:", await response.aread())  # Debugging line
-                    async for line in response.aiter_lines():
-                        if line.startswith("data: "):
-                            data = line[6:]
-                            if data.strip() == "[DONE]":
-                                break
-                            try:
-                                print("Received data chunk from OpenAI:", data)  # Debugging line
-                                chunk = json.loads(data)  # Correct JSON parsing
-                                content = chunk['choices'][0]['delta'].get('content', '')
-                                if content:
-                                    print("Streaming content:", content)  # Debugging line
-                                    yield content
-                            except Exception as e:
-                                print("Error parsing chunk:", e)  # Debugging line
-                                pass
-
-        return StreamingResponse(generate_response(), media_type="text/event-stream")
+            if cached_chunks is not None:
+                source = replay(cached_chunks)
+            else:
+                source = completion_source(request.app.state, cache_key, messages, models, store_in_cache)
+            source_label = "cache" if cached_chunks is not None else "upstream"
+            reply_parts = []
+            metrics.REQUESTS_IN_FLIGHT.inc()
+            try:
+                # Deltas are batched into fewer, larger writes and framed as SSE events.
+                # If the client disconnects, the server cancels this generator (or
+                # closes it); aclosing then closes the whole chain down to the
+                # upstream stream right away instead of whenever it is collected.
+                async with aclosing(coalesce(source)) as flushes:
+                    async for content in flushes:
+                        if not reply_parts:
+                            metrics.TIME_TO_FIRST_TOKEN.observe(time.perf_counter() - started, source=source_label)
+                        reply_parts.append(content)
+                        yield sse_event(content)
+            except (asyncio.CancelledError, GeneratorExit):
+                metrics.CLIENT_DISCONNECTS.inc(source=source_label)
+                logger.debug("Client disconnected; stream cancelled after %d chunks", len(reply_parts))
+                raise
+            except UpstreamError as e:
+                # Every attempt failed before streaming started; the headers are
+                # already sent, so the status goes in a final "error" event
+                logger.error("Upstream request failed: %s", e)
+                yield sse_event(json.dumps({"status": e.status_code, "detail": str(e)}), event="error")
+            finally:
+                metrics.REQUESTS_IN_FLIGHT.dec()
+                if release is not None:
+                    release()
+
+            reply = "".join(reply_parts)
+            record_completion(started, reply, source_label)
+
+            # Record the completed turn so the client does not have to resend it
+            if conversation_id and reply_parts:
+                reply_message = {"role": "assistant", "content": reply}
+                await session_store.append_async(
+                    conversation_id,
+                    [user_message, reply_message],
+                    [trimmed.counts[-1], token_counter.count_message(reply_message)],
+                )
 
+        headers = {"X-Cache": "HIT" if cached_chunks is not None else "MISS"}
+        if conversation_id:
+            headers["X-Conversation-Id"] = conversation_id
+        # The background task releases the slot even if the stream never starts
+        return StreamingResponse(
+            generate_response(),
+            media_type="text/event-stream",
+            headers=headers,
+            background=BackgroundTask(release) if release is not None else None,
+        )
+
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+    except NoBackendAvailable as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        print("Error in chat endpoint:", e)  # Debugging line
+        logger.exception("Error in chat endpoint: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
-# Serve static files
-app.mount("/static", StaticFiles(directory="static"), name="static")
+@app.post("/chat/batch")
+async def chat_batch(batch: BatchInput, request: Request):
+    """
+    Answers independent prompts with bounded concurrency and streams one
+    NDJSON line per item, in completion order, tagged with the item's index.
+    Failed items get an error line; the rest of the batch carries on.
+    """
+    if len(batch.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"A batch holds at most {BATCH_MAX_ITEMS} items.")
+    state = request.app.state
+    try:
+        # One rate limit token per batch; every item still waits for an upstream slot
+        state.admission.check_rate(client_key(request))
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+    use_cache, store_in_cache = cache_policy(request)
+    concurrency = min(batch.concurrency or BATCH_CONCURRENCY, BATCH_MAX_CONCURRENCY)
+
+    async def complete(index: int, item: ChatInput) -> dict:
+        if item.conversation_id:
+            raise ValueError("conversation_id is not supported in batches.")
+        messages = [SYSTEM_MESSAGE, *item.conversation_history, {"role": "user", "content": item.message}]
+        label = route_label(state, item.models)
+        trimmed = await fit_context(state, messages)
+        cache_key = payload_key(label, trimmed.messages)
+        cached_chunks = state.response_cache.get(cache_key) if use_cache else None
+        if cached_chunks is not None:
+            return {"reply": "".join(cached_chunks), "cached": True, "prompt_tokens": trimmed.token_count}
+
+        release = await state.admission.admit()
+        try:
+            source = completion_source(state, cache_key, trimmed.messages, item.models, store_in_cache)
+            reply = "".join([content async for content in source])
+        finally:
+            release()
+        return {"reply": reply, "cached": False, "prompt_tokens": trimmed.token_count}
+
+    async def generate_lines():
+        async for index, result, error in fan_out(batch.items, complete, concurrency):
+            if error is None:
+                line = {"index": index, **result}
+            else:
+                if isinstance(error, (UpstreamError, AdmissionRejected)):
+                    status = error.status_code
+                elif isinstance(error, ValueError):
+                    status = 400
+                else:
+                    logger.exception("Batch item %d failed", index, exc_info=error)
+                    status = 500
+                line = {"index": index, "error": str(error), "status": status}
+            yield json.dumps(line) + "\n"
+
+    return StreamingResponse(generate_lines(), media_type="application/x-ndjson")
+
+@app.websocket("/ws/chat")
+async def chat_websocket(websocket: WebSocket, conversation_id: Optional[str] = None):
+    """
+    Chat over one WebSocket for many turns.
+
+    The conversation and its token counts live on the connection, so a turn
+    only sends its new message. Client frames are JSON:
+    {"type": "message", "message": ..., "id": ..., "models": [...]} starts a turn and
+    {"type": "cancel"} stops the running one. The server answers a turn with
+    "delta" frames and a final "done", "cancelled" or "error" frame, each
+    carrying the turn's id. With ?conversation_id=... the history is loaded
+    from and saved to the session store.
+    """
+    await websocket.accept()
+    state = websocket.app.state
+    if conversation_id:
+        history, history_counts = await state.session_store.load_async(conversation_id)
+    else:
+        history, history_counts = [], []
+    system_count = token_counter.count_message(SYSTEM_MESSAGE)
+    send_lock = asyncio.Lock()
+    turn = None
+    turn_id = None
+    metrics.WEBSOCKET_CONNECTIONS.inc()
+
+    async def send(frame: dict):
+        async with send_lock:
+            await websocket.send_text(json.dumps(frame))
+
+    async def run_turn(turn_id, text: str, models: Optional[List[str]]):
+        started = time.perf_counter()
+        release = None
+        try:
+            state.admission.check_rate(client_key(websocket))
+            label = route_label(state, models)
+            user_message = {"role": "user", "content": text}
+            (user_count,) = await token_counter.count_each_async([user_message])
+            trimmed = await fit_context(
+                state, [SYSTEM_MESSAGE, *history, user_message], [system_count, *history_counts, user_count]
+            )
+            if trimmed.trimmed_messages and state.compactor is None:
+                # The history only grows, so what no longer fits never will again
+                # (summaries are keyed by the full history, so it is kept for them)
+                del history[:trimmed.trimmed_messages]
+                del history_counts[:trimmed.trimmed_messages]
+            cache_key = payload_key(label, trimmed.messages)
+            cached_chunks = state.response_cache.get(cache_key)
+            if cached_chunks is not None:
+                source, source_label = replay(cached_chunks), "cache"
+            else:
+                release = await state.admission.admit()
+                source, source_label = completion_source(state, cache_key, trimmed.messages, models, True), "upstream"
+
+            reply_parts = []
+            async with aclosing(coalesce(source)) as flushes:
+                async for content in flushes:
+                    if not reply_parts:
+                        metrics.TIME_TO_FIRST_TOKEN.observe(time.perf_counter() - started, source=source_label)
+                    reply_parts.append(content)
+                    await send({"type": "delta", "id": turn_id, "content": content})
+            reply = "".join(reply_parts)
+            reply_tokens = record_completion(started, reply, source_label)
+            if reply_parts:
+                reply_message = {"role": "assistant", "content": reply}
+                turn_messages = [user_message, reply_message]
+                turn_counts = [user_count, token_counter.count_message(reply_message)]
+                history.extend(turn_messages)
+                history_counts.extend(turn_counts)
+                if conversation_id:
+                    await state.session_store.append_async(conversation_id, turn_messages, turn_counts)
+            await send({
+                "type": "done",
+                "id": turn_id,
+                "cached": cached_chunks is not None,
+                "prompt_tokens": trimmed.token_count,
+                "completion_tokens": reply_tokens,
+            })
+        except AdmissionRejected as e:
+            await send({"type": "error", "id": turn_id, "status": e.status_code, "detail": e.detail, "retry_after": e.retry_after})
+        except UpstreamError as e:
+            logger.error("Upstream request failed: %s", e)
+            await send({"type": "error", "id": turn_id, "status": e.status_code, "detail": str(e)})
+        except NoBackendAvailable as e:
+            await send({"type": "error", "id": turn_id, "status": 400, "detail": str(e)})
+        except Exception as e:
+            logger.exception("Error in WebSocket turn: %s", e)
+            await send({"type": "error", "id": turn_id, "status": 500, "detail": str(e)})
+        finally:
+            if release is not None:
+                release()
+
+    async def stop_turn() -> bool:
+        # Cancels the running turn; returns whether there was one
+        if turn is None or turn.done():
+            return False
+        turn.cancel()
+        await asyncio.gather(turn, return_exceptions=True)
+        metrics.WEBSOCKET_TURNS_CANCELLED.inc()
+        return True
+
+    def turn_finished(task: asyncio.Task):
+        # A turn only fails here if the socket closed while it was sending
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug("WebSocket turn ended: %r", task.exception())
+
+    try:
+        while True:
+            try:
+                frame = json.loads(await websocket.receive_text())
+            except ValueError:
+                await send({"type": "error", "status": 400, "detail": "Frames must be JSON objects."})
+                continue
+            kind = frame.get("type", "message") if isinstance(frame, dict) else None
+            if kind == "cancel":
+                if await stop_turn():
+                    await send({"type": "cancelled", "id": turn_id})
+            elif kind != "message" or not isinstance(frame.get("message"), str):
+                await send({"type": "error", "id": frame.get("id") if isinstance(frame, dict) else None, "status": 400, "detail": "Expected a message or cancel frame."})
+            elif turn is not None and not turn.done():
+                await send({"type": "error", "id": frame.get("id"), "status": 409, "detail": "A turn is already in progress."})
+            else:
+                turn_id = frame.get("id")
+                turn = asyncio.get_running_loop().create_task(run_turn(turn_id, frame["message"], frame.get("models")))
+                turn.add_done_callback(turn_finished)
+    except WebSocketDisconnect:
+        logger.debug("WebSocket client disconnected")
+    finally:
+        await stop_turn()
+        metrics.WEBSOCKET_CONNECTIONS.dec()
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
-# Define templates directory
-templates = Jinja2Templates(directory="static")
+@app.get("/cache/stats")
+async def cache_stats(request: Request):
+    single_flight = request.app.state.single_flight
+    return {
+        **request.app.state.response_cache.stats(),
+        "upstream_streams_started": single_flight.started,
+        "coalesced_requests": single_flight.coalesced,
+        "in_flight": single_flight.in_flight,
+    }
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request})
+    return index_page.response(request)
 
 if __name__ == "__main__":
+    import argparse
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
+    parser = argparse.ArgumentParser(description="Run the chat app.")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=WEB_CONCURRENCY, help="Worker processes (default: WEB_CONCURRENCY or the CPU count)")
+    parser.add_argument("--reload", action="store_true", help="Development mode: one worker that restarts on code changes")
+    args = parser.parse_args()
+    uvicorn.run("main:app", host=args.host, port=args.port, **server_options(args.workers, args.reload))
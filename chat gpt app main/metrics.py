@@ -0,0 +1,223 @@
+"""
+Minimal in-process metrics with Prometheus text exposition.
+
+Metrics are module-level objects registered in `REGISTRY`; `/metrics` renders
+them with `REGISTRY.render()`.
+"""
+import bisect
+import math
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# Default latency buckets in seconds, from a few milliseconds up to a minute
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        header = f"# HELP {self.name} {self.documentation}\n# TYPE {self.name} {self.kind}\n"
+        return header + "".join(line + "\n" for line in self.samples())
+
+
+class Counter(_Metric):
+    """A monotonically increasing count."""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{_label_text(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Gauge(Counter):
+    """A value that can go up and down."""
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+
+class CallbackMetric(_Metric):
+    """A counter or gauge whose value is read from a callback at render time."""
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], float], kind: str = "gauge"):
+        super().__init__(name, documentation)
+        self.kind = kind
+        self.callback = callback
+
+    def samples(self) -> List[str]:
+        return [f"{self.name} {_format_value(self.callback())}"]
+
+
+class Histogram(_Metric):
+    """Observations counted into cumulative buckets, plus their sum and count."""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            # Per-bucket counts (the last one is +Inf), then sum and count
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def count(self, **labels) -> int:
+        series = self._series.get(self._key(labels))
+        return series[2] if series else 0
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_label_text(self.labelnames, key, le)} {cumulative}")
+            labels = _label_text(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    """An ordered collection of metrics rendered together."""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered.")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name: str, documentation: str, callback: Callable[[], float], kind: str = "gauge") -> CallbackMetric:
+        """Registers (or replaces) a metric read from `callback` at render time."""
+        self._metrics.pop(name, None)
+        return self.register(CallbackMetric(name, documentation, callback, kind))
+
+    def render(self) -> str:
+        """Returns all metrics in the Prometheus text exposition format."""
+        return "".join(metric.render() for metric in self._metrics.values())
+
+
+REGISTRY = Registry()
+
+# Chat proxy metrics
+REQUESTS_IN_FLIGHT = REGISTRY.gauge("chat_requests_in_flight", "Chat responses currently being streamed.")
+TIME_TO_FIRST_TOKEN = REGISTRY.histogram(
+    "chat_time_to_first_token_seconds", "Time from request arrival to the first streamed chunk.", ["source"]
+)
+STREAM_DURATION = REGISTRY.histogram(
+    "chat_stream_duration_seconds", "Time from request arrival to the end of the stream.", ["source"]
+)
+TOKENS_PER_SECOND = REGISTRY.histogram(
+    "chat_stream_tokens_per_second",
+    "Completion tokens streamed per second of stream duration.",
+    ["source"],
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000),
+)
+COMPLETION_TOKENS = REGISTRY.counter("chat_completion_tokens_total", "Completion tokens streamed to clients.")
+UPSTREAM_RESPONSES = REGISTRY.counter(
+    "chat_upstream_responses_total", "Upstream completions responses by HTTP status code.", ["status"]
+)
+PROMPT_TOKENS = REGISTRY.histogram(
+    "chat_prompt_tokens",
+    "Prompt tokens sent upstream after trimming.",
+    buckets=(100, 250, 500, 1000, 2000, 3000, 4000, 8000, 16000),
+)
+TRIMMED_TOKENS = REGISTRY.counter("chat_trimmed_tokens_total", "History tokens dropped to fit the context budget.")
+TRIMMED_MESSAGES = REGISTRY.counter("chat_trimmed_messages_total", "History messages dropped to fit the context budget.")
+TRIMMED_TOKENS_PER_REQUEST = REGISTRY.histogram(
+    "chat_trimmed_tokens",
+    "History tokens dropped per request.",
+    buckets=(0, 100, 500, 1000, 2000, 4000, 8000, 16000, 64000),
+)
+CLIENT_DISCONNECTS = REGISTRY.counter(
+    "chat_client_disconnects_total", "Streams cancelled because the client disconnected.", ["source"]
+)
+UPSTREAM_CANCELLED = REGISTRY.counter(
+    "chat_upstream_cancelled_total", "Upstream streams aborted because no client was listening any more."
+)
+UPSTREAM_HEDGES = REGISTRY.counter("chat_upstream_hedges_total", "Extra upstream attempts started because the first token was late.")
+UPSTREAM_HEDGE_WINS = REGISTRY.counter("chat_upstream_hedge_wins_total", "Requests whose first token came from a hedged attempt.")
+UPSTREAM_RETRIES = REGISTRY.counter("chat_upstream_retries_total", "Upstream attempts retried after failing before streaming started.")
+UPSTREAM_ENDPOINT_FAILURES = REGISTRY.counter(
+    "chat_upstream_endpoint_failures_total", "Failed upstream attempts by endpoint.", ["endpoint"]
+)
+BACKEND_REQUESTS = REGISTRY.counter(
+    "chat_backend_requests_total", "Requests routed to each backend by outcome before the first token.", ["backend", "outcome"]
+)
+BACKEND_TTFT = REGISTRY.gauge("chat_backend_ttft_ewma_seconds", "Moving average of each backend's time to first token.", ["backend"])
+BACKEND_ERROR_RATE = REGISTRY.gauge("chat_backend_error_rate_ewma", "Moving average of each backend's error rate.", ["backend"])
+WEBSOCKET_CONNECTIONS = REGISTRY.gauge("chat_websocket_connections", "Open /ws/chat connections.")
+WEBSOCKET_TURNS_CANCELLED = REGISTRY.counter(
+    "chat_websocket_turns_cancelled_total", "WebSocket turns cancelled by the client or by a disconnect."
+)
+ADMISSION_ACTIVE = REGISTRY.gauge("chat_admission_active", "Requests holding a concurrency slot.", ["limiter"])
+ADMISSION_QUEUE_DEPTH = REGISTRY.gauge("chat_admission_queue_depth", "Requests waiting for a concurrency slot.", ["limiter"])
+ADMISSION_REJECTIONS = REGISTRY.counter(
+    "chat_admission_rejections_total", "Requests rejected by admission control.", ["limiter", "reason"]
+)
@@ -0,0 +1,227 @@
+"""
+Local stand-in for the OpenAI chat completions API.
+
+It streams synthetic completions in the same SSE wire format as the real API,
+so the chat app can be benchmarked and load-tested without spending API quota.
+Point the app at it with UPSTREAM_BASE_URL=http://127.0.0.1:8001/v1.
+
+The same server also speaks the Anthropic Messages stream format at
+/v1/messages (ANTHROPIC_BASE_URL=http://127.0.0.1:8001/v1) and the Gemini
+streamGenerateContent SSE format at /v1beta/models/{model}:streamGenerateContent
+(GEMINI_BASE_URL=http://127.0.0.1:8001/v1beta).
+
+Usage:
+    python mock_upstream.py [--port 8001] [--tokens 50] [--token-rate 100]
+                            [--first-token-delay 0.2] [--error-rate 0.01]
+"""
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass
+
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, StreamingResponse
+
+REPLY = "This is a synthetic reply from the local mock completions server."
+
+
+@dataclass
+class MockConfig:
+    """
+    Behaviour of the mock completions server.
+
+    Attributes:
+        tokens (int): Content chunks per completion; 0 streams the fixed REPLY sentence.
+        token_rate (float): Chunks per second after the first one; 0 streams as fast as possible.
+        first_token_delay (float): Seconds before the first content chunk.
+        error_rate (float): Fraction of requests answered with `error_status` instead of a stream.
+        error_status (int): HTTP status of injected errors (e.g. 500, 429, 503).
+        stream_error_rate (float): Fraction of streams cut off halfway without [DONE].
+    """
+    tokens: int = 0
+    token_rate: float = 0.0
+    first_token_delay: float = 0.0
+    error_rate: float = 0.0
+    error_status: int = 500
+    stream_error_rate: float = 0.0
+
+
+def completion_chunk(model: str, delta: dict, finish_reason=None) -> str:
+    payload = {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+def anthropic_event(event: str, payload: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps({'type': event, **payload})}\n\n"
+
+
+def gemini_chunk(text: str, finish_reason=None) -> str:
+    candidate = {"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}
+    if finish_reason:
+        candidate["finishReason"] = finish_reason
+    return f"data: {json.dumps({'candidates': [candidate]})}\n\n"
+
+
+def create_mock_app(config: MockConfig = None) -> FastAPI:
+    """
+    Builds a mock completions app.
+
+    Args:
+        config (MockConfig, optional): Server behaviour; defaults to an instant, error-free stream.
+
+    Returns:
+        FastAPI: The app. `app.state.config` can be changed while it runs,
+        `app.state.requests` counts the completions requests received
+        (`app.state.last_request` is the body of the latest one),
+        `app.state.chunks_sent` the content chunks written and
+        `app.state.disconnects` the streams the client abandoned.
+    """
+    app = FastAPI()
+    app.state.config = config or MockConfig()
+    app.state.requests = 0
+    app.state.last_request = None
+    app.state.chunks_sent = 0
+    app.state.disconnects = 0
+
+    def respond(body: dict, opening: list, content_chunk, closing: list):
+        # Streams the configured synthetic reply in one provider's framing
+        config = app.state.config
+        app.state.requests += 1
+        app.state.last_request = body
+        if config.error_rate and random.random() < config.error_rate:
+            return JSONResponse(
+                {"error": {"message": "Injected error from the mock server.", "type": "mock_error"}},
+                status_code=config.error_status,
+            )
+        if config.tokens:
+            words = [f"tok{i}" for i in range(config.tokens)]
+        else:
+            words = REPLY.split(" ")
+        cut_off = config.stream_error_rate and random.random() < config.stream_error_rate
+        interval = 1.0 / config.token_rate if config.token_rate else 0.0
+
+        async def stream():
+            try:
+                for chunk in opening:
+                    yield chunk
+                if config.first_token_delay:
+                    await asyncio.sleep(config.first_token_delay)
+                for i, word in enumerate(words):
+                    if cut_off and i == len(words) // 2:
+                        raise RuntimeError("Injected stream failure from the mock server.")
+                    if i and interval:
+                        await asyncio.sleep(interval)
+                    yield content_chunk(word + " ")
+                    app.state.chunks_sent += 1
+                    await asyncio.sleep(0)
+                for chunk in closing:
+                    yield chunk
+            except (asyncio.CancelledError, GeneratorExit):
+                app.state.disconnects += 1
+                raise
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    @app.post("/v1/chat/completions")
+    async def completions(body: dict):
+        model = body.get("model", "gpt-3.5-turbo")
+        return respond(
+            body,
+            [completion_chunk(model, {"role": "assistant"})],
+            lambda text: completion_chunk(model, {"content": text}),
+            [completion_chunk(model, {}, finish_reason="stop"), "data: [DONE]\n\n"],
+        )
+
+    @app.post("/v1/messages")
+    async def anthropic_messages(body: dict):
+        message = {"id": "msg_mock", "type": "message", "role": "assistant", "model": body.get("model"), "content": []}
+        return respond(
+            body,
+            [
+                anthropic_event("message_start", {"message": message}),
+                anthropic_event("content_block_start", {"index": 0, "content_block": {"type": "text", "text": ""}}),
+                anthropic_event("ping", {}),
+            ],
+            lambda text: anthropic_event("content_block_delta", {"index": 0, "delta": {"type": "text_delta", "text": text}}),
+            [
+                anthropic_event("content_block_stop", {"index": 0}),
+                anthropic_event("message_delta", {"delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": 1}}),
+                anthropic_event("message_stop", {}),
+            ],
+        )
+
+    @app.post("/v1beta/models/{model}:streamGenerateContent")
+    async def gemini_stream(model: str, body: dict):
+        return respond(body, [], gemini_chunk, [gemini_chunk("", finish_reason="STOP")])
+
+    return app
+
+
+mock_app = create_mock_app()
+
+
+def serve_in_thread(app=mock_app, host: str = "127.0.0.1", port: int = 0, **config):
+    """
+    Start an ASGI app under uvicorn in a daemon thread.
+
+    Args:
+        app: The ASGI application to serve (the mock upstream by default).
+        host (str): Interface to bind.
+        port (int): Port to bind, or 0 to pick a free one.
+        **config: Extra `uvicorn.Config` options, e.g. `ssl_certfile`.
+
+    Returns:
+        tuple: The running `uvicorn.Server` and the base URL it listens on.
+    """
+    config.setdefault("log_level", "warning")
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, **config))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    server.thread = thread
+    while not server.started:
+        time.sleep(0.01)
+    bound_port = server.servers[0].sockets[0].getsockname()[1]
+    scheme = "https" if config.get("ssl_certfile") else "http"
+    return server, f"{scheme}://{host}:{bound_port}"
+
+
+def stop_server(server, timeout: float = 5.0) -> None:
+    """Shut down a server started by `serve_in_thread` and wait for its thread to exit."""
+    server.should_exit = True
+    server.thread.join(timeout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--tokens", type=int, default=0)
+    parser.add_argument("--token-rate", type=float, default=0.0)
+    parser.add_argument("--first-token-delay", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--stream-error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    config = MockConfig(
+        tokens=args.tokens,
+        token_rate=args.token_rate,
+        first_token_delay=args.first_token_delay,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        stream_error_rate=args.stream_error_rate,
+    )
+    uvicorn.run(create_mock_app(config), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
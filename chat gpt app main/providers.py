@@ -0,0 +1,361 @@
+"""
+Chat backends for several providers behind one streaming interface.
+
+Each adapter turns OpenAI-style messages into its provider's request and its
+provider's SSE stream back into content deltas. `BackendRouter` picks a
+backend among the models a request allows, from an exponentially weighted
+moving average (EWMA) of each backend's time to first token and error rate.
+"""
+import logging
+import os
+import random
+import time
+from typing import AsyncIterator, Callable, Dict, List, Optional, Sequence
+
+import httpx
+
+from metrics import BACKEND_ERROR_RATE, BACKEND_REQUESTS, BACKEND_TTFT
+from streaming import loads
+from upstream import UpstreamError
+
+logger = logging.getLogger(__name__)
+
+# Comma-separated provider:model pairs, e.g. "openai:gpt-3.5-turbo,anthropic:claude-3-5-haiku-latest"
+CHAT_BACKENDS = os.getenv("CHAT_BACKENDS", "openai:gpt-3.5-turbo")
+ANTHROPIC_BASE_URL = os.getenv("ANTHROPIC_BASE_URL", "https://api.anthropic.com/v1").rstrip("/")
+ANTHROPIC_VERSION = os.getenv("ANTHROPIC_VERSION", "2023-06-01")
+ANTHROPIC_MAX_TOKENS = int(os.getenv("ANTHROPIC_MAX_TOKENS", "1024"))
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com/v1beta").rstrip("/")
+# Weight of the newest observation in the moving averages
+ROUTER_EWMA_ALPHA = float(os.getenv("ROUTER_EWMA_ALPHA", "0.2"))
+# Seconds of extra expected latency per unit of error rate
+ROUTER_ERROR_PENALTY = float(os.getenv("ROUTER_ERROR_PENALTY", "10"))
+# Fraction of requests sent to a random allowed backend to keep its averages fresh
+ROUTER_EXPLORE = float(os.getenv("ROUTER_EXPLORE", "0.05"))
+
+
+def merge_turns(messages: List[dict], roles: Dict[str, str]) -> List[dict]:
+    """
+    Maps roles and joins consecutive messages of the same role, for APIs that
+    require user and model turns to alternate.
+
+    Returns:
+        list: `{"role": ..., "content": ...}` dicts with provider role names.
+    """
+    turns = []
+    for message in messages:
+        role = roles.get(message.get("role"))
+        if role is None:
+            continue
+        if turns and turns[-1]["role"] == role:
+            turns[-1]["content"] += "\n\n" + message.get("content", "")
+        else:
+            turns.append({"role": role, "content": message.get("content", "")})
+    return turns
+
+
+def system_text(messages: List[dict]) -> str:
+    """Returns the system messages joined into one instruction."""
+    return "\n\n".join(m.get("content", "") for m in messages if m.get("role") == "system")
+
+
+async def sse_data(response: httpx.Response) -> AsyncIterator[str]:
+    """Yields the payload of every `data:` line of an SSE response."""
+    async for line in response.aiter_lines():
+        if line.startswith("data:"):
+            yield line[5:].lstrip()
+
+
+class Backend:
+    """
+    One provider and model.
+
+    Attributes:
+        provider (str): Provider name, e.g. "openai".
+        model (str): Model name sent to the provider.
+        name (str): "provider:model", used in routing and metrics.
+    """
+    provider = ""
+
+    def __init__(self, model: str):
+        self.model = model
+        self.name = f"{self.provider}:{model}"
+
+    def stream(self, messages: List[dict]) -> AsyncIterator[str]:
+        """
+        Streams a completion of OpenAI-style `messages` as content deltas.
+
+        Raises:
+            UpstreamError: If the provider answers with an error status.
+        """
+        raise NotImplementedError
+
+
+class OpenAIBackend(Backend):
+    """OpenAI chat completions, through the hedging and failover pool."""
+    provider = "openai"
+
+    def __init__(self, model: str, upstream, api_key: Optional[str]):
+        """
+        Args:
+            model (str): Model name.
+            upstream (UpstreamPool): The OpenAI-compatible endpoints.
+            api_key (str): Bearer token.
+        """
+        super().__init__(model)
+        self.upstream = upstream
+        self.api_key = api_key
+
+    def stream(self, messages: List[dict]) -> AsyncIterator[str]:
+        return self.upstream.stream(self.api_key, {"model": self.model, "messages": messages, "stream": True})
+
+
+class AnthropicBackend(Backend):
+    """Anthropic Messages API (`content_block_delta` events)."""
+    provider = "anthropic"
+
+    def __init__(self, model: str, client: httpx.AsyncClient, api_key: Optional[str], base_url: str = ANTHROPIC_BASE_URL, max_tokens: int = ANTHROPIC_MAX_TOKENS):
+        super().__init__(model)
+        self.client = client
+        self.api_key = api_key
+        self.url = f"{base_url.rstrip('/')}/messages"
+        self.max_tokens = max_tokens
+
+    def request_body(self, messages: List[dict]) -> dict:
+        body = {
+            "model": self.model,
+            "max_tokens": self.max_tokens,
+            "messages": merge_turns(messages, {"user": "user", "assistant": "assistant"}),
+            "stream": True,
+        }
+        system = system_text(messages)
+        if system:
+            body["system"] = system
+        return body
+
+    async def stream(self, messages: List[dict]) -> AsyncIterator[str]:
+        headers = {"x-api-key": self.api_key or "", "anthropic-version": ANTHROPIC_VERSION}
+        async with self.client.stream("POST", self.url, headers=headers, json=self.request_body(messages)) as response:
+            if response.status_code != 200:
+                raise UpstreamError(response.status_code, await response.aread())
+            # Events after message_stop are ignored, but the body is read to its
+            # end so the connection goes back to the pool instead of being closed
+            stopped = False
+            async for data in sse_data(response):
+                if stopped:
+                    continue
+                event = loads(data)
+                kind = event.get("type")
+                if kind == "content_block_delta":
+                    text = event.get("delta", {}).get("text")
+                    if text:
+                        yield text
+                elif kind == "message_stop":
+                    stopped = True
+                elif kind == "error":
+                    raise UpstreamError(502, data.encode())
+
+
+class GeminiBackend(Backend):
+    """Google Gemini `streamGenerateContent` with `alt=sse`."""
+    provider = "gemini"
+
+    def __init__(self, model: str, client: httpx.AsyncClient, api_key: Optional[str], base_url: str = GEMINI_BASE_URL):
+        super().__init__(model)
+        self.client = client
+        self.api_key = api_key
+        self.url = f"{base_url.rstrip('/')}/models/{model}:streamGenerateContent"
+
+    def request_body(self, messages: List[dict]) -> dict:
+        turns = merge_turns(messages, {"user": "user", "assistant": "model"})
+        body = {"contents": [{"role": turn["role"], "parts": [{"text": turn["content"]}]} for turn in turns]}
+        system = system_text(messages)
+        if system:
+            body["systemInstruction"] = {"parts": [{"text": system}]}
+        return body
+
+    async def stream(self, messages: List[dict]) -> AsyncIterator[str]:
+        headers = {"x-goog-api-key": self.api_key or ""}
+        async with self.client.stream(
+            "POST", self.url, params={"alt": "sse"}, headers=headers, json=self.request_body(messages)
+        ) as response:
+            if response.status_code != 200:
+                raise UpstreamError(response.status_code, await response.aread())
+            async for data in sse_data(response):
+                for candidate in loads(data).get("candidates", ()):
+                    for part in candidate.get("content", {}).get("parts", ()):
+                        text = part.get("text")
+                        if text:
+                            yield text
+
+
+class BackendStats:
+    """Moving averages of one backend's time to first token and error rate."""
+
+    def __init__(self):
+        self.ttft: Optional[float] = None
+        self.error_rate = 0.0
+        self.requests = 0
+
+    def observe(self, alpha: float, ttft: Optional[float], failed: bool) -> None:
+        self.requests += 1
+        self.error_rate += alpha * ((1.0 if failed else 0.0) - self.error_rate)
+        if ttft is not None:
+            self.ttft = ttft if self.ttft is None else self.ttft + alpha * (ttft - self.ttft)
+
+
+class NoBackendAvailable(ValueError):
+    """Raised when no configured backend serves any of the allowed models."""
+
+
+class BackendRouter:
+    """
+    Routes each request to the allowed backend with the lowest expected latency.
+
+    The score of a backend is its EWMA time to first token plus
+    `error_penalty` seconds per unit of EWMA error rate. Backends without
+    observations are tried first. If the chosen backend fails before its
+    first token, the next best one is tried; after that the request stays on
+    its backend.
+    """
+
+    def __init__(self, backends: Sequence[Backend], alpha: float = ROUTER_EWMA_ALPHA, error_penalty: float = ROUTER_ERROR_PENALTY, explore: float = ROUTER_EXPLORE):
+        """
+        Args:
+            backends (list): The configured backends.
+            alpha (float): Weight of the newest observation in the averages.
+            error_penalty (float): Seconds added to the score per unit of error rate.
+            explore (float): Fraction of requests routed to a random allowed backend.
+        """
+        if not backends:
+            raise ValueError("At least one backend is required.")
+        self.backends = list(backends)
+        self.alpha = alpha
+        self.error_penalty = error_penalty
+        self.explore = explore
+        self.stats: Dict[str, BackendStats] = {backend.name: BackendStats() for backend in self.backends}
+
+    @property
+    def default_model(self) -> str:
+        return self.backends[0].model
+
+    def allowed_backends(self, allowed: Optional[Sequence[str]] = None) -> List[Backend]:
+        """
+        Returns the backends serving the allowed models, given as "model" or
+        "provider:model"; all of them if `allowed` is empty.
+
+        Raises:
+            NoBackendAvailable: If none of them is configured.
+        """
+        if not allowed:
+            return list(self.backends)
+        names = set(allowed)
+        backends = [b for b in self.backends if b.model in names or b.name in names]
+        if not backends:
+            raise NoBackendAvailable(f"No backend serves any of the models {sorted(names)}.")
+        return backends
+
+    def candidates(self, allowed: Optional[Sequence[str]] = None) -> List[Backend]:
+        """
+        Returns the allowed backends, best first.
+        """
+        backends = self.allowed_backends(allowed)
+        backends.sort(key=self.score)
+        if len(backends) > 1 and self.explore and random.random() < self.explore:
+            backends.insert(0, backends.pop(random.randrange(1, len(backends))))
+        return backends
+
+    def score(self, backend: Backend) -> float:
+        stats = self.stats[backend.name]
+        if not stats.requests:
+            return -1.0
+        return (stats.ttft or 0.0) + self.error_penalty * stats.error_rate
+
+    def _observe(self, backend: Backend, ttft: Optional[float], failed: bool) -> None:
+        stats = self.stats[backend.name]
+        stats.observe(self.alpha, ttft, failed)
+        BACKEND_REQUESTS.inc(backend=backend.name, outcome="error" if failed else "ok")
+        BACKEND_ERROR_RATE.set(stats.error_rate, backend=backend.name)
+        if stats.ttft is not None:
+            BACKEND_TTFT.set(stats.ttft, backend=backend.name)
+
+    async def stream(self, messages: List[dict], allowed: Optional[Sequence[str]] = None, admit: Optional[Callable] = None) -> AsyncIterator[str]:
+        """
+        Streams a completion from the best allowed backend.
+
+        Args:
+            messages (list): OpenAI-style messages.
+            allowed (list, optional): Models the request may use; any if empty.
+            admit (callable, optional): Awaited with each backend before it is
+                called, e.g. AdmissionController.admit_backend; returns a function
+                that releases what it took. If it rejects, the next backend is tried.
+
+        Yields:
+            str: Content deltas, in order.
+        """
+        candidates = self.candidates(allowed)
+        for position, backend in enumerate(candidates):
+            last = position == len(candidates) - 1
+            release = None
+            if admit is not None:
+                try:
+                    release = await admit(backend)
+                except Exception as e:
+                    if last:
+                        raise
+                    logger.warning("Backend %s is over its budget, trying the next one: %s", backend.name, e)
+                    continue
+            try:
+                started = time.perf_counter()
+                stream = backend.stream(messages)
+                try:
+                    try:
+                        first = await stream.__anext__()
+                    except StopAsyncIteration:
+                        first = None
+                except Exception as e:
+                    await stream.aclose()
+                    self._observe(backend, None, failed=True)
+                    if last:
+                        raise
+                    logger.warning("Backend %s failed before streaming, trying the next one: %s", backend.name, e)
+                    continue
+                self._observe(backend, time.perf_counter() - started, failed=False)
+                try:
+                    if first is None:
+                        return
+                    yield first
+                    async for content in stream:
+                        yield content
+                finally:
+                    await stream.aclose()
+                return
+            finally:
+                if release is not None:
+                    release()
+
+
+def create_backends(spec: str, client: httpx.AsyncClient, upstream) -> List[Backend]:
+    """
+    Builds the backends listed in a "provider:model,..." specification.
+
+    Args:
+        spec (str): The CHAT_BACKENDS setting.
+        client (httpx.AsyncClient): The shared client, for non-OpenAI providers.
+        upstream (UpstreamPool): The OpenAI endpoints.
+
+    Returns:
+        list: The backends, in the configured order.
+    """
+    backends = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        provider, _, model = item.partition(":")
+        if provider == "openai":
+            backends.append(OpenAIBackend(model, upstream, os.getenv("OPENAI_API_KEY")))
+        elif provider == "anthropic":
+            backends.append(AnthropicBackend(model, client, os.getenv("ANTHROPIC_API_KEY")))
+        elif provider == "gemini":
+            backends.append(GeminiBackend(model, client, os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")))
+        else:
+            raise ValueError(f"Unknown provider {provider!r} in CHAT_BACKENDS.")
+    return backends
@@ -0,0 +1,42 @@
+"""
+Launch settings for running the chat app under uvicorn.
+
+Production mode runs several worker processes on uvloop and httptools (when
+installed) without the reload watcher; development mode keeps a single
+auto-reloading worker.
+"""
+import importlib.util
+import os
+
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+# Access logging costs a formatted line per request; off unless asked for
+ACCESS_LOG = os.getenv("ACCESS_LOG", "0").lower() in ("1", "true", "yes")
+
+
+def module_available(name: str) -> bool:
+    """Returns whether a module can be imported, without importing it."""
+    return importlib.util.find_spec(name) is not None
+
+
+def server_options(workers: int = WEB_CONCURRENCY, reload: bool = False, access_log: bool = ACCESS_LOG) -> dict:
+    """
+    Returns keyword arguments for `uvicorn.run`.
+
+    Args:
+        workers (int): Worker processes; forced to 1 with reload.
+        reload (bool): Development mode: restart when the code changes.
+        access_log (bool): Log every request.
+
+    Returns:
+        dict: uvicorn options. The app must be passed as an import string
+        ("main:app") for workers or reload to take effect.
+    """
+    if reload:
+        return {"reload": True, "workers": 1, "access_log": True}
+    return {
+        "reload": False,
+        "workers": max(1, workers),
+        "loop": "uvloop" if module_available("uvloop") else "asyncio",
+        "http": "httptools" if module_available("httptools") else "h11",
+        "access_log": access_log,
+    }
@@ -0,0 +1,277 @@
+"""
+Server-side conversation sessions.
+
+In `conversation_id` mode the client only sends the new message. The server
+keeps each conversation's messages together with their cached token counts
+and appends the user turn and the assistant reply itself.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import List, Tuple
+
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "sessions.db")
+SESSION_TTL = float(os.getenv("SESSION_TTL", "3600"))
+SESSION_MAX = int(os.getenv("SESSION_MAX", "10000"))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(256 * 1024 * 1024)))
+
+# Rough fixed cost of one stored message (dict, list slots, count) in bytes
+MESSAGE_OVERHEAD_BYTES = 200
+
+
+def message_size(message: dict) -> int:
+    """Approximate in-memory size of a stored message in bytes."""
+    return MESSAGE_OVERHEAD_BYTES + sum(len(value) for value in message.values() if isinstance(value, str))
+
+
+class SessionStore(ABC):
+    """
+    Backend interface for conversation sessions.
+
+    A session is an ordered list of messages and, in parallel, the token count
+    of each message as computed by `TokenCounter.count_message`.
+    """
+
+    @abstractmethod
+    def load(self, conversation_id: str) -> Tuple[List[dict], List[int]]:
+        """
+        Returns the messages and token counts of a conversation, or two empty
+        lists if it is unknown or has expired.
+        """
+
+    @abstractmethod
+    def append(self, conversation_id: str, messages: List[dict], counts: List[int]) -> None:
+        """Appends messages (and their token counts) to a conversation, creating it if needed."""
+
+    @abstractmethod
+    def delete(self, conversation_id: str) -> None:
+        """Forgets a conversation. Unknown ids are ignored."""
+
+    async def load_async(self, conversation_id: str) -> Tuple[List[dict], List[int]]:
+        """`load` for use on the event loop; backends that do I/O run it in a thread."""
+        return self.load(conversation_id)
+
+    async def append_async(self, conversation_id: str, messages: List[dict], counts: List[int]) -> None:
+        """`append` for use on the event loop; backends that do I/O run it in a thread."""
+        self.append(conversation_id, messages, counts)
+
+    def close(self) -> None:
+        """Releases backend resources."""
+
+
+class _Session:
+    __slots__ = ("messages", "counts", "size", "last_access")
+
+    def __init__(self):
+        self.messages: List[dict] = []
+        self.counts: List[int] = []
+        self.size = 0
+        self.last_access = time.monotonic()
+
+
+class InMemorySessionStore(SessionStore):
+    """
+    Per-process session store with LRU + TTL eviction and a memory cap.
+    """
+
+    def __init__(self, max_sessions: int = SESSION_MAX, ttl: float = SESSION_TTL, max_bytes: int = SESSION_MAX_BYTES):
+        """
+        Args:
+            max_sessions (int): Maximum number of conversations kept.
+            ttl (float): Seconds of inactivity after which a conversation expires.
+            max_bytes (int): Approximate cap on the memory used by all stored messages.
+        """
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _drop(self, conversation_id: str) -> None:
+        session = self._sessions.pop(conversation_id)
+        self.total_bytes -= session.size
+
+    def _expire(self, now: float) -> None:
+        # Sessions are kept in access order, so expired ones are at the front
+        while self._sessions:
+            conversation_id, session = next(iter(self._sessions.items()))
+            if now - session.last_access <= self.ttl:
+                break
+            self._drop(conversation_id)
+
+    def load(self, conversation_id: str) -> Tuple[List[dict], List[int]]:
+        now = time.monotonic()
+        self._expire(now)
+        session = self._sessions.get(conversation_id)
+        if session is None:
+            return [], []
+        session.last_access = now
+        self._sessions.move_to_end(conversation_id)
+        return list(session.messages), list(session.counts)
+
+    def append(self, conversation_id: str, messages: List[dict], counts: List[int]) -> None:
+        now = time.monotonic()
+        self._expire(now)
+        session = self._sessions.get(conversation_id)
+        if session is None:
+            session = self._sessions[conversation_id] = _Session()
+        self._sessions.move_to_end(conversation_id)
+        session.last_access = now
+
+        added = sum(message_size(message) for message in messages)
+        session.messages.extend(messages)
+        session.counts.extend(counts)
+        session.size += added
+        self.total_bytes += added
+
+        # A single conversation may not use the whole budget: drop its oldest turns
+        while session.size > self.max_bytes and len(session.messages) > 1:
+            removed = message_size(session.messages.pop(0))
+            session.counts.pop(0)
+            session.size -= removed
+            self.total_bytes -= removed
+
+        while self._sessions and (len(self._sessions) > self.max_sessions or self.total_bytes > self.max_bytes):
+            oldest = next(iter(self._sessions))
+            if oldest == conversation_id:
+                break
+            self._drop(oldest)
+
+    def delete(self, conversation_id: str) -> None:
+        if conversation_id in self._sessions:
+            self._drop(conversation_id)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Session store in a SQLite database, so several workers can share sessions.
+
+    The database runs in WAL mode so readers in one worker do not block writers
+    in another. Eviction is by TTL and by a cap on the number of conversations,
+    least recently used first.
+    """
+
+    def __init__(self, path: str = SESSION_DB_PATH, max_sessions: int = SESSION_MAX, ttl: float = SESSION_TTL):
+        """
+        Args:
+            path (str): Database file shared by all workers.
+            max_sessions (int): Maximum number of conversations kept.
+            ttl (float): Seconds of inactivity after which a conversation expires.
+        """
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                conversation_id TEXT PRIMARY KEY,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS sessions_last_access ON sessions (last_access);
+            CREATE TABLE IF NOT EXISTS session_messages (
+                conversation_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                message TEXT NOT NULL,
+                tokens INTEGER NOT NULL,
+                PRIMARY KEY (conversation_id, seq)
+            );
+            """
+        )
+
+    def load(self, conversation_id: str) -> Tuple[List[dict], List[int]]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT last_access FROM sessions WHERE conversation_id = ?", (conversation_id,)
+            ).fetchone()
+            if row is None or now - row[0] > self.ttl:
+                return [], []
+            self._conn.execute(
+                "UPDATE sessions SET last_access = ? WHERE conversation_id = ?", (now, conversation_id)
+            )
+            rows = self._conn.execute(
+                "SELECT message, tokens FROM session_messages WHERE conversation_id = ? ORDER BY seq",
+                (conversation_id,),
+            ).fetchall()
+        return [json.loads(message) for message, _ in rows], [tokens for _, tokens in rows]
+
+    async def load_async(self, conversation_id: str) -> Tuple[List[dict], List[int]]:
+        # sqlite3 blocks (up to `timeout` on a locked database), so keep it off the event loop
+        return await asyncio.to_thread(self.load, conversation_id)
+
+    async def append_async(self, conversation_id: str, messages: List[dict], counts: List[int]) -> None:
+        await asyncio.to_thread(self.append, conversation_id, messages, counts)
+
+    def append(self, conversation_id: str, messages: List[dict], counts: List[int]) -> None:
+        now = time.time()
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "INSERT INTO sessions (conversation_id, last_access) VALUES (?, ?) "
+                    "ON CONFLICT (conversation_id) DO UPDATE SET last_access = excluded.last_access",
+                    (conversation_id, now),
+                )
+                (next_seq,) = conn.execute(
+                    "SELECT COALESCE(MAX(seq) + 1, 0) FROM session_messages WHERE conversation_id = ?",
+                    (conversation_id,),
+                ).fetchone()
+                conn.executemany(
+                    "INSERT INTO session_messages (conversation_id, seq, message, tokens) VALUES (?, ?, ?, ?)",
+                    [
+                        (conversation_id, next_seq + i, json.dumps(message), tokens)
+                        for i, (message, tokens) in enumerate(zip(messages, counts))
+                    ],
+                )
+                self._evict(now)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _evict(self, now: float) -> None:
+        conn = self._conn
+        evicted = conn.execute(
+            "SELECT conversation_id FROM sessions WHERE last_access < ? "
+            "UNION SELECT conversation_id FROM ("
+            "SELECT conversation_id FROM sessions ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+            (now - self.ttl, self.max_sessions),
+        ).fetchall()
+        if evicted:
+            conn.executemany("DELETE FROM sessions WHERE conversation_id = ?", evicted)
+            conn.executemany("DELETE FROM session_messages WHERE conversation_id = ?", evicted)
+
+    def delete(self, conversation_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE conversation_id = ?", (conversation_id,))
+            self._conn.execute("DELETE FROM session_messages WHERE conversation_id = ?", (conversation_id,))
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def create_session_store() -> SessionStore:
+    """
+    Creates the session store selected by the SESSION_BACKEND environment variable.
+
+    Returns:
+        SessionStore: An `InMemorySessionStore` ("memory") or `SQLiteSessionStore` ("sqlite").
+    """
+    if SESSION_BACKEND == "memory":
+        return InMemorySessionStore()
+    if SESSION_BACKEND == "sqlite":
+        return SQLiteSessionStore()
+    raise ValueError(f"Unknown SESSION_BACKEND {SESSION_BACKEND!r}; expected 'memory' or 'sqlite'.")
@@ -0,0 +1,126 @@
+"""
+Request coalescing for identical in-flight chat requests.
+
+The first request for a payload hash starts the upstream stream in its own
+task; identical requests that arrive while it is running subscribe to it
+instead of opening another upstream stream.
+"""
+import asyncio
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+from metrics import UPSTREAM_CANCELLED
+
+
+class _Flight:
+    """
+    One upstream stream shared by all of its subscribers.
+
+    Chunks are appended to a single log. Each subscriber reads the log through
+    its own cursor, so its buffer is the window between its cursor and the end
+    of the log: it holds no copies, and the upstream reader never waits for a
+    subscriber. A slow reader only falls behind; it cannot stall the upstream
+    reader or the other subscribers.
+    """
+    __slots__ = ("chunks", "done", "error", "task", "subscribers", "_changed")
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.task: Optional[asyncio.Task] = None
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+
+    def notify(self) -> None:
+        # Wake everyone waiting for new chunks and arm a fresh event
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent streams onto one upstream stream.
+    """
+
+    def __init__(self):
+        self.started = 0
+        self.coalesced = 0
+        self._flights: Dict[str, _Flight] = {}
+
+    @property
+    def in_flight(self) -> int:
+        """Number of upstream streams currently running."""
+        return len(self._flights)
+
+    def stream(
+        self,
+        key: str,
+        factory: Callable[[], AsyncIterator[str]],
+        on_complete: Optional[Callable[[List[str]], None]] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Returns an iterator over the chunks of the stream for `key`.
+
+        Args:
+            key (str): Hash of the upstream payload.
+            factory (callable): Opens the upstream stream; only called if no
+                identical stream is in flight.
+            on_complete (callable, optional): Called once with all chunks when
+                the upstream stream finishes successfully. Only used by the
+                request that starts the stream.
+
+        Returns:
+            AsyncIterator[str]: The chunks received so far followed by the live tail.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight()
+            flight.task = asyncio.get_running_loop().create_task(self._run(key, flight, factory, on_complete))
+            self.started += 1
+        else:
+            self.coalesced += 1
+        # Count the subscriber now, before its iterator is first advanced, so
+        # the flight is not torn down while a new subscriber is attaching
+        flight.subscribers += 1
+        return self._subscribe(key, flight)
+
+    async def _run(self, key: str, flight: _Flight, factory, on_complete) -> None:
+        try:
+            async for chunk in factory():
+                flight.chunks.append(chunk)
+                flight.notify()
+        except asyncio.CancelledError:
+            flight.error = asyncio.CancelledError()
+            raise
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.notify()
+        if on_complete is not None and flight.error is None:
+            on_complete(flight.chunks)
+
+    async def _subscribe(self, key: str, flight: _Flight) -> AsyncIterator[str]:
+        cursor = 0
+        try:
+            while True:
+                if cursor < len(flight.chunks):
+                    chunk = flight.chunks[cursor]
+                    cursor += 1
+                    yield chunk
+                elif flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                else:
+                    await flight._changed.wait()
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                # Nobody is listening any more: stop reading upstream
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                flight.task.cancel()
+                UPSTREAM_CANCELLED.inc()
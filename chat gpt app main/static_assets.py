@@ -0,0 +1,206 @@
+"""
+Static file serving for production.
+
+Text assets are compressed once (gzip, and brotli when the `brotli` package
+is installed) and the compressed copy is sent to clients that accept it, with
+ETag and Cache-Control headers so repeat visits are answered with 304s. The
+index page is rendered once and kept in memory.
+
+Compressed copies are written at build time:
+
+    python static_assets.py static
+"""
+import argparse
+import gzip
+import hashlib
+import mimetypes
+import os
+from typing import Callable, Dict, List, Optional
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+STATIC_CACHE_CONTROL = os.getenv("STATIC_CACHE_CONTROL", "public, max-age=3600")
+# The index references the other assets, so browsers revalidate it every time
+INDEX_CACHE_CONTROL = os.getenv("INDEX_CACHE_CONTROL", "no-cache")
+PRECOMPRESS_MIN_BYTES = int(os.getenv("PRECOMPRESS_MIN_BYTES", "256"))
+COMPRESSIBLE_SUFFIXES = (".html", ".htm", ".css", ".js", ".mjs", ".json", ".svg", ".txt", ".xml", ".map")
+
+# Content-Encoding -> file suffix, in order of preference
+ENCODINGS = {"br": ".br", "gzip": ".gz"}
+
+
+def _compressors() -> Dict[str, Callable[[bytes], bytes]]:
+    compressors = {"gzip": lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        compressors["br"] = lambda data: brotli.compress(data, quality=11)
+    return compressors
+
+
+def accepted_encodings(accept_encoding: str) -> List[str]:
+    """
+    Returns the supported encodings a client accepts, in order of preference.
+
+    Args:
+        accept_encoding (str): The request's Accept-Encoding header.
+    """
+    accepted = set()
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip())
+    return [encoding for encoding in ENCODINGS if encoding in accepted or "*" in accepted]
+
+
+def precompress(directory: str, min_bytes: int = PRECOMPRESS_MIN_BYTES) -> int:
+    """
+    Writes a compressed copy next to every text asset that is missing one or
+    whose copy is older than the asset. Safe to run from several workers at
+    once: copies are written to a temporary file and renamed into place.
+
+    Args:
+        directory (str): Static files directory.
+        min_bytes (int): Smaller files are not worth compressing.
+
+    Returns:
+        int: Number of compressed files written.
+    """
+    written = 0
+    compressors = _compressors()
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if not name.endswith(COMPRESSIBLE_SUFFIXES):
+                continue
+            path = os.path.join(root, name)
+            source_stat = os.stat(path)
+            if source_stat.st_size < min_bytes:
+                continue
+            data = None
+            for encoding, compress in compressors.items():
+                target = path + ENCODINGS[encoding]
+                try:
+                    if os.stat(target).st_mtime >= source_stat.st_mtime:
+                        continue
+                except FileNotFoundError:
+                    pass
+                if data is None:
+                    with open(path, "rb") as f:
+                        data = f.read()
+                temporary = f"{target}.{os.getpid()}.tmp"
+                with open(temporary, "wb") as f:
+                    f.write(compress(data))
+                os.replace(temporary, target)
+                written += 1
+    return written
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """
+    StaticFiles that serves `name.br` or `name.gz` in place of `name` when the
+    client accepts that encoding, and adds a Cache-Control header.
+    """
+
+    def __init__(self, *args, cache_control: str = STATIC_CACHE_CONTROL, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_control = cache_control
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope, status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        path = os.fspath(full_path)
+        response = None
+        if path.endswith(COMPRESSIBLE_SUFFIXES):
+            for encoding in accepted_encodings(request_headers.get("accept-encoding", "")):
+                encoded_path = path + ENCODINGS[encoding]
+                try:
+                    encoded_stat = os.stat(encoded_path)
+                except FileNotFoundError:
+                    continue
+                if encoded_stat.st_mtime < stat_result.st_mtime:
+                    continue  # stale copy
+                response = FileResponse(
+                    encoded_path,
+                    status_code=status_code,
+                    stat_result=encoded_stat,
+                    media_type=mimetypes.guess_type(path)[0] or "text/plain",
+                )
+                response.headers["content-encoding"] = encoding
+                break
+        if response is None:
+            response = FileResponse(full_path, status_code=status_code, stat_result=stat_result)
+        if path.endswith(COMPRESSIBLE_SUFFIXES):
+            response.headers["vary"] = "Accept-Encoding"
+        response.headers["cache-control"] = self.cache_control
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+class RenderedPage:
+    """
+    A template rendered once and served from memory, precompressed, with an
+    ETag. The template must not depend on the request.
+    """
+
+    def __init__(self, templates, name: str, cache_control: str = INDEX_CACHE_CONTROL):
+        """
+        Args:
+            templates (Jinja2Templates): The template loader.
+            name (str): Template name, e.g. "index.html".
+            cache_control (str): Cache-Control header of the page.
+        """
+        self.templates = templates
+        self.name = name
+        self.cache_control = cache_control
+        self.bodies: Optional[Dict[str, bytes]] = None
+        self.etags: Dict[str, str] = {}
+
+    def render(self) -> None:
+        """Renders and compresses the page; called on the first request if not before."""
+        body = self.templates.get_template(self.name).render().encode("utf-8")
+        bodies = {"identity": body}
+        for encoding, compress in _compressors().items():
+            bodies[encoding] = compress(body)
+        digest = hashlib.blake2b(body, digest_size=8).hexdigest()
+        self.etags = {encoding: f'"{digest}-{encoding}"' for encoding in bodies}
+        self.bodies = bodies
+
+    def response(self, request) -> Response:
+        """Returns the page, a compressed variant of it, or a 304."""
+        if self.bodies is None:
+            self.render()
+        encoding = next(
+            (e for e in accepted_encodings(request.headers.get("accept-encoding", "")) if e in self.bodies),
+            "identity",
+        )
+        headers = {"etag": self.etags[encoding], "cache-control": self.cache_control, "vary": "Accept-Encoding"}
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and self.etags[encoding] in [tag.strip() for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+        if encoding != "identity":
+            headers["content-encoding"] = encoding
+        return Response(self.bodies[encoding], media_type="text/html", headers=headers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write compressed copies of the static assets.")
+    parser.add_argument("directory", nargs="?", default=os.getenv("STATIC_DIR", "static"))
+    parser.add_argument("--min-bytes", type=int, default=PRECOMPRESS_MIN_BYTES)
+    args = parser.parse_args()
+    written = precompress(args.directory, args.min_bytes)
+    print(f"Wrote {written} compressed files in {args.directory}")
+
+
+if __name__ == "__main__":
+    main()
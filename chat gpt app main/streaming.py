@@ -0,0 +1,140 @@
+"""
+Streaming-path helpers: fast upstream chunk parsing, delta coalescing and
+SSE framing.
+"""
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from typing import AsyncIterator, Optional
+
+try:
+    import orjson
+
+    loads = orjson.loads
+except ImportError:  # orjson is optional; fall back to the standard library
+    loads = json.loads
+
+STREAM_FLUSH_INTERVAL = float(os.getenv("STREAM_FLUSH_INTERVAL", "0.05"))
+STREAM_FLUSH_BYTES = int(os.getenv("STREAM_FLUSH_BYTES", "1024"))
+
+_DONE = object()
+
+
+def parse_delta(data: str) -> Optional[str]:
+    """
+    Extracts the content delta from the payload of one upstream `data:` line.
+
+    Role-only, finish and keep-alive chunks carry no "content" key at all, so
+    they are skipped with a substring check instead of a JSON decode.
+
+    Args:
+        data (str): The text after "data: ".
+
+    Returns:
+        Optional[str]: The content delta, or None if the chunk has none.
+    """
+    if '"content"' not in data:
+        return None
+    content = loads(data)["choices"][0]["delta"].get("content")
+    return content or None
+
+
+def sse_event(text: str, event: Optional[str] = None) -> str:
+    """
+    Frames text as one server-sent event. Every line of the text gets its own
+    `data:` field, so embedded newlines survive the framing. `event` names the
+    event type; unnamed events are content deltas.
+    """
+    name = f"event: {event}\n" if event else ""
+    return name + "".join(f"data: {line}\n" for line in text.split("\n")) + "\n"
+
+
+async def coalesce(
+    source: AsyncIterator[str],
+    interval: float = STREAM_FLUSH_INTERVAL,
+    max_bytes: int = STREAM_FLUSH_BYTES,
+) -> AsyncIterator[str]:
+    """
+    Merges small deltas into larger flushes.
+
+    The first delta is flushed immediately so time-to-first-token is not
+    delayed. After that, deltas are buffered until `interval` seconds have
+    passed since the first buffered one or the buffer reaches `max_bytes`,
+    whichever comes first. The source is read by a separate task, so the time
+    window is honoured even while the upstream is silent.
+
+    Args:
+        source (AsyncIterator[str]): Content deltas.
+        interval (float): Maximum time a delta waits in the buffer.
+        max_bytes (int): Flush as soon as the buffer holds this many characters.
+
+    Yields:
+        str: Concatenated deltas.
+    """
+    pending = deque()
+    arrived = asyncio.Event()
+
+    async def pump():
+        try:
+            async for delta in source:
+                pending.append(delta)
+                arrived.set()
+        except Exception as e:
+            pending.append(e)
+        else:
+            pending.append(_DONE)
+        arrived.set()
+
+    async def next_item(timeout=None):
+        # Waiting on the event (never on the data itself) means a timeout
+        # cannot lose a delta
+        if not pending:
+            arrived.clear()
+            if timeout is None:
+                await arrived.wait()
+            else:
+                await asyncio.wait_for(arrived.wait(), timeout)
+        return pending.popleft()
+
+    pump_task = asyncio.get_running_loop().create_task(pump())
+    try:
+        item = await next_item()
+        yield_first = True
+        buffer = []
+        size = 0
+        deadline = 0.0
+        while item is not _DONE:
+            if isinstance(item, Exception):
+                # What arrived before the error still reaches the consumer
+                if buffer:
+                    yield "".join(buffer)
+                raise item
+            if yield_first:
+                yield_first = False
+                yield item
+            else:
+                if not buffer:
+                    deadline = time.monotonic() + interval
+                buffer.append(item)
+                size += len(item)
+                if size >= max_bytes:
+                    yield "".join(buffer)
+                    buffer = []
+                    size = 0
+            if buffer:
+                try:
+                    item = await next_item(max(deadline - time.monotonic(), 0))
+                    continue
+                except asyncio.TimeoutError:
+                    yield "".join(buffer)
+                    buffer = []
+                    size = 0
+            item = await next_item()
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        # Wait for the cancelled pump so the source is closed before we return
+        pump_task.cancel()
+        await asyncio.gather(pump_task, return_exceptions=True)
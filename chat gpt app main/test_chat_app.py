@@ -0,0 +1,1444 @@
+import asyncio
+import importlib
+import json
+import logging
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import httpx
+
+from admission import AdmissionController, AdmissionRejected, ConcurrencyLimiter, RateLimiter
+from batch import BATCH_MAX_ITEMS, fan_out
+from cache import ResponseCache, payload_key
+from compaction import SUMMARY_PREFIX, Compactor, prefix_hashes, summarize_with_router
+from loadtest import check_thresholds, percentile, run_load
+from metrics import CLIENT_DISCONNECTS, UPSTREAM_CANCELLED, UPSTREAM_HEDGE_WINS, UPSTREAM_RETRIES, Registry
+from mock_upstream import MockConfig, create_mock_app, serve_in_thread, stop_server
+from providers import AnthropicBackend, Backend, BackendRouter, GeminiBackend, NoBackendAvailable, OpenAIBackend, merge_turns
+from server import server_options
+from sessions import InMemorySessionStore, SQLiteSessionStore
+from singleflight import SingleFlight
+from static_assets import PrecompressedStaticFiles, RenderedPage, accepted_encodings, precompress
+from streaming import coalesce, parse_delta, sse_event
+from tokens import TokenCounter, TOKENS_PER_MESSAGE, REPLY_PRIMING_TOKENS
+from upstream import UpstreamError
+from upstream_pool import UpstreamPool
+
+
+class WordEncoder:
+    """Stand-in for a tiktoken encoding: one token per whitespace-separated word."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def encode(self, text):
+        self.calls += 1
+        return text.split()
+
+
+def conversation(turns, words_per_turn=10):
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    for i in range(turns):
+        role = "user" if i % 2 == 0 else "assistant"
+        messages.append({"role": role, "content": " ".join([f"w{i}"] * words_per_turn)})
+    return messages
+
+
+class TestTokenCounter(unittest.TestCase):
+
+    def setUp(self):
+        self.encoder = WordEncoder()
+        self.counter = TokenCounter(self.encoder, max_entries=100)
+
+    def test_count_message_includes_format_overhead(self):
+        """Test that role, content and per-message overhead are all counted."""
+        message = {"role": "user", "content": "hello there"}
+        self.assertEqual(self.counter.count_message(message), TOKENS_PER_MESSAGE + 1 + 2)
+        named = {"role": "user", "name": "bob", "content": "hello there"}
+        self.assertEqual(self.counter.count_message(named), TOKENS_PER_MESSAGE + 1 + 1 + 1 + 2)
+
+    def test_repeated_history_is_not_reencoded(self):
+        """Test that counting the same conversation twice hits the cache."""
+        messages = conversation(20)
+        first = self.counter.count_messages(messages)
+        calls = self.encoder.calls
+        second = self.counter.count_messages(messages)
+        self.assertEqual(first, second)
+        self.assertEqual(self.encoder.calls, calls)
+        self.assertGreater(self.counter.hits, 0)
+
+    def test_cache_is_bounded(self):
+        """Test that the cache evicts least recently used entries."""
+        for i in range(250):
+            self.counter.count_text(f"text {i}")
+        self.assertEqual(len(self.counter._cache), 100)
+
+    def test_trim_keeps_newest_messages_within_budget(self):
+        """Test that trimming drops the oldest history and keeps system and newest."""
+        messages = conversation(30)
+        result = self.counter.trim(messages, max_tokens=100)
+        self.assertLessEqual(result.token_count, 100)
+        self.assertIs(result.messages[0], messages[0])
+        self.assertEqual(result.messages[1:], messages[len(messages) - len(result.messages) + 1:])
+        self.assertEqual(result.token_count, self.counter.count_messages(result.messages))
+        self.assertEqual(result.trimmed_messages, len(messages) - len(result.messages))
+        self.assertEqual(
+            result.trimmed_tokens,
+            self.counter.count_messages(messages) - result.token_count,
+        )
+
+    def test_trim_without_overflow_keeps_everything(self):
+        """Test that a conversation within budget is left untouched."""
+        messages = conversation(4)
+        result = self.counter.trim(messages, max_tokens=4000)
+        self.assertEqual(result.messages, messages)
+        self.assertEqual(result.trimmed_messages, 0)
+        self.assertEqual(result.token_count - REPLY_PRIMING_TOKENS, sum(result.counts))
+
+
+class SlowEncoder(WordEncoder):
+    """Word encoder that takes 1 ms per 1000 characters and, like tiktoken, releases the GIL."""
+
+    def encode(self, text):
+        time.sleep(len(text) / 1_000_000)
+        return super().encode(text)
+
+    def encode_batch(self, texts, num_threads=1):
+        return [self.encode(text) for text in texts]
+
+
+class TestNonBlockingTokenization(unittest.IsolatedAsyncioTestCase):
+
+    async def small_request_ttfts(self, counter, huge_history):
+        small = conversation(4)
+        loop = asyncio.get_running_loop()
+
+        async def small_request():
+            started = loop.time()
+            await counter.trim_async(small, 4000)
+            await asyncio.sleep(0)  # Stands in for sending the first token
+            return loop.time() - started
+
+        huge = asyncio.create_task(counter.trim_async(huge_history, 4000))
+        ttfts = []
+        while not huge.done():
+            ttfts.append(await small_request())
+            await asyncio.sleep(0.005)
+        await huge
+        return ttfts
+
+    async def test_small_requests_stay_fast_during_huge_tokenization(self):
+        """Test that a huge history is tokenized off the loop so small requests' TTFT stays flat."""
+        huge_history = conversation(50, words_per_turn=2000)  # ~500 ms of encoding
+        counter = TokenCounter(SlowEncoder(), offload_chars=20000)
+        try:
+            ttfts = await self.small_request_ttfts(counter, huge_history)
+        finally:
+            counter.close()
+        self.assertEqual(counter.offloaded, 1)
+        self.assertGreater(len(ttfts), 10)
+        self.assertLess(max(ttfts), 0.1)
+
+    async def test_inline_tokenization_blocks_the_loop(self):
+        """Test the baseline: without offloading, small requests wait for the huge one."""
+        huge_history = conversation(50, words_per_turn=2000)
+        counter = TokenCounter(SlowEncoder(), offload_chars=10 ** 12)
+        ttfts = await self.small_request_ttfts(counter, huge_history)
+        self.assertGreater(max(ttfts), 0.3)
+
+    async def test_async_counts_match_sync_counts(self):
+        """Test that offloaded counting gives the same numbers as inline counting."""
+        messages = conversation(10, words_per_turn=500)
+        offloaded = TokenCounter(WordEncoder(), offload_chars=1)
+        try:
+            counts = await offloaded.count_each_async(messages)
+        finally:
+            offloaded.close()
+        inline = TokenCounter(WordEncoder())
+        self.assertEqual(counts, [inline.count_message(message) for message in messages])
+
+
+class TestCompaction(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.calls = []
+        self.fail = False
+        self.counter = TokenCounter(WordEncoder())
+        self.compactor = Compactor(self.counter, self.summarize)
+
+    async def summarize(self, previous, turns):
+        self.calls.append((previous, [turn["content"] for turn in turns]))
+        if self.fail:
+            raise RuntimeError("summarizer down")
+        await asyncio.sleep(0)
+        return f"summary of {len(self.calls)}"
+
+    def prompt(self, turns):
+        return conversation(turns) + [{"role": "user", "content": "new question"}]
+
+    async def test_no_summary_when_everything_fits(self):
+        """Test that a prompt within budget is left alone."""
+        result = await self.compactor.compact(self.prompt(4), 1000)
+        self.assertEqual(result.trimmed_messages, 0)
+        await self.compactor.drain()
+        self.assertEqual(self.calls, [])
+
+    async def test_summary_replaces_dropped_turns(self):
+        """Test that dropped turns are summarized in the background and used on the next request."""
+        messages = self.prompt(20)
+        first = await self.compactor.compact(messages, 100)
+        # No summary yet: plain trimming, summary written off the request path
+        self.assertGreater(first.trimmed_messages, 0)
+        self.assertNotIn(SUMMARY_PREFIX, str(first.messages))
+        await self.compactor.drain()
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(len(self.calls[0][1]), first.trimmed_messages)
+
+        second = await self.compactor.compact(messages, 100)
+        self.assertEqual(second.messages[1]["content"], SUMMARY_PREFIX + "summary of 1")
+        self.assertLessEqual(second.token_count, 100)
+        self.assertEqual(second.token_count, sum(second.counts) + REPLY_PRIMING_TOKENS)
+        self.assertEqual(second.messages[-1]["content"], "new question")
+        self.assertEqual(self.compactor.hits, 1)
+
+    async def test_summary_is_extended_incrementally(self):
+        """Test that later turns only summarize the newly dropped messages on top of the cached summary."""
+        messages = self.prompt(20)
+        await self.compactor.compact(messages, 100)
+        await self.compactor.drain()
+        await self.compactor.compact(messages, 100)
+        await self.compactor.drain()
+        longer = messages[:-1] + [{"role": "assistant", "content": "w20 " * 10}, {"role": "user", "content": "w21 " * 10}, messages[-1]]
+        await self.compactor.compact(longer, 100)
+        await self.compactor.drain()
+        previous, turns = self.calls[-1]
+        self.assertIsNotNone(previous)
+        self.assertLess(len(turns), len(self.calls[0][1]))
+        result = await self.compactor.compact(longer, 100)
+        self.assertEqual(result.messages[1]["content"], SUMMARY_PREFIX + f"summary of {len(self.calls)}")
+
+    async def test_concurrent_requests_share_one_summary(self):
+        """Test that the same prefix is only summarized once at a time."""
+        messages = self.prompt(20)
+        await asyncio.gather(*(self.compactor.compact(messages, 100) for _ in range(5)))
+        await self.compactor.drain()
+        self.assertEqual(len(self.calls), 1)
+
+    async def test_failed_summary_falls_back_to_trimming(self):
+        """Test that a summarizer error is counted and the prompt is still trimmed."""
+        self.fail = True
+        messages = self.prompt(20)
+        await self.compactor.compact(messages, 100)
+        await self.compactor.drain()
+        result = await self.compactor.compact(messages, 100)
+        self.assertEqual(self.compactor.failures, 1)
+        self.assertNotIn(SUMMARY_PREFIX, str(result.messages))
+        self.assertLessEqual(result.token_count, 100)
+
+    async def test_summaries_go_through_router_and_admission(self):
+        """Test that a summary is routed like a request and holds an admission slot while it streams."""
+        backend = FakeBackend("fast")
+        admission = AdmissionController(max_concurrent=1, queue_timeout=0.05, model_budgets={})
+        held = []
+        stream = backend.stream
+
+        async def recording_stream(messages):
+            held.append(admission.global_limiter.active)
+            async for content in stream(messages):
+                yield content
+
+        backend.stream = recording_stream
+        summary = await summarize_with_router(BackendRouter([backend], explore=0), admission, None, conversation(2))
+        self.assertEqual(summary, "fast")
+        self.assertEqual(held, [1])
+        self.assertEqual(admission.global_limiter.active, 0)
+
+    def test_prefix_hashes_identify_prefixes(self):
+        """Test that prefix hashes depend on the whole prefix, not just the last message."""
+        a = prefix_hashes(conversation(4))
+        b = prefix_hashes(conversation(6))
+        self.assertEqual(a, b[:len(a)])
+        changed = conversation(4)
+        changed[1]["content"] = "different"
+        self.assertNotEqual(prefix_hashes(changed)[-1], a[-1])
+
+
+class SessionStoreTests:
+    """Behaviour shared by every session store backend."""
+
+    def make_store(self, **kwargs):
+        raise NotImplementedError
+
+    def test_append_and_load(self):
+        """Test that appended turns come back in order with their token counts."""
+        store = self.make_store()
+        store.append("c1", [{"role": "user", "content": "hi"}], [5])
+        store.append("c1", [{"role": "assistant", "content": "hello"}], [6])
+        messages, counts = store.load("c1")
+        self.assertEqual([m["content"] for m in messages], ["hi", "hello"])
+        self.assertEqual(counts, [5, 6])
+
+    def test_unknown_conversation_is_empty(self):
+        """Test that loading an unknown conversation returns no history."""
+        self.assertEqual(self.make_store().load("missing"), ([], []))
+
+    def test_ttl_expiry(self):
+        """Test that idle conversations expire."""
+        store = self.make_store(ttl=0.05)
+        store.append("c1", [{"role": "user", "content": "hi"}], [5])
+        time.sleep(0.1)
+        self.assertEqual(store.load("c1"), ([], []))
+
+    def test_lru_eviction(self):
+        """Test that the least recently used conversation is evicted first."""
+        store = self.make_store(max_sessions=2)
+        store.append("c1", [{"role": "user", "content": "one"}], [1])
+        store.append("c2", [{"role": "user", "content": "two"}], [1])
+        store.load("c1")
+        store.append("c3", [{"role": "user", "content": "three"}], [1])
+        self.assertEqual(store.load("c2"), ([], []))
+        self.assertEqual(len(store.load("c1")[0]), 1)
+        self.assertEqual(len(store.load("c3")[0]), 1)
+
+    def test_delete(self):
+        """Test that a deleted conversation is forgotten."""
+        store = self.make_store()
+        store.append("c1", [{"role": "user", "content": "hi"}], [5])
+        store.delete("c1")
+        self.assertEqual(store.load("c1"), ([], []))
+
+
+class TestInMemorySessionStore(SessionStoreTests, unittest.TestCase):
+
+    def make_store(self, **kwargs):
+        return InMemorySessionStore(**kwargs)
+
+    def test_memory_cap(self):
+        """Test that stored messages stay within the memory cap."""
+        store = InMemorySessionStore(max_bytes=10000)
+        for i in range(100):
+            store.append(f"c{i}", [{"role": "user", "content": "x" * 500}], [100])
+        self.assertLessEqual(store.total_bytes, 10000)
+        self.assertEqual(len(store.load("c99")[0]), 1)
+
+
+class TestSQLiteSessionStore(SessionStoreTests, unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        self.tmpdir.cleanup()
+
+    def make_store(self, **kwargs):
+        store = SQLiteSessionStore(os.path.join(self.tmpdir.name, "sessions.db"), **kwargs)
+        self.stores.append(store)
+        return store
+
+    def test_sessions_are_shared_between_connections(self):
+        """Test that two stores on the same file (two workers) see the same sessions."""
+        first, second = self.make_store(), self.make_store()
+        first.append("c1", [{"role": "user", "content": "hi"}], [5])
+        self.assertEqual(second.load("c1"), ([{"role": "user", "content": "hi"}], [5]))
+
+    def test_async_calls_run_off_the_event_loop(self):
+        """Test that load_async and append_async do their sqlite3 work in a worker thread."""
+        store = self.make_store()
+        threads = []
+        load, append = store.load, store.append
+
+        def recording(method):
+            def call(*args):
+                threads.append(threading.get_ident())
+                return method(*args)
+            return call
+
+        async def turn():
+            await store.append_async("c1", [{"role": "user", "content": "hi"}], [5])
+            return await store.load_async("c1")
+
+        with mock.patch.object(store, "load", recording(load)), mock.patch.object(store, "append", recording(append)):
+            self.assertEqual(asyncio.run(turn()), ([{"role": "user", "content": "hi"}], [5]))
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.get_ident(), threads)
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def test_key_is_normalized(self):
+        """Test that key order and non-prompt fields do not change the cache key."""
+        first = payload_key("gpt-3.5-turbo", [{"role": "user", "content": "hi"}])
+        second = payload_key("gpt-3.5-turbo", [{"content": "hi", "role": "user", "id": 7}])
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, payload_key("gpt-4", [{"role": "user", "content": "hi"}]))
+
+    def test_hit_and_miss_counters(self):
+        """Test that lookups are counted as hits or misses."""
+        cache = ResponseCache()
+        self.assertIsNone(cache.get("k"))
+        cache.put("k", ["Hello", " world"])
+        self.assertEqual(cache.get("k"), ["Hello", " world"])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_lru_eviction_by_size(self):
+        """Test that the least recently used responses are evicted when full."""
+        cache = ResponseCache(max_bytes=10)
+        cache.put("a", ["xxxx"])
+        cache.put("b", ["xxxx"])
+        cache.get("a")
+        cache.put("c", ["xxxx"])
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("a"))
+        self.assertLessEqual(cache.total_bytes, 10)
+
+    def test_ttl(self):
+        """Test that expired responses are not served."""
+        cache = ResponseCache(ttl=0.05)
+        cache.put("k", ["x"])
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("k"))
+
+
+class TestSingleFlight(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.opened = 0
+        self.release = asyncio.Event()
+
+    async def upstream(self, chunks=("a", "b", "c", "d")):
+        self.opened += 1
+        yield chunks[0]
+        await self.release.wait()
+        for chunk in chunks[1:]:
+            yield chunk
+            await asyncio.sleep(0)
+
+    async def collect(self, iterator, delay=0.0):
+        received = []
+        async for chunk in iterator:
+            received.append(chunk)
+            await asyncio.sleep(delay)
+        return received
+
+    async def test_identical_requests_share_one_upstream_stream(self):
+        """Test that concurrent identical requests open a single upstream stream."""
+        flights = SingleFlight()
+        completed = []
+        first = asyncio.create_task(self.collect(flights.stream("k", self.upstream, completed.append)))
+        await asyncio.sleep(0.01)
+        # Late subscribers get the chunks already received plus the live tail
+        others = [asyncio.create_task(self.collect(flights.stream("k", self.upstream))) for _ in range(5)]
+        await asyncio.sleep(0.01)
+        self.release.set()
+        results = await asyncio.gather(first, *others)
+        self.assertEqual(self.opened, 1)
+        self.assertEqual(flights.coalesced, 5)
+        for result in results:
+            self.assertEqual(result, ["a", "b", "c", "d"])
+        self.assertEqual(completed, [["a", "b", "c", "d"]])
+        self.assertEqual(flights.in_flight, 0)
+
+    async def test_slow_subscriber_does_not_stall_others(self):
+        """Test that a slow reader does not hold back the upstream or fast readers."""
+        flights = SingleFlight()
+        chunks = tuple(str(i) for i in range(20))
+        self.release.set()
+        slow = asyncio.create_task(self.collect(flights.stream("k", lambda: self.upstream(chunks)), delay=0.01))
+        fast = asyncio.create_task(self.collect(flights.stream("k", lambda: self.upstream(chunks))))
+        self.assertEqual(await asyncio.wait_for(fast, timeout=0.5), list(chunks))
+        self.assertFalse(slow.done())
+        self.assertEqual(await slow, list(chunks))
+
+    async def test_upstream_cancelled_when_all_subscribers_leave(self):
+        """Test that the upstream stream stops once nobody is listening."""
+        flights = SingleFlight()
+        iterator = flights.stream("k", self.upstream)
+        self.assertEqual(await iterator.__anext__(), "a")
+        await iterator.aclose()
+        await asyncio.sleep(0)
+        self.assertEqual(flights.in_flight, 0)
+        # The next identical request opens a fresh upstream stream
+        self.release.set()
+        self.assertEqual(await self.collect(flights.stream("k", self.upstream)), ["a", "b", "c", "d"])
+        self.assertEqual(self.opened, 2)
+
+
+class TestStreaming(unittest.IsolatedAsyncioTestCase):
+
+    def test_parse_delta(self):
+        """Test that content is extracted and content-free chunks are skipped."""
+        self.assertEqual(parse_delta('{"choices":[{"delta":{"content":"Hi"}}]}'), "Hi")
+        self.assertIsNone(parse_delta('{"choices":[{"delta":{"role":"assistant"}}]}'))
+        self.assertIsNone(parse_delta('{"choices":[{"delta":{},"finish_reason":"stop"}]}'))
+
+    def test_sse_event_framing(self):
+        """Test that every line of a delta gets its own data field."""
+        self.assertEqual(sse_event("Hi"), "data: Hi\n\n")
+        self.assertEqual(sse_event("a\nb"), "data: a\ndata: b\n\n")
+        self.assertEqual(sse_event("{}", event="error"), "event: error\ndata: {}\n\n")
+
+    async def deltas(self, count, delay):
+        for i in range(count):
+            yield f"t{i} "
+            await asyncio.sleep(delay)
+
+    async def test_coalesce_batches_within_time_window(self):
+        """Test that deltas are merged into fewer flushes without losing any."""
+        flushes = [chunk async for chunk in coalesce(self.deltas(40, 0.001), interval=0.02, max_bytes=10000)]
+        self.assertEqual("".join(flushes), "".join(f"t{i} " for i in range(40)))
+        self.assertEqual(flushes[0], "t0 ")
+        self.assertLess(len(flushes), 20)
+
+    async def test_coalesce_respects_byte_budget(self):
+        """Test that a flush is emitted once the byte budget is reached."""
+        flushes = [chunk async for chunk in coalesce(self.deltas(40, 0), interval=10, max_bytes=12)]
+        self.assertEqual("".join(flushes), "".join(f"t{i} " for i in range(40)))
+        self.assertTrue(all(len(flush) < 12 + 4 for flush in flushes))
+
+    async def test_coalesce_propagates_errors(self):
+        """Test that an upstream error reaches the consumer."""
+        async def failing():
+            yield "a"
+            raise RuntimeError("upstream broke")
+
+        with self.assertRaises(RuntimeError):
+            async for _ in coalesce(failing()):
+                pass
+
+    async def test_coalesce_flushes_buffer_before_error(self):
+        """Test that deltas buffered when the source fails are flushed before the error."""
+        async def failing():
+            for i in range(5):
+                yield f"t{i} "
+            raise RuntimeError("upstream broke")
+
+        flushes = []
+        with self.assertRaises(RuntimeError):
+            async for chunk in coalesce(failing(), interval=10, max_bytes=10000):
+                flushes.append(chunk)
+        self.assertEqual(flushes, ["t0 ", "t1 t2 t3 t4 "])
+
+    async def test_coalesce_closes_source_on_close(self):
+        """Test that closing the coalesced stream closes the source before aclose returns."""
+        closed = []
+
+        async def endless():
+            try:
+                while True:
+                    yield "x"
+                    await asyncio.sleep(0.001)
+            finally:
+                closed.append(True)
+
+        flushes = coalesce(endless(), interval=10, max_bytes=10000)
+        self.assertEqual(await flushes.__anext__(), "x")
+        await flushes.aclose()
+        self.assertEqual(closed, [True])
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_prometheus_text_format(self):
+        """Test counters, gauges and histograms in the Prometheus text format."""
+        registry = Registry()
+        requests = registry.counter("requests_total", "Requests.", ["status"])
+        in_flight = registry.gauge("in_flight", "In flight.")
+        latency = registry.histogram("latency_seconds", "Latency.", buckets=(0.1, 1.0))
+        requests.inc(status="200")
+        requests.inc(2, status="429")
+        in_flight.inc()
+        in_flight.dec()
+        latency.observe(0.05)
+        latency.observe(0.5)
+        latency.observe(5)
+
+        text = registry.render()
+        self.assertIn("# TYPE requests_total counter\n", text)
+        self.assertIn('requests_total{status="429"} 2\n', text)
+        self.assertIn("in_flight 0\n", text)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1\n', text)
+        self.assertIn('latency_seconds_bucket{le="1"} 2\n', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 3\n', text)
+        self.assertIn("latency_seconds_count 3\n", text)
+
+    def test_duplicate_registration_is_rejected(self):
+        """Test that a metric name can only be registered once."""
+        registry = Registry()
+        registry.counter("requests_total", "Requests.")
+        with self.assertRaises(ValueError):
+            registry.counter("requests_total", "Requests.")
+
+
+class TestAdmission(unittest.IsolatedAsyncioTestCase):
+
+    async def test_queue_full_is_rejected_with_retry_after(self):
+        """Test that requests beyond the wait queue are rejected with 503."""
+        limiter = ConcurrencyLimiter("test", max_concurrent=1, max_queue=1, queue_timeout=1)
+        await limiter.acquire()
+        waiting = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        self.assertEqual(limiter.queue_depth, 1)
+        with self.assertRaises(AdmissionRejected) as ctx:
+            await limiter.acquire()
+        self.assertEqual(ctx.exception.status_code, 503)
+        self.assertGreaterEqual(ctx.exception.retry_after, 1)
+        limiter.release()
+        await waiting
+        self.assertEqual(limiter.active, 1)
+
+    async def test_queue_timeout(self):
+        """Test that a request waiting longer than the queue timeout is rejected."""
+        limiter = ConcurrencyLimiter("test", max_concurrent=1, max_queue=5, queue_timeout=0.05)
+        await limiter.acquire()
+        with self.assertRaises(AdmissionRejected):
+            await limiter.acquire()
+        self.assertEqual(limiter.queue_depth, 0)
+        limiter.release()
+        self.assertEqual(limiter.active, 0)
+
+    async def test_slots_are_handed_over_in_order(self):
+        """Test that waiters are admitted first in, first out."""
+        limiter = ConcurrencyLimiter("test", max_concurrent=1, max_queue=5, queue_timeout=1)
+        await limiter.acquire()
+        admitted = []
+
+        async def wait(name):
+            await limiter.acquire()
+            admitted.append(name)
+
+        tasks = [asyncio.create_task(wait(name)) for name in "abc"]
+        await asyncio.sleep(0)
+        for _ in range(3):
+            limiter.release()
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        self.assertEqual(admitted, ["a", "b", "c"])
+
+    async def test_model_budget(self):
+        """Test that a per-model budget applies on top of the global limit."""
+        controller = AdmissionController(max_concurrent=10, queue_timeout=0.05, model_budgets={"gpt-4": 1})
+        release = await controller.admit("gpt-4")
+        with self.assertRaises(AdmissionRejected):
+            await controller.admit("gpt-4")
+        other = await controller.admit("gpt-3.5-turbo")
+        release()
+        release()  # Releasing twice is harmless
+        other()
+        self.assertEqual(controller.global_limiter.active, 0)
+
+    async def test_backend_budget_keys(self):
+        """Test that a backend's budget is found by its provider:model name or by its model."""
+        controller = AdmissionController(queue_timeout=0.05, model_budgets={"fake:a": 1, "b": 1})
+        for backend in (FakeBackend("a"), FakeBackend("b")):
+            release = await controller.admit_backend(backend)
+            with self.assertRaises(AdmissionRejected):
+                await controller.admit_backend(backend)
+            release()
+        release = await controller.admit_backend(FakeBackend("c"))
+        release()
+        self.assertEqual(controller.global_limiter.active, 0)
+
+    def test_rate_limiter(self):
+        """Test that a client exceeding its bucket gets a 429 while others do not."""
+        limiter = RateLimiter(rate_per_minute=60, burst=3)
+        for _ in range(3):
+            limiter.check("a")
+        with self.assertRaises(AdmissionRejected) as ctx:
+            limiter.check("a")
+        self.assertEqual(ctx.exception.status_code, 429)
+        limiter.check("b")
+
+    def test_rate_limiter_is_off_by_default(self):
+        """Test that the default rate limiter admits any number of requests."""
+        limiter = AdmissionController().rate_limiter
+        for _ in range(1000):
+            limiter.check("a")
+
+
+class TestLoadTestReport(unittest.TestCase):
+
+    def test_percentile(self):
+        """Test percentile interpolation."""
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0), 1)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertAlmostEqual(percentile(values, 50), 50.5)
+        self.assertIsNone(percentile([], 50))
+
+    def test_thresholds(self):
+        """Test that violated thresholds are reported."""
+        report = {"ttft_ms": {"p95": 120.0, "p99": 300.0}, "error_rate": 0.02, "throughput_rps": 50.0}
+        self.assertEqual(check_thresholds(report, max_p95_ttft_ms=200, max_error_rate=0.05), [])
+        failures = check_thresholds(report, max_p99_ttft_ms=250, min_throughput_rps=100)
+        self.assertEqual(len(failures), 2)
+
+
+class TestUpstreamPool(unittest.IsolatedAsyncioTestCase):
+    payload = {"model": "gpt-3.5-turbo", "messages": [], "stream": True}
+
+    async def asyncSetUp(self):
+        self.client = httpx.AsyncClient()
+        self.servers = []
+
+    async def asyncTearDown(self):
+        await self.client.aclose()
+        for server in self.servers:
+            stop_server(server)
+
+    def mock(self, **config):
+        app = create_mock_app(MockConfig(tokens=5, **config))
+        server, base_url = serve_in_thread(app)
+        self.servers.append(server)
+        return app, base_url + "/v1"
+
+    def pool(self, urls, **options):
+        options.setdefault("hedge_initial_delay", 0.1)
+        options.setdefault("backoff_base", 0.01)
+        return UpstreamPool(self.client, urls, **options)
+
+    async def collect(self, pool):
+        return [chunk async for chunk in pool.stream("key", self.payload)]
+
+    async def test_hedge_wins_over_slow_first_token(self):
+        """Test that a late first token triggers a hedge and the loser is cancelled."""
+        slow, slow_url = self.mock(first_token_delay=2.0)
+        fast, fast_url = self.mock()
+        wins = UPSTREAM_HEDGE_WINS.value()
+        start = time.perf_counter()
+        chunks = await self.collect(self.pool([slow_url, fast_url]))
+        self.assertLess(time.perf_counter() - start, 1.0)
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual(UPSTREAM_HEDGE_WINS.value(), wins + 1)
+        deadline = time.monotonic() + 2
+        while slow.state.disconnects == 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        self.assertEqual(slow.state.disconnects, 1)
+        self.assertEqual(slow.state.chunks_sent, 0)
+
+    async def test_no_hedge_when_disabled(self):
+        """Test that max_hedges=0 waits for the primary."""
+        slow, slow_url = self.mock(first_token_delay=0.3)
+        fast, fast_url = self.mock()
+        chunks = await self.collect(self.pool([slow_url, fast_url], max_hedges=0))
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual(fast.state.requests, 0)
+
+    async def test_failover_on_error_before_streaming(self):
+        """Test that a retryable error fails over to the next endpoint."""
+        broken, broken_url = self.mock(error_rate=1.0, error_status=503)
+        healthy, healthy_url = self.mock()
+        retries = UPSTREAM_RETRIES.value()
+        pool = self.pool([broken_url, healthy_url])
+        chunks = await self.collect(pool)
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual(broken.state.requests, 1)
+        self.assertEqual(UPSTREAM_RETRIES.value(), retries + 1)
+        self.assertEqual(pool.endpoints[0].failures, 1)
+        self.assertEqual(pool.endpoints[1].successes, 1)
+
+    async def test_retries_are_bounded(self):
+        """Test that retryable errors are retried up to the limit and then raised."""
+        broken, broken_url = self.mock(error_rate=1.0, error_status=500)
+        with self.assertRaises(UpstreamError):
+            await self.collect(self.pool([broken_url], retries=2))
+        self.assertEqual(broken.state.requests, 3)
+
+    async def test_client_errors_are_not_retried(self):
+        """Test that a non-retryable status is raised at once."""
+        broken, broken_url = self.mock(error_rate=1.0, error_status=400)
+        pool = self.pool([broken_url])
+        with self.assertRaises(UpstreamError) as ctx:
+            await self.collect(pool)
+        self.assertEqual(ctx.exception.status_code, 400)
+        self.assertEqual(broken.state.requests, 1)
+        self.assertEqual(pool.endpoints[0].failures, 0)
+
+    async def test_client_error_cancels_pending_hedges(self):
+        """Test that a non-retryable error on a hedge cancels the slow primary before it is raised."""
+        slow, slow_url = self.mock(first_token_delay=2.0)
+        broken, broken_url = self.mock(error_rate=1.0, error_status=400)
+        pool = self.pool([slow_url, broken_url])
+        start = time.perf_counter()
+        with self.assertRaises(UpstreamError) as ctx:
+            await self.collect(pool)
+        self.assertLess(time.perf_counter() - start, 1.0)
+        self.assertEqual(ctx.exception.status_code, 400)
+        self.assertEqual([endpoint.failures for endpoint in pool.endpoints], [0, 0])
+        deadline = time.monotonic() + 2
+        while slow.state.disconnects == 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        self.assertEqual(slow.state.disconnects, 1)
+        self.assertEqual(slow.state.chunks_sent, 0)
+
+    async def test_no_retry_after_streaming_started(self):
+        """Test that a stream failing midway is not retried."""
+        flaky, flaky_url = self.mock(stream_error_rate=1.0)
+        chunks = []
+        with self.assertRaises(httpx.TransportError):
+            async for chunk in self.pool([flaky_url]).stream("key", self.payload):
+                chunks.append(chunk)
+        self.assertTrue(chunks)
+        self.assertEqual(flaky.state.requests, 1)
+
+    def test_unhealthy_endpoints_are_tried_last(self):
+        """Test that repeated failures put an endpoint in cooldown."""
+        pool = UpstreamPool(None, ["http://a", "http://b"], failure_threshold=2, cooldown=60)
+        first = pool.endpoints[0]
+        first.record_failure()
+        self.assertTrue(first.healthy)
+        first.record_failure()
+        self.assertFalse(first.healthy)
+        self.assertEqual([e.base_url for e in pool.ordered_endpoints()], ["http://b", "http://a"])
+        self.assertEqual(pool.healthy_endpoints, 1)
+        first.record_success()
+        self.assertTrue(first.healthy)
+
+    def test_hedge_delay_tracks_percentile(self):
+        """Test that the hedge delay follows recent first-token latencies within its bounds."""
+        pool = UpstreamPool(None, ["http://a"], hedge_initial_delay=1.0, hedge_min_samples=10, hedge_min_delay=0.01, hedge_max_delay=0.5)
+        self.assertEqual(pool.hedge_delay(), 0.5)
+        pool._first_token_latencies.extend([0.02] * 95 + [0.3] * 5)
+        self.assertEqual(pool.hedge_delay(), 0.02)
+        pool._first_token_latencies.extend([0.4] * 100)
+        self.assertEqual(pool.hedge_delay(), 0.4)
+
+
+class FakeBackend(Backend):
+    provider = "fake"
+
+    def __init__(self, model, delay=0.0, fail=False):
+        super().__init__(model)
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+
+    async def stream(self, messages):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise UpstreamError(503, b"down")
+        yield self.model
+
+
+class TestProviders(unittest.IsolatedAsyncioTestCase):
+    messages = [
+        {"role": "system", "content": "Be brief."},
+        {"role": "user", "content": "Hi"},
+        {"role": "user", "content": "Are you there?"},
+        {"role": "assistant", "content": "Yes."},
+        {"role": "user", "content": "Good."},
+    ]
+    reply = "tok0 tok1 tok2 tok3 tok4 "
+
+    async def asyncSetUp(self):
+        self.client = httpx.AsyncClient()
+        self.stub = create_mock_app(MockConfig(tokens=5))
+        self.server, self.base_url = serve_in_thread(self.stub)
+
+    async def asyncTearDown(self):
+        await self.client.aclose()
+        stop_server(self.server)
+
+    async def collect(self, stream):
+        return "".join([chunk async for chunk in stream])
+
+    async def test_openai_adapter(self):
+        """Test the OpenAI adapter against the chat completions stub."""
+        backend = OpenAIBackend("gpt-4o-mini", UpstreamPool(self.client, [self.base_url + "/v1"]), "key")
+        self.assertEqual(await self.collect(backend.stream(self.messages)), self.reply)
+        self.assertEqual(self.stub.state.last_request["model"], "gpt-4o-mini")
+
+    async def test_anthropic_adapter(self):
+        """Test the Anthropic adapter against the Messages stream stub."""
+        backend = AnthropicBackend("claude-test", self.client, "key", base_url=self.base_url + "/v1")
+        self.assertEqual(await self.collect(backend.stream(self.messages)), self.reply)
+        body = self.stub.state.last_request
+        self.assertEqual(body["system"], "Be brief.")
+        self.assertEqual([m["role"] for m in body["messages"]], ["user", "assistant", "user"])
+        self.assertEqual(body["messages"][0]["content"], "Hi\n\nAre you there?")
+        self.assertIn("max_tokens", body)
+
+    async def test_adapters_leave_connections_reusable(self):
+        """Test that each adapter reads its stream to the end, so one connection serves repeated requests."""
+        for backend in (
+            OpenAIBackend("gpt-4o-mini", UpstreamPool(self.client, [self.base_url + "/v1"]), "key"),
+            AnthropicBackend("claude-test", self.client, "key", base_url=self.base_url + "/v1"),
+            GeminiBackend("gemini-test", self.client, "key", base_url=self.base_url + "/v1beta"),
+        ):
+            for _ in range(2):
+                self.assertEqual(await self.collect(backend.stream(self.messages)), self.reply)
+            self.assertEqual(len(self.client._transport._pool.connections), 1, backend.name)
+
+    async def test_gemini_adapter(self):
+        """Test the Gemini adapter against the streamGenerateContent SSE stub."""
+        backend = GeminiBackend("gemini-test", self.client, "key", base_url=self.base_url + "/v1beta")
+        self.assertEqual(await self.collect(backend.stream(self.messages)), self.reply)
+        body = self.stub.state.last_request
+        self.assertEqual(body["systemInstruction"], {"parts": [{"text": "Be brief."}]})
+        self.assertEqual([c["role"] for c in body["contents"]], ["user", "model", "user"])
+
+    async def test_adapters_raise_on_error_status(self):
+        """Test that provider error statuses become UpstreamError."""
+        self.stub.state.config = MockConfig(error_rate=1.0, error_status=429)
+        for backend in (
+            AnthropicBackend("claude-test", self.client, "key", base_url=self.base_url + "/v1"),
+            GeminiBackend("gemini-test", self.client, "key", base_url=self.base_url + "/v1beta"),
+        ):
+            with self.assertRaises(UpstreamError) as ctx:
+                await self.collect(backend.stream(self.messages))
+            self.assertEqual(ctx.exception.status_code, 429)
+
+    def test_merge_turns(self):
+        """Test that consecutive same-role messages are joined and unknown roles skipped."""
+        turns = merge_turns(self.messages, {"user": "user", "assistant": "model"})
+        self.assertEqual([t["role"] for t in turns], ["user", "model", "user"])
+
+
+class TestBackendRouter(unittest.IsolatedAsyncioTestCase):
+
+    async def collect(self, router, allowed=None):
+        return "".join([chunk async for chunk in router.stream([], allowed)])
+
+    async def test_routes_to_lowest_latency(self):
+        """Test that after trying every backend the router prefers the fastest."""
+        slow, fast = FakeBackend("slow", delay=0.05), FakeBackend("fast", delay=0.0)
+        router = BackendRouter([slow, fast], explore=0)
+        await self.collect(router)
+        await self.collect(router)
+        self.assertEqual((slow.calls, fast.calls), (1, 1))
+        for _ in range(5):
+            self.assertEqual(await self.collect(router), "fast")
+        self.assertEqual(slow.calls, 1)
+
+    async def test_errors_fail_over_and_shift_traffic(self):
+        """Test that a failing backend is skipped within the request and then avoided."""
+        broken, healthy = FakeBackend("broken", fail=True), FakeBackend("healthy", delay=0.01)
+        router = BackendRouter([broken, healthy], explore=0)
+        self.assertEqual(await self.collect(router), "healthy")
+        self.assertGreater(router.stats[broken.name].error_rate, 0)
+        broken.calls = 0
+        for _ in range(3):
+            self.assertEqual(await self.collect(router), "healthy")
+        self.assertEqual(broken.calls, 0)
+
+    async def test_allowed_models(self):
+        """Test that routing stays within the allowed models."""
+        a, b = FakeBackend("a"), FakeBackend("b", delay=0.01)
+        router = BackendRouter([a, b], explore=0)
+        for _ in range(3):
+            self.assertEqual(await self.collect(router, ["b"]), "b")
+        self.assertEqual(await self.collect(router, ["fake:a"]), "a")
+        with self.assertRaises(NoBackendAvailable):
+            router.allowed_backends(["c"])
+
+    async def test_budget_of_chosen_backend_is_charged(self):
+        """Test that the picked backend's budget is held while it streams, and a full one is skipped."""
+        a, b = FakeBackend("a"), FakeBackend("b")
+        router = BackendRouter([a, b], explore=0)
+        controller = AdmissionController(queue_timeout=0.05, model_budgets={"a": 1, "b": 1})
+        limiters = controller.model_limiters
+        held = await controller.admit_backend(a)
+        self.assertEqual("".join([chunk async for chunk in router.stream([], admit=controller.admit_backend)]), "b")
+        self.assertEqual(a.calls, 0)
+        held()
+        # b now has a latency, so the untried a comes first
+        stream = router.stream([], admit=controller.admit_backend)
+        self.assertEqual(await stream.__anext__(), "a")
+        self.assertEqual((limiters["a"].active, limiters["b"].active), (1, 0))
+        await stream.aclose()
+        self.assertEqual((limiters["a"].active, limiters["b"].active), (0, 0))
+        self.assertEqual(controller.global_limiter.active, 0)
+
+    async def test_last_error_is_raised(self):
+        """Test that the error of the last allowed backend propagates."""
+        router = BackendRouter([FakeBackend("x", fail=True)], explore=0)
+        with self.assertRaises(UpstreamError):
+            await self.collect(router)
+
+
+def import_chat_app():
+    """
+    Imports main.py without network access: tiktoken is replaced with the
+    word encoder and static files are served from an empty temp directory.
+    """
+    if "main" in sys.modules:
+        return sys.modules["main"]
+    static_root = tempfile.mkdtemp()
+    os.makedirs(os.path.join(static_root, "static"))
+    with open(os.path.join(static_root, "static", "index.html"), "w") as f:
+        f.write("<html></html>")
+    cwd = os.getcwd()
+    os.chdir(static_root)
+    try:
+        with mock.patch("tiktoken.encoding_for_model", return_value=WordEncoder()):
+            return importlib.import_module("main")
+    finally:
+        os.chdir(cwd)
+
+
+def use_mock_upstream(state, base_url):
+    """Points a running chat app's OpenAI backend at a mock server."""
+    state.upstream = UpstreamPool(state.http_client, [base_url + "/v1"])
+    state.router = BackendRouter([OpenAIBackend("gpt-3.5-turbo", state.upstream, "key")], explore=0)
+
+
+class ChatAppTestCase(unittest.TestCase):
+    """Serves the chat app in front of a local mock upstream."""
+    mock_config = MockConfig(tokens=5)
+
+    def setUp(self):
+        self.main = import_chat_app()
+        self.upstream = create_mock_app(self.mock_config)
+        self.upstream_server, upstream_url = serve_in_thread(self.upstream)
+        self.app_server, self.app_url = serve_in_thread(self.main.app)
+        state = self.main.app.state
+        use_mock_upstream(state, upstream_url)
+
+    def tearDown(self):
+        stop_server(self.app_server)
+        stop_server(self.upstream_server)
+
+    def wait_for(self, condition, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+
+class TestClientDisconnect(ChatAppTestCase):
+    mock_config = MockConfig(tokens=1000, token_rate=50)
+
+    def test_disconnect_cancels_upstream_stream(self):
+        """Test that a client disconnect stops reading from the upstream within a bounded time."""
+        disconnects = CLIENT_DISCONNECTS.value(source="upstream")
+        cancelled = UPSTREAM_CANCELLED.value()
+        body = {"message": "a long story please", "conversation_history": []}
+        with httpx.Client(timeout=5) as client:
+            with client.stream("POST", self.app_url + "/chat", json=body, headers={"Cache-Control": "no-store"}) as response:
+                self.assertEqual(response.status_code, 200)
+                chunks = response.iter_bytes()
+                next(chunks)
+                next(chunks)
+        # Closing the response drops the connection mid-stream
+        self.assertTrue(self.wait_for(lambda: self.upstream.state.disconnects == 1))
+        sent = self.upstream.state.chunks_sent
+        time.sleep(0.2)
+        self.assertEqual(self.upstream.state.chunks_sent, sent)
+        self.assertLess(sent, 1000)
+        self.assertTrue(self.wait_for(lambda: CLIENT_DISCONNECTS.value(source="upstream") == disconnects + 1))
+        self.assertEqual(UPSTREAM_CANCELLED.value(), cancelled + 1)
+
+
+class TestSharedClient(ChatAppTestCase):
+
+    def test_one_client_for_the_app_lifetime(self):
+        """Test that requests share the lifespan's client and its connection, and shutdown closes it."""
+        state = self.main.app.state
+        client = state.http_client
+        self.assertIsInstance(client, httpx.AsyncClient)
+        self.assertIs(state.upstream.client, client)
+        body = {"message": "Hello", "conversation_history": []}
+        with httpx.Client(timeout=5) as http:
+            for _ in range(3):
+                response = http.post(self.app_url + "/chat", json=body, headers={"Cache-Control": "no-store"})
+                self.assertEqual(response.status_code, 200)
+        self.assertIs(state.http_client, client)
+        self.assertFalse(client.is_closed)
+        # Sequential requests reuse one kept-alive upstream connection
+        self.assertEqual(len(client._transport._pool.connections), 1)
+        stop_server(self.app_server)
+        self.assertTrue(client.is_closed)
+
+
+class TestLoadTest(ChatAppTestCase):
+
+    def test_default_run_reaches_upstream(self):
+        """Test that a default load test sends unique, uncached prompts, so every request reaches the upstream."""
+        report = asyncio.run(run_load(self.app_url, concurrency=2, requests=6))
+        self.assertEqual(report["succeeded"], 6)
+        self.assertEqual(self.upstream.state.requests, 6)
+
+    def test_cached_run_is_opt_in(self):
+        """Test that repeated cacheable prompts are answered from the cache after the first."""
+        report = asyncio.run(run_load(self.app_url, concurrency=1, requests=4, unique=False, no_cache=False))
+        self.assertEqual(report["succeeded"], 4)
+        self.assertEqual(self.upstream.state.requests, 1)
+
+
+class TestUpstreamUnreachable(ChatAppTestCase):
+    """Points the chat app at a port nothing listens on."""
+
+    def setUp(self):
+        super().setUp()
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        use_mock_upstream(self.main.app.state, f"http://127.0.0.1:{port}")
+
+    def test_chat_reports_upstream_error(self):
+        """Test that a connection error ends /chat with an error event instead of a broken stream."""
+        body = {"message": "anyone there?", "conversation_history": []}
+        with httpx.Client(timeout=10) as client:
+            response = client.post(self.app_url + "/chat", json=body, headers={"Cache-Control": "no-cache"})
+        self.assertEqual(response.status_code, 200)
+        event, data = response.text.strip().split("\n")
+        self.assertEqual(event, "event: error")
+        self.assertEqual(json.loads(data[len("data: "):])["status"], 502)
+
+    def test_batch_reports_upstream_error(self):
+        """Test that a connection error is reported as a 502 batch item."""
+        with httpx.Client(timeout=10) as client:
+            response = client.post(self.app_url + "/chat/batch", json={"items": [{"message": "anyone there?"}]})
+        line = json.loads(response.text)
+        self.assertEqual(line["status"], 502)
+
+
+class TestFanOut(unittest.IsolatedAsyncioTestCase):
+
+    async def test_bounded_concurrency_and_completion_order(self):
+        """Test that at most `concurrency` items run at once and results arrive as they finish."""
+        running = peak = 0
+
+        async def handler(index, delay):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(delay)
+            running -= 1
+            return delay
+
+        delays = [0.05, 0.01, 0.03, 0.02, 0.04, 0.01]
+        results = [(index, result) async for index, result, error in fan_out(delays, handler, concurrency=3)]
+        self.assertEqual(peak, 3)
+        self.assertEqual(sorted(index for index, _ in results), list(range(len(delays))))
+        self.assertEqual(results[0][0], 1)
+        self.assertNotEqual([index for index, _ in results], list(range(len(delays))))
+
+    async def test_errors_are_per_item(self):
+        """Test that a failing item is reported and the others still complete."""
+        async def handler(index, item):
+            if item == "bad":
+                raise ValueError("bad item")
+            return item.upper()
+
+        results = {index: (result, error) async for index, result, error in fan_out(["a", "bad", "c"], handler, 2)}
+        self.assertEqual(results[0], ("A", None))
+        self.assertIsInstance(results[1][1], ValueError)
+        self.assertEqual(results[2], ("C", None))
+
+    async def test_closing_cancels_remaining_items(self):
+        """Test that closing the iterator early cancels the items in progress."""
+        cancelled = 0
+
+        async def handler(index, delay):
+            nonlocal cancelled
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                cancelled += 1
+                raise
+            return delay
+
+        results = fan_out([0.01, 5, 5], handler, concurrency=3)
+        await results.__anext__()
+        await results.aclose()
+        self.assertEqual(cancelled, 2)
+
+
+class TestChatEndpoint(ChatAppTestCase):
+
+    def post_chat(self, body, headers=None):
+        with httpx.Client(timeout=10) as client:
+            response = client.post(self.app_url + "/chat", json=body, headers=headers or {})
+        reply = "".join(line[6:] for line in response.text.split("\n") if line.startswith("data: "))
+        return response, reply
+
+    def test_conversation_id_keeps_history(self):
+        """Test that turns sent with a conversation_id reach the upstream with the earlier turns."""
+        response, first_reply = self.post_chat({"message": "First question", "conversation_id": "c1"})
+        self.assertEqual(response.headers["x-conversation-id"], "c1")
+        self.assertEqual(first_reply, "tok0 tok1 tok2 tok3 tok4 ")
+        self.post_chat({"message": "Second question", "conversation_id": "c1"})
+        messages = self.upstream.state.last_request["messages"]
+        self.assertEqual(messages[1:], [
+            {"role": "user", "content": "First question"},
+            {"role": "assistant", "content": first_reply},
+            {"role": "user", "content": "Second question"},
+        ])
+        history, counts = self.main.app.state.session_store.load("c1")
+        self.assertEqual(len(history), 4)
+        self.assertEqual(len(counts), 4)
+        self.post_chat({"message": "Unrelated", "conversation_id": "c2"})
+        self.assertEqual(self.upstream.state.last_request["messages"][1:], [{"role": "user", "content": "Unrelated"}])
+
+    def test_response_cache_miss_then_hit(self):
+        """Test that a repeated prompt is replayed from the cache unless the client sends no-cache."""
+        body = {"message": "Cache me", "conversation_history": []}
+        response, reply = self.post_chat(body)
+        self.assertEqual(response.headers["x-cache"], "MISS")
+        self.assertEqual(self.upstream.state.requests, 1)
+        response, cached_reply = self.post_chat(body)
+        self.assertEqual(response.headers["x-cache"], "HIT")
+        self.assertEqual(cached_reply, reply)
+        self.assertEqual(self.upstream.state.requests, 1)
+        response, _ = self.post_chat(body, headers={"Cache-Control": "no-cache"})
+        self.assertEqual(response.headers["x-cache"], "MISS")
+        self.assertEqual(self.upstream.state.requests, 2)
+        response, _ = self.post_chat({"message": "Cache me too", "conversation_history": []})
+        self.assertEqual(response.headers["x-cache"], "MISS")
+        self.assertEqual(self.upstream.state.requests, 3)
+
+
+    def scrape(self):
+        with httpx.Client(timeout=5) as client:
+            response = client.get(self.app_url + "/metrics")
+        self.assertEqual(response.status_code, 200)
+        samples = {}
+        for line in response.text.splitlines():
+            if line and not line.startswith("#"):
+                name, _, value = line.rpartition(" ")
+                samples[name] = float(value)
+        return response.text, samples
+
+    def test_metrics_after_request(self):
+        """Test that /metrics reports the counters and histograms of a completed /chat request."""
+        _, before = self.scrape()
+        self.post_chat({"message": "Count me", "conversation_history": []}, headers={"Cache-Control": "no-store"})
+        text, after = self.scrape()
+        self.assertIn("# TYPE chat_time_to_first_token_seconds histogram", text)
+        self.assertIn("# TYPE chat_completion_tokens_total counter", text)
+        for name, increase in (
+            ('chat_time_to_first_token_seconds_count{source="upstream"}', 1),
+            ('chat_stream_duration_seconds_count{source="upstream"}', 1),
+            ('chat_upstream_responses_total{status="200"}', 1),
+            ("chat_prompt_tokens_count", 1),
+            ("chat_completion_tokens_total", 5),
+        ):
+            self.assertEqual(after[name] - before.get(name, 0), increase, name)
+        self.assertEqual(after["chat_requests_in_flight"], 0)
+
+    def test_upstream_requests_are_not_logged_at_info(self):
+        """Test that httpx's per-request INFO lines are filtered out even when the app logs at INFO."""
+        root = logging.getLogger()
+        level = root.level
+        root.setLevel(logging.INFO)
+        self.addCleanup(root.setLevel, level)
+        for name in ("httpx", "httpcore"):
+            self.assertFalse(logging.getLogger(name).isEnabledFor(logging.INFO), name)
+
+
+class TestChatBatch(ChatAppTestCase):
+
+    def post_batch(self, body):
+        with httpx.Client(timeout=10) as client:
+            response = client.post(self.app_url + "/chat/batch", json=body)
+        return response, [json.loads(line) for line in response.text.splitlines()]
+
+    def test_batch_streams_ndjson_per_item(self):
+        """Test that every item gets one tagged line and a bad item does not fail the batch."""
+        items = [{"message": f"prompt {i}"} for i in range(6)]
+        items.append({"message": "sessions", "conversation_id": "c1"})
+        response, lines = self.post_batch({"items": items, "concurrency": 3})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["content-type"], "application/x-ndjson")
+        by_index = {line["index"]: line for line in lines}
+        self.assertEqual(sorted(by_index), list(range(7)))
+        for i in range(6):
+            self.assertEqual(by_index[i]["reply"], "tok0 tok1 tok2 tok3 tok4 ")
+            self.assertGreater(by_index[i]["prompt_tokens"], 0)
+        self.assertEqual(by_index[6]["status"], 400)
+        self.assertEqual(self.upstream.state.requests, 6)
+
+    def test_batch_uses_response_cache(self):
+        """Test that repeated prompts in later batches are served from the cache."""
+        self.post_batch({"items": [{"message": "same"}]})
+        _, lines = self.post_batch({"items": [{"message": "same"}]})
+        self.assertTrue(lines[0]["cached"])
+        self.assertEqual(self.upstream.state.requests, 1)
+
+    def test_upstream_errors_are_reported_per_item(self):
+        """Test that upstream failures become error lines."""
+        self.upstream.state.config = MockConfig(error_rate=1.0, error_status=400)
+        _, lines = self.post_batch({"items": [{"message": "x"}, {"message": "y"}]})
+        self.assertEqual([line["status"] for line in lines], [400, 400])
+
+    def test_unknown_model_is_rejected(self):
+        """Test that /chat answers 400 when no backend serves the allowed models."""
+        with httpx.Client(timeout=10) as client:
+            response = client.post(self.app_url + "/chat", json={"message": "hi", "models": ["no-such-model"]})
+        self.assertEqual(response.status_code, 400)
+
+    def test_batch_size_is_limited(self):
+        """Test that oversized batches are rejected up front."""
+        response, _ = self.post_batch({"items": [{"message": "x"}] * (BATCH_MAX_ITEMS + 1)})
+        self.assertEqual(response.status_code, 413)
+
+
+class TestWebSocketChat(unittest.TestCase):
+    """Drives /ws/chat in-process with Starlette's test client against a mock upstream."""
+
+    def setUp(self):
+        from starlette.testclient import TestClient
+        main = import_chat_app()
+        self.upstream = create_mock_app(MockConfig(tokens=5))
+        self.upstream_server, upstream_url = serve_in_thread(self.upstream)
+        self.client = TestClient(main.app)
+        self.client.__enter__()
+        state = main.app.state
+        use_mock_upstream(state, upstream_url)
+        self.session_store = state.session_store
+
+    def tearDown(self):
+        self.client.__exit__(None, None, None)
+        stop_server(self.upstream_server)
+
+    def turn(self, ws, message, turn_id=None):
+        ws.send_json({"type": "message", "message": message, "id": turn_id})
+        deltas = []
+        while True:
+            frame = ws.receive_json()
+            if frame["type"] != "delta":
+                return "".join(deltas), frame
+            self.assertEqual(frame["id"], turn_id)
+            deltas.append(frame["content"])
+
+    def test_turns_share_connection_context(self):
+        """Test that later turns send the earlier ones upstream without the client resending them."""
+        with self.client.websocket_connect("/ws/chat") as ws:
+            reply, done = self.turn(ws, "first question", 1)
+            self.assertEqual(reply, "tok0 tok1 tok2 tok3 tok4 ")
+            self.assertEqual(done["type"], "done")
+            self.assertEqual(done["id"], 1)
+            self.assertGreater(done["completion_tokens"], 0)
+            _, done = self.turn(ws, "second question", 2)
+            self.assertEqual(done["type"], "done")
+        sent = self.upstream.state.last_request["messages"]
+        self.assertEqual([m["role"] for m in sent], ["system", "user", "assistant", "user"])
+        self.assertEqual(sent[1]["content"], "first question")
+        self.assertEqual(sent[2]["content"], reply)
+
+    def test_cancel_stops_the_turn(self):
+        """Test that a cancel frame stops the stream and the connection stays usable."""
+        self.upstream.state.config = MockConfig(tokens=1000, token_rate=50)
+        with self.client.websocket_connect("/ws/chat") as ws:
+            ws.send_json({"type": "message", "message": "long story", "id": "a"})
+            self.assertEqual(ws.receive_json()["type"], "delta")
+            ws.send_json({"type": "message", "message": "too soon", "id": "b"})
+            busy = ws.receive_json()
+            while busy["type"] == "delta":
+                busy = ws.receive_json()
+            self.assertEqual((busy["id"], busy["status"]), ("b", 409))
+            ws.send_json({"type": "cancel"})
+            frame = ws.receive_json()
+            while frame["type"] == "delta":
+                frame = ws.receive_json()
+            self.assertEqual(frame, {"type": "cancelled", "id": "a"})
+            self.upstream.state.config = MockConfig(tokens=5)
+            _, done = self.turn(ws, "short one", "c")
+            self.assertEqual(done["type"], "done")
+        # The cancelled turn is not part of the history
+        sent = self.upstream.state.last_request["messages"]
+        self.assertEqual([m["content"] for m in sent[1:]], ["short one"])
+
+    def test_conversation_id_uses_session_store(self):
+        """Test that turns are saved to and loaded from the session store."""
+        with self.client.websocket_connect("/ws/chat?conversation_id=ws-1") as ws:
+            self.turn(ws, "remember this")
+        history, counts = self.session_store.load("ws-1")
+        self.assertEqual([m["role"] for m in history], ["user", "assistant"])
+        self.assertEqual(len(counts), 2)
+        with self.client.websocket_connect("/ws/chat?conversation_id=ws-1") as ws:
+            self.turn(ws, "what did I say?")
+        sent = self.upstream.state.last_request["messages"]
+        self.assertEqual(sent[1]["content"], "remember this")
+
+    def test_bad_frames_get_errors(self):
+        """Test that malformed frames are answered with an error and do not close the socket."""
+        with self.client.websocket_connect("/ws/chat") as ws:
+            ws.send_text("not json")
+            self.assertEqual(ws.receive_json()["status"], 400)
+            ws.send_json({"type": "bogus"})
+            self.assertEqual(ws.receive_json()["status"], 400)
+            _, done = self.turn(ws, "still here")
+            self.assertEqual(done["type"], "done")
+
+
+class TestStaticAssets(unittest.TestCase):
+
+    def setUp(self):
+        from starlette.applications import Starlette
+        from starlette.routing import Mount, Route
+        from starlette.templating import Jinja2Templates
+        from starlette.testclient import TestClient
+        self.directory = tempfile.mkdtemp()
+        self.script = "console.log('hello');\n" * 100
+        with open(os.path.join(self.directory, "app.js"), "w") as f:
+            f.write(self.script)
+        with open(os.path.join(self.directory, "index.html"), "w") as f:
+            f.write("<html>{{ 6 * 7 }}" + " " * 500 + "</html>")
+        self.page = RenderedPage(Jinja2Templates(directory=self.directory), "index.html")
+        app = Starlette(routes=[
+            Route("/", lambda request: self.page.response(request)),
+            Mount("/static", PrecompressedStaticFiles(directory=self.directory)),
+        ])
+        self.client = TestClient(app)
+
+    def test_accepted_encodings(self):
+        """Test Accept-Encoding parsing, including q=0 and wildcards."""
+        self.assertEqual(accepted_encodings("gzip, deflate"), ["gzip"])
+        self.assertEqual(accepted_encodings("gzip;q=0, br"), ["br"])
+        self.assertEqual(accepted_encodings("*"), ["br", "gzip"])
+        self.assertEqual(accepted_encodings(""), [])
+
+    def test_precompressed_copy_is_served(self):
+        """Test that the .gz copy is served to gzip clients with caching headers."""
+        self.assertGreaterEqual(precompress(self.directory), 1)
+        self.assertEqual(precompress(self.directory), 0)
+        response = self.client.get("/static/app.js", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["content-encoding"], "gzip")
+        self.assertIn("javascript", response.headers["content-type"])
+        self.assertEqual(response.headers["vary"], "Accept-Encoding")
+        self.assertIn("max-age", response.headers["cache-control"])
+        self.assertEqual(response.text, self.script)
+        self.assertLess(int(response.headers["content-length"]), len(self.script))
+        revalidated = self.client.get(
+            "/static/app.js", headers={"Accept-Encoding": "gzip", "If-None-Match": response.headers["etag"]}
+        )
+        self.assertEqual(revalidated.status_code, 304)
+
+    def test_identity_without_accept_encoding(self):
+        """Test that clients that do not accept gzip get the original file."""
+        precompress(self.directory)
+        response = self.client.get("/static/app.js", headers={"Accept-Encoding": "identity"})
+        self.assertNotIn("content-encoding", response.headers)
+        self.assertEqual(int(response.headers["content-length"]), len(self.script))
+
+    def test_index_is_rendered_once(self):
+        """Test that the index is rendered on first use, compressed and revalidated by ETag."""
+        response = self.client.get("/", headers={"Accept-Encoding": "gzip"})
+        self.assertIn("42", response.text)
+        self.assertEqual(response.headers["content-encoding"], "gzip")
+        os.remove(os.path.join(self.directory, "index.html"))
+        again = self.client.get("/", headers={"Accept-Encoding": "gzip", "If-None-Match": response.headers["etag"]})
+        self.assertEqual(again.status_code, 304)
+
+    def test_server_options(self):
+        """Test that production mode drops the reload watcher and development mode keeps one worker."""
+        production = server_options(workers=4)
+        self.assertEqual((production["reload"], production["workers"]), (False, 4))
+        self.assertIn(production["loop"], ("uvloop", "asyncio"))
+        self.assertEqual(server_options(workers=4, reload=True)["workers"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional
+
+# Chat format overhead for gpt-3.5-turbo / gpt-4 style models: every message is
+# wrapped in <|start|>{role}\n{content}<|end|>, a "name" field costs one extra
+# token, and every reply is primed with <|start|>assistant<|message|>.
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+REPLY_PRIMING_TOKENS = 3
+
+# Uncached text above this many characters is tokenized off the event loop
+TOKENIZE_OFFLOAD_CHARS = int(os.getenv("TOKENIZE_OFFLOAD_CHARS", "20000"))
+TOKENIZER_THREADS = int(os.getenv("TOKENIZER_THREADS", "2"))
+
+
+class TrimResult(NamedTuple):
+    """
+    Outcome of fitting a conversation into a token budget.
+
+    Attributes:
+        messages (list): The messages that fit, in their original order.
+        counts (list): Token count of each kept message, including format overhead.
+        token_count (int): Total prompt tokens of the kept messages, including reply priming.
+        trimmed_messages (int): Number of history messages dropped.
+        trimmed_tokens (int): Tokens of the dropped messages.
+    """
+    messages: list
+    counts: list
+    token_count: int
+    trimmed_messages: int
+    trimmed_tokens: int
+
+
+class TokenCounter:
+    """
+    Counts chat prompt tokens with a bounded cache from content hash to token count.
+
+    History turns are resent on every request, so after the first request each
+    of them is a cache hit and is never re-encoded.
+    """
+
+    def __init__(
+        self,
+        encoder,
+        max_entries: int = 10000,
+        offload_chars: int = TOKENIZE_OFFLOAD_CHARS,
+        threads: int = TOKENIZER_THREADS,
+    ):
+        """
+        Args:
+            encoder: A tiktoken `Encoding` (anything with an `encode(str)` method).
+            max_entries (int): Maximum number of cached token counts (LRU eviction).
+            offload_chars (int): Uncached text size from which the async methods
+                tokenize in the thread pool instead of on the event loop.
+            threads (int): Size of the tokenizer thread pool.
+        """
+        self.encoder = encoder
+        self.max_entries = max_entries
+        self.offload_chars = offload_chars
+        self.threads = threads
+        self.hits = 0
+        self.misses = 0
+        self.offloaded = 0
+        self._cache: "OrderedDict[bytes, int]" = OrderedDict()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @staticmethod
+    def _key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def count_text(self, text: str) -> int:
+        """
+        Returns the number of tokens in a string, encoding it only on a cache miss.
+        """
+        key = self._key(text)
+        cache = self._cache
+        count = cache.get(key)
+        if count is not None:
+            cache.move_to_end(key)
+            self.hits += 1
+            return count
+        self.misses += 1
+        count = len(self.encoder.encode(text))
+        self._store(key, count)
+        return count
+
+    def _store(self, key: bytes, count: int) -> None:
+        cache = self._cache
+        cache[key] = count
+        if len(cache) > self.max_entries:
+            cache.popitem(last=False)
+
+    def count_message(self, message: dict) -> int:
+        """
+        Returns the tokens a single message occupies in the prompt, including
+        the per-message role/format overhead.
+        """
+        tokens = TOKENS_PER_MESSAGE
+        for key, value in message.items():
+            if isinstance(value, str):
+                tokens += self.count_text(value)
+            if key == "name":
+                tokens += TOKENS_PER_NAME
+        return tokens
+
+    def _encode_lengths(self, texts: List[str]) -> List[int]:
+        # Runs in the tokenizer pool; tiktoken releases the GIL while encoding
+        encode_batch = getattr(self.encoder, "encode_batch", None)
+        if encode_batch is not None:
+            return [len(tokens) for tokens in encode_batch(texts, num_threads=self.threads)]
+        return [len(self.encoder.encode(text)) for text in texts]
+
+    async def count_each_async(self, messages: List[dict]) -> List[int]:
+        """
+        Returns the token count of each message, like `count_message`, without
+        blocking the event loop on large uncached text.
+
+        Cached text is counted inline. If the uncached text adds up to at least
+        `offload_chars` characters, it is batch-encoded in the tokenizer thread
+        pool while the event loop keeps serving other requests.
+        """
+        missing: Dict[bytes, str] = {}
+        for message in messages:
+            for value in message.values():
+                if isinstance(value, str):
+                    key = self._key(value)
+                    if key not in self._cache:
+                        missing[key] = value
+        if sum(len(text) for text in missing.values()) < self.offload_chars:
+            return [self.count_message(message) for message in messages]
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="tokenizer")
+        texts = list(missing.values())
+        lengths = await asyncio.get_running_loop().run_in_executor(self._executor, self._encode_lengths, texts)
+        self.misses += len(texts)
+        self.offloaded += 1
+        # The cache is only touched on the event loop thread
+        fresh = dict(zip(missing, lengths))
+        for key, count in fresh.items():
+            self._store(key, count)
+
+        counts = []
+        for message in messages:
+            tokens = TOKENS_PER_MESSAGE
+            for key, value in message.items():
+                if isinstance(value, str):
+                    count = fresh.get(self._key(value))
+                    tokens += count if count is not None else self.count_text(value)
+                if key == "name":
+                    tokens += TOKENS_PER_NAME
+            counts.append(tokens)
+        return counts
+
+    async def trim_async(self, messages: List[dict], max_tokens: int, counts: Optional[List[int]] = None) -> TrimResult:
+        """
+        Like `trim`, but tokenizes large uncached histories off the event loop.
+        """
+        if counts is None:
+            counts = await self.count_each_async(messages)
+        return self.trim(messages, max_tokens, counts)
+
+    def close(self) -> None:
+        """Shuts down the tokenizer thread pool, if it was started."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def count_messages(self, messages: List[dict]) -> int:
+        """
+        Returns the prompt tokens of a whole conversation, including reply priming.
+        """
+        return sum(self.count_message(message) for message in messages) + REPLY_PRIMING_TOKENS
+
+    def trim(self, messages: List[dict], max_tokens: int, counts: Optional[List[int]] = None) -> TrimResult:
+        """
+        Drops the oldest history messages until the prompt fits in `max_tokens`.
+
+        The first (system) message and the newest message are always kept. The
+        rest is walked once from newest to oldest, so the cost is linear in the
+        number of messages.
+
+        Args:
+            messages (list): System message, history and the new user message.
+            max_tokens (int): Prompt token budget.
+            counts (list, optional): Precomputed per-message token counts.
+
+        Returns:
+            TrimResult: The kept messages and the token accounting.
+        """
+        if counts is None:
+            counts = [self.count_message(message) for message in messages]
+        if len(messages) <= 2:
+            return TrimResult(list(messages), list(counts), sum(counts) + REPLY_PRIMING_TOKENS, 0, 0)
+
+        used = counts[0] + counts[-1] + REPLY_PRIMING_TOKENS
+        first_kept = len(messages) - 1
+        while first_kept > 1 and used + counts[first_kept - 1] <= max_tokens:
+            first_kept -= 1
+            used += counts[first_kept]
+
+        kept_messages = [messages[0]] + messages[first_kept:]
+        kept_counts = [counts[0]] + counts[first_kept:]
+        trimmed_tokens = sum(counts[1:first_kept])
+        return TrimResult(kept_messages, kept_counts, used, first_kept - 1, trimmed_tokens)
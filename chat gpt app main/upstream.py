@@ -0,0 +1,139 @@
+import logging
+import os
+import httpx
+
+from metrics import UPSTREAM_RESPONSES
+from streaming import parse_delta
+
+logger = logging.getLogger(__name__)
+
+# Connection pool and timeout settings for the upstream completions API.
+# Every value can be overridden through the environment (or the .env file).
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "60"))
+UPSTREAM_WRITE_TIMEOUT = float(os.getenv("UPSTREAM_WRITE_TIMEOUT", "10"))
+UPSTREAM_POOL_TIMEOUT = float(os.getenv("UPSTREAM_POOL_TIMEOUT", "10"))
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "1").lower() not in ("0", "false", "no")
+
+
+def http2_available() -> bool:
+    """
+    Check whether the optional `h2` package needed for HTTP/2 is installed.
+
+    Returns:
+        bool: True if httpx can negotiate HTTP/2, False otherwise.
+    """
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def create_upstream_client(**overrides) -> httpx.AsyncClient:
+    """
+    Create the application-scoped client used for all upstream calls.
+
+    Connections are kept alive and reused across requests, so only the first
+    request to a host pays for the TCP and TLS handshakes. The read timeout
+    bounds the gap between two streamed chunks, not the whole completion.
+
+    Args:
+        **overrides: Keyword arguments passed through to `httpx.AsyncClient`,
+            taking precedence over the environment configuration.
+
+    Returns:
+        httpx.AsyncClient: A pooled client. The caller owns it and must close it.
+    """
+    options = {
+        "http2": UPSTREAM_HTTP2 and http2_available(),
+        "limits": httpx.Limits(
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+            keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+        ),
+        "timeout": httpx.Timeout(
+            connect=UPSTREAM_CONNECT_TIMEOUT,
+            read=UPSTREAM_READ_TIMEOUT,
+            write=UPSTREAM_WRITE_TIMEOUT,
+            pool=UPSTREAM_POOL_TIMEOUT,
+        ),
+    }
+    options.update(overrides)
+    return httpx.AsyncClient(**options)
+
+
+# Point this at a local mock (see mock_upstream.py) to test without API quota
+UPSTREAM_BASE_URL = os.getenv("UPSTREAM_BASE_URL", "https://api.openai.com/v1").rstrip("/")
+CHAT_COMPLETIONS_URL = f"{UPSTREAM_BASE_URL}/chat/completions"
+
+# Statuses worth retrying on another attempt: throttling, timeouts and server errors
+RETRYABLE_STATUSES = frozenset({408, 409, 425, 429, 500, 502, 503, 504})
+
+
+class UpstreamError(Exception):
+    """
+    Raised when the completions API answers with an error status.
+
+    Attributes:
+        status_code (int): HTTP status of the upstream response.
+        retryable (bool): Whether another attempt may succeed.
+    """
+
+    def __init__(self, status_code: int, body: bytes = b""):
+        super().__init__(f"Upstream returned HTTP {status_code}: {body[:200]!r}")
+        self.status_code = status_code
+        self.retryable = status_code in RETRYABLE_STATUSES
+
+
+async def stream_chat_completion(client: httpx.AsyncClient, api_key: str, payload: dict, url: str = CHAT_COMPLETIONS_URL):
+    """
+    Streams a chat completion and yields the content deltas as they arrive.
+
+    Args:
+        client (httpx.AsyncClient): The shared upstream client.
+        api_key (str): Bearer token for the completions API.
+        payload (dict): Request body; must ask for `"stream": True`.
+        url (str): Chat completions endpoint.
+
+    Yields:
+        str: Non-empty content deltas, in order.
+
+    Raises:
+        UpstreamError: If the API answers with a non-200 status.
+    """
+    async with client.stream(
+        "POST",
+        url,
+        headers={
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        },
+        json=payload,
+    ) as response:
+        UPSTREAM_RESPONSES.inc(status=response.status_code)
+        logger.debug("OpenAI API response status: %s", response.status_code)
+        if response.status_code != 200:
+            body = await response.aread()
+            logger.warning("Error from OpenAI API: %s %s", response.status_code, body)
+            raise UpstreamError(response.status_code, body)
+        done = False
+        async for line in response.aiter_lines():
+            # Reading on to the end of the body after [DONE] lets the
+            # connection go back to the pool instead of being closed
+            if done or not line.startswith("data: "):
+                continue
+            data = line[6:]
+            if data == "[DONE]":
+                done = True
+                continue
+            try:
+                content = parse_delta(data)
+            except Exception as e:
+                logger.warning("Error parsing chunk: %s", e)
+                continue
+            if content:
+                yield content
@@ -0,0 +1,312 @@
+"""
+Hedged requests and failover across several upstream completions endpoints.
+
+Each request goes to the healthiest endpoint first. If its first token has not
+arrived after the hedge delay (a high percentile of recent first-token
+latencies), a second attempt is started on the next endpoint, the first stream
+to produce a token wins and the other one is cancelled. Errors that happen
+before streaming starts are retried with jittered exponential backoff; once a
+token has been streamed the request is committed to its endpoint.
+"""
+import asyncio
+import logging
+import math
+import os
+import random
+import time
+from collections import deque
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+import httpx
+
+from metrics import UPSTREAM_ENDPOINT_FAILURES, UPSTREAM_HEDGE_WINS, UPSTREAM_HEDGES, UPSTREAM_RETRIES
+from upstream import UPSTREAM_BASE_URL, UpstreamError, stream_chat_completion
+
+logger = logging.getLogger(__name__)
+
+# Comma-separated base URLs, in order of preference
+UPSTREAM_URLS = os.getenv("UPSTREAM_URLS", UPSTREAM_BASE_URL)
+# Hedge once the first token is later than this percentile of recent first-token latencies
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_INITIAL_DELAY = float(os.getenv("HEDGE_INITIAL_DELAY", "1.0"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.05"))
+HEDGE_MAX_DELAY = float(os.getenv("HEDGE_MAX_DELAY", "5.0"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+# Extra attempts started for one slow request; 0 disables hedging
+MAX_HEDGES = int(os.getenv("MAX_HEDGES", "1"))
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "2"))
+RETRY_BACKOFF_BASE = float(os.getenv("RETRY_BACKOFF_BASE", "0.1"))
+RETRY_BACKOFF_MAX = float(os.getenv("RETRY_BACKOFF_MAX", "2.0"))
+# Consecutive failures after which an endpoint is skipped for the cooldown
+ENDPOINT_FAILURE_THRESHOLD = int(os.getenv("ENDPOINT_FAILURE_THRESHOLD", "3"))
+ENDPOINT_COOLDOWN = float(os.getenv("ENDPOINT_COOLDOWN", "30"))
+
+
+def parse_urls(spec: str) -> List[str]:
+    """
+    Parses a comma-separated list of base URLs.
+    """
+    return [url.strip().rstrip("/") for url in spec.split(",") if url.strip()]
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Returns whether an error raised before the first token is worth another attempt.
+    """
+    if isinstance(error, UpstreamError):
+        return error.retryable
+    return isinstance(error, httpx.TransportError)
+
+
+def as_upstream_error(error: BaseException) -> BaseException:
+    """
+    Turns a network error into the UpstreamError callers handle: 504 for
+    timeouts, 502 for anything else. Other errors are returned unchanged.
+    """
+    if not isinstance(error, httpx.TransportError):
+        return error
+    status_code = 504 if isinstance(error, httpx.TimeoutException) else 502
+    upstream_error = UpstreamError(status_code, f"{type(error).__name__}: {error}".encode())
+    upstream_error.__cause__ = error
+    return upstream_error
+
+
+class Endpoint:
+    """
+    One upstream base URL and its health.
+
+    After `failure_threshold` consecutive failures the endpoint is unhealthy
+    for `cooldown` seconds. It is then tried again; one more failure puts it
+    back in cooldown, one success makes it healthy.
+    """
+
+    def __init__(self, base_url: str, failure_threshold: int = ENDPOINT_FAILURE_THRESHOLD, cooldown: float = ENDPOINT_COOLDOWN):
+        self.base_url = base_url
+        self.url = f"{base_url}/chat/completions"
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        self.successes = 0
+        self.failures = 0
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    def record_success(self) -> None:
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold:
+            self.unhealthy_until = time.monotonic() + self.cooldown
+            logger.warning("Upstream %s marked unhealthy for %.0fs", self.base_url, self.cooldown)
+
+
+class UpstreamPool:
+    """
+    Streams completions from a list of endpoints with hedging, retries and failover.
+    """
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        base_urls: Sequence[str] = (),
+        hedge_percentile: float = HEDGE_PERCENTILE,
+        hedge_initial_delay: float = HEDGE_INITIAL_DELAY,
+        hedge_min_delay: float = HEDGE_MIN_DELAY,
+        hedge_max_delay: float = HEDGE_MAX_DELAY,
+        hedge_min_samples: int = HEDGE_MIN_SAMPLES,
+        max_hedges: int = MAX_HEDGES,
+        retries: int = UPSTREAM_MAX_RETRIES,
+        backoff_base: float = RETRY_BACKOFF_BASE,
+        backoff_max: float = RETRY_BACKOFF_MAX,
+        failure_threshold: int = ENDPOINT_FAILURE_THRESHOLD,
+        cooldown: float = ENDPOINT_COOLDOWN,
+    ):
+        """
+        Args:
+            client (httpx.AsyncClient): The shared upstream client.
+            base_urls (list): Endpoint base URLs in order of preference;
+                defaults to the UPSTREAM_URLS setting.
+            hedge_percentile (float): First-token latency percentile used as the hedge delay.
+            hedge_initial_delay (float): Hedge delay until enough latencies have been seen.
+            hedge_min_delay (float): Lower bound of the hedge delay in seconds.
+            hedge_max_delay (float): Upper bound of the hedge delay in seconds.
+            hedge_min_samples (int): Latencies needed before the percentile is used.
+            max_hedges (int): Extra attempts per request; 0 disables hedging.
+            retries (int): Retries of errors that happen before streaming starts.
+            backoff_base (float): First retry backoff in seconds, doubled on each retry.
+            backoff_max (float): Upper bound of the retry backoff in seconds.
+            failure_threshold (int): Consecutive failures that make an endpoint unhealthy.
+            cooldown (float): Seconds an unhealthy endpoint is skipped.
+        """
+        self.client = client
+        self.endpoints = [
+            Endpoint(url, failure_threshold, cooldown) for url in (base_urls or parse_urls(UPSTREAM_URLS))
+        ]
+        if not self.endpoints:
+            raise ValueError("At least one upstream URL is required.")
+        self.hedge_percentile = hedge_percentile
+        self.hedge_initial_delay = hedge_initial_delay
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_delay = hedge_max_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.max_hedges = max_hedges
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._first_token_latencies: "deque[float]" = deque(maxlen=512)
+
+    @property
+    def healthy_endpoints(self) -> int:
+        return sum(endpoint.healthy for endpoint in self.endpoints)
+
+    def hedge_delay(self) -> float:
+        """
+        Returns how long to wait for a first token before hedging.
+        """
+        samples = self._first_token_latencies
+        if len(samples) < self.hedge_min_samples:
+            delay = self.hedge_initial_delay
+        else:
+            ordered = sorted(samples)
+            rank = math.ceil(len(ordered) * self.hedge_percentile / 100) - 1
+            delay = ordered[min(max(rank, 0), len(ordered) - 1)]
+        return min(max(delay, self.hedge_min_delay), self.hedge_max_delay)
+
+    def backoff(self, retry: int) -> float:
+        """
+        Returns the sleep before the given retry (1-based), with full jitter.
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (retry - 1)))
+
+    def ordered_endpoints(self) -> List[Endpoint]:
+        """
+        Returns the healthy endpoints in order of preference, then the
+        unhealthy ones, soonest to recover first, as a last resort.
+        """
+        healthy = [endpoint for endpoint in self.endpoints if endpoint.healthy]
+        unhealthy = sorted(
+            (endpoint for endpoint in self.endpoints if not endpoint.healthy),
+            key=lambda endpoint: endpoint.unhealthy_until,
+        )
+        return healthy + unhealthy
+
+    async def _first_token(self, endpoint: Endpoint, api_key: str, payload: dict) -> Tuple[AsyncIterator[str], Optional[str]]:
+        # Opens one attempt and waits for its first content delta (None if the stream is empty)
+        stream = stream_chat_completion(self.client, api_key, payload, endpoint.url)
+        started = time.perf_counter()
+        try:
+            first = await stream.__anext__()
+        except StopAsyncIteration:
+            first = None
+        except BaseException:
+            await stream.aclose()
+            raise
+        self._first_token_latencies.append(time.perf_counter() - started)
+        return stream, first
+
+    async def _race(self, api_key: str, payload: dict) -> Tuple[AsyncIterator[str], Optional[str]]:
+        # Runs attempts (the primary, hedges and retries) until one produces a first token
+        endpoints = self.ordered_endpoints()
+        attempts: Dict[asyncio.Task, Endpoint] = {}
+        pending = set()
+        winner = None
+
+        def start() -> None:
+            endpoint = endpoints[len(attempts) % len(endpoints)]
+            task = asyncio.get_running_loop().create_task(self._first_token(endpoint, api_key, payload))
+            attempts[task] = endpoint
+            pending.add(task)
+
+        hedges = retries = 0
+        last_error = None
+        start()
+        try:
+            while True:
+                timeout = self.hedge_delay() if hedges < self.max_hedges else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # The first token is late: race a second attempt against it
+                    hedges += 1
+                    UPSTREAM_HEDGES.inc()
+                    logger.debug("No first token after %.3fs; hedging", timeout)
+                    start()
+                    continue
+                pending.difference_update(done)
+                fatal_error = None
+                for task in done:
+                    endpoint = attempts[task]
+                    error = task.exception()
+                    if error is None:
+                        endpoint.record_success()
+                        if winner is None:
+                            winner = task
+                        continue
+                    logger.warning("Upstream attempt on %s failed: %s", endpoint.base_url, error)
+                    if not is_retryable(error):
+                        # The request itself was rejected; that says nothing about the endpoint
+                        fatal_error = error
+                        continue
+                    endpoint.record_failure()
+                    UPSTREAM_ENDPOINT_FAILURES.inc(endpoint=endpoint.base_url)
+                    last_error = error
+                if winner is not None:
+                    if hedges and next(iter(attempts)) is not winner:
+                        UPSTREAM_HEDGE_WINS.inc()
+                    return winner.result()
+                if fatal_error is not None:
+                    # Every endpoint would reject it too: stop the hedges before reporting it
+                    for task in pending:
+                        task.cancel()
+                    await asyncio.gather(*pending, return_exceptions=True)
+                    pending.clear()
+                    raise fatal_error
+                if not pending:
+                    # Nothing has been streamed yet, so another attempt is safe
+                    if retries >= self.retries:
+                        raise as_upstream_error(last_error)
+                    retries += 1
+                    UPSTREAM_RETRIES.inc()
+                    await asyncio.sleep(self.backoff(retries))
+                    start()
+        finally:
+            # Cancel the losers and close any that also produced a token
+            for task in pending:
+                task.cancel()
+            for task in attempts:
+                if task is not winner and task.done() and not task.cancelled() and task.exception() is None:
+                    await task.result()[0].aclose()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    async def stream(self, api_key: str, payload: dict) -> AsyncIterator[str]:
+        """
+        Streams a chat completion from the first endpoint to produce a token.
+
+        Args:
+            api_key (str): Bearer token for the completions API.
+            payload (dict): Request body; must ask for `"stream": True`.
+
+        Yields:
+            str: Non-empty content deltas, in order.
+
+        Raises:
+            UpstreamError: If every attempt fails, or the first non-retryable
+                error status. Network errors are reported as 502, or 504 for
+                timeouts.
+        """
+        stream, first = await self._race(api_key, payload)
+        try:
+            if first is None:
+                return
+            yield first
+            async for content in stream:
+                yield content
+        finally:
+            await stream.aclose()